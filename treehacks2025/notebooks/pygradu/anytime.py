@@ -0,0 +1,255 @@
+import heapq
+import threading
+import time
+import numpy as np
+from .shortest_path import as_node_mask, get_node, get_path_speeds, get_turn_penalties, retrace_path
+
+
+class AnytimeResult():
+    def __init__(self, route, cost, bound, epsilon, expansions, seconds, final, search):
+        """
+        Best route found so far. cost is at most bound times the optimal cost,
+        final is True when the search has nothing left to improve. search is
+        the AnytimeSearch that keeps improving the route in the background.
+        """
+        self.route = route
+        self.cost = cost
+        self.bound = bound
+        self.epsilon = epsilon
+        self.expansions = expansions
+        self.seconds = seconds
+        self.final = final
+        self.search = search
+
+
+class AnytimeSearch():
+    def __init__(self, graph, start_latlon, end_latlon, avg_speeds, speed, course, vessel_type, grid, dirways_graph, shallow_graph,
+                 mmsi, voyage, start_time, landmarks=None, epsilon=2.0, epsilon_step=0.5):
+        """
+        Anytime repairing A* (ARA*) on the same costs as a_star_heap.
+        Nodes are ordered by g + epsilon * h, the first route is found fast
+        and every following iteration lowers epsilon and reuses the earlier
+        search until epsilon is 1. h comes from the landmark tables (see
+        landmarks.py), without landmarks h is 0 and the first route is optimal.
+        """
+        self.graph = graph
+        self.grid = grid
+        self.start_latlon = start_latlon
+        self.end_latlon = end_latlon
+        self.avg_speeds = avg_speeds
+        self.speed = speed
+        self.vessel_type = vessel_type
+        self.mmsi = mmsi
+        self.voyage = voyage
+        self.start_time = start_time
+        self.epsilon = epsilon
+        self.epsilon_step = epsilon_step
+
+        self.start_pos = get_node(grid, start_latlon[0], start_latlon[1])
+        self.end_pos = get_node(grid, end_latlon[0], end_latlon[1])
+
+        node_count = grid.get_node_count()
+        self.g = np.full(node_count, np.inf)
+        self.h = np.zeros(node_count)
+        self.parents = np.full(node_count, -1, dtype=np.int64)
+        self.course = course
+        self.course_codes = np.full(node_count, -1, dtype=np.int32)
+        self.closed = np.zeros(node_count, dtype=bool)
+        self.open_keys = np.full(node_count, np.inf)
+        self.open_heap = []
+        self.inconsistent = set()
+        # Epsilon of the last iteration that ran to completion
+        self.proven_epsilon = np.inf
+        self.counter = 0
+        self.expansions = 0
+        self.seconds = 0.0
+
+        self.dirway_mask = None
+        if graph.use_dirways:
+            self.dirway_mask = as_node_mask(dirways_graph, node_count)
+        self.shallow_mask = None
+        if graph.use_shallow_penalty:
+            self.shallow_mask = as_node_mask(shallow_graph, node_count)
+
+        self.turns = None
+        if graph.use_turn_penalty:
+            self.turns = graph.get_turn_table(grid)
+
+        self.heuristic = None
+        if landmarks is not None:
+            landmarks.check_graph(graph)
+            self.heuristic = landmarks.get_heuristic(self.end_pos)
+
+        self.result = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = False
+
+        # Positions outside the grid (-1) leave the heap empty and no route is found
+        if self.start_pos >= 0 and self.end_pos >= 0:
+            self.g[self.start_pos] = 0
+            self.h[self.start_pos] = self.get_h([self.start_pos])[0]
+            self.push(self.start_pos)
+
+    def get_h(self, nodes):
+        if self.heuristic is None:
+            return np.zeros(len(nodes))
+        return self.heuristic(nodes)
+
+    def get_key(self, node):
+        return self.g[node] + self.epsilon * self.h[node]
+
+    def push(self, node):
+        key = self.get_key(node)
+        self.open_keys[node] = key
+        self.counter += 1
+        heapq.heappush(self.open_heap, (key, self.counter, node))
+
+    def pop_stale(self):
+        while self.open_heap and self.open_keys[self.open_heap[0][2]] != self.open_heap[0][0]:
+            heapq.heappop(self.open_heap)
+
+    # Expand nodes until the route to the goal can not be improved with the
+    # current epsilon or the budget runs out. Returns False when interrupted.
+    def improve_path(self, deadline, max_expansions):
+        graph = self.graph
+        while True:
+            self.pop_stale()
+            if not self.open_heap or self.get_key(self.end_pos) <= self.open_heap[0][0]:
+                return True
+            if self.stopped or (max_expansions is not None and self.expansions >= max_expansions) or \
+                    (deadline is not None and time.perf_counter() >= deadline):
+                return False
+
+            _, _, current = heapq.heappop(self.open_heap)
+            self.open_keys[current] = np.inf
+            self.closed[current] = True
+            self.expansions += 1
+            current_g = self.g[current]
+
+            next_nodes, next_costs = graph.get_neighbours(
+                current, self.dirway_mask, self.shallow_mask)
+
+            next_codes = None
+            if self.turns is not None:
+                penalties, next_codes = get_turn_penalties(graph, self.grid, self.turns, current,
+                                                           self.course_codes[current], self.course,
+                                                           next_nodes, self.dirway_mask)
+                next_costs = next_costs + penalties
+                next_codes = next_codes.tolist()
+
+            # Heuristic of the nodes seen for the first time, all at once
+            new_nodes = next_nodes[(self.parents[next_nodes] == -1) & (next_nodes != self.start_pos)]
+            if len(new_nodes) > 0:
+                self.h[new_nodes] = self.get_h(new_nodes)
+
+            for i, (next_node, next_g) in enumerate(zip(next_nodes.tolist(), next_costs.tolist())):
+                next_g += current_g
+
+                if next_g < self.g[next_node]:
+                    self.g[next_node] = next_g
+                    self.parents[next_node] = current
+                    if next_codes is not None:
+                        self.course_codes[next_node] = next_codes[i]
+                    if self.closed[next_node]:
+                        self.inconsistent.add(next_node)
+                    else:
+                        self.push(next_node)
+
+    # Optimal cost is at least the smallest g + h of the nodes left to expand
+    def get_bound(self):
+        cost = self.g[self.end_pos]
+        if not np.isfinite(cost):
+            return np.inf
+        nodes = [node for key, _, node in self.open_heap if self.open_keys[node] == key]
+        nodes.extend(self.inconsistent)
+        if not nodes:
+            return 1.0
+        nodes = np.array(nodes, dtype=np.int64)
+        lower_bound = np.min(self.g[nodes] + self.h[nodes])
+        if lower_bound >= cost:
+            return 1.0
+        if lower_bound <= 0:
+            return self.proven_epsilon
+        return min(self.proven_epsilon, cost / lower_bound)
+
+    def publish(self, final):
+        cost = self.g[self.end_pos]
+        if not np.isfinite(cost):
+            return
+        path = []
+        node = self.end_pos
+        while node != -1:
+            path.append(int(node))
+            node = self.parents[node]
+        path = path[::-1]
+
+        speeds = get_path_speeds(self.avg_speeds, self.vessel_type, self.speed, path)
+        route = retrace_path(self.grid, path, speeds, self.start_latlon, self.end_latlon,
+                             self.mmsi, self.voyage, self.start_time)
+        bound = 1.0 if final else self.get_bound()
+        with self.lock:
+            self.result = AnytimeResult(route, float(cost), float(bound), self.epsilon,
+                                        self.expansions, self.seconds, final, self)
+
+    # Run until the bound is 1 or the budget (seconds and/or expansions) is used
+    def run(self, max_seconds=None, max_expansions=None):
+        started = time.perf_counter()
+        deadline = None if max_seconds is None else started + max_seconds
+        if max_expansions is not None:
+            max_expansions += self.expansions
+
+        while True:
+            completed = self.improve_path(deadline, max_expansions)
+            self.seconds += time.perf_counter() - started
+            started = time.perf_counter()
+            if completed:
+                self.proven_epsilon = self.epsilon
+            final = completed and self.epsilon <= 1.0
+            self.publish(final)
+            if not completed or final or self.stopped:
+                break
+
+            # Next iteration with a smaller epsilon reuses the g-values found so far
+            self.epsilon = max(1.0, self.epsilon - self.epsilon_step)
+            open_nodes = [node for key, _, node in self.open_heap if self.open_keys[node] == key]
+            self.open_heap = []
+            self.open_keys[:] = np.inf
+            for node in set(open_nodes) | self.inconsistent:
+                self.push(node)
+            self.inconsistent = set()
+            self.closed[:] = False
+
+        return self.get_result()
+
+    def get_result(self):
+        with self.lock:
+            return self.result
+
+    # Keep lowering epsilon in a background thread, get_result returns the latest route
+    def improve_in_background(self):
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+
+
+# Anytime version of a_star_heap. Returns the best route found within the
+# budget as an AnytimeResult, or None when no route was found in time.
+def anytime_a_star(graph, start_latlon, end_latlon, avg_speeds, speed, course, vessel_type, grid, dirways_graph, shallow_graph, mmsi, voyage, start_time,
+                   landmarks=None, epsilon=2.0, max_seconds=None, max_expansions=None, improve_in_background=False):
+    search = AnytimeSearch(graph, start_latlon, end_latlon, avg_speeds, speed, course, vessel_type, grid, dirways_graph, shallow_graph,
+                           mmsi, voyage, start_time, landmarks, epsilon)
+    result = search.run(max_seconds, max_expansions)
+    if result is None:
+        print('Path not found within budget!')
+        print('Voyage=', str(voyage))
+        return None
+    if improve_in_background and not result.final:
+        search.improve_in_background()
+    return result
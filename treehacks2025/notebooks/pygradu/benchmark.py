@@ -0,0 +1,201 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from . import gridify, instrumentation, portcalls, shortest_path, synthetic
+
+
+def run_queries(engine, observations, grid, graph, avg_speeds, dirways_graph, shallow_graph):
+    expansions = 0
+    failed = 0
+    started = time.perf_counter()
+    for i, observation in observations.iterrows():
+        start_coords = [observation.lat, observation.lon]
+        end_coords = [observation.end_lat, observation.end_lon]
+        start_time = pd.to_datetime(observation.timestamp)
+
+        route = engine(graph, start_coords, end_coords, avg_speeds, observation.speed, observation.course,
+                       observation.vessel_type, grid, dirways_graph, shallow_graph, observation.mmsi, observation.voyage, start_time)
+        if route is None:
+            failed += 1
+            continue
+        # The goal node is expanded but not stored in the search area
+        expansions += len(route[1]) + 1
+    seconds = time.perf_counter() - started
+
+    return [len(observations), failed, expansions, seconds, expansions / seconds if seconds > 0 else None]
+
+
+# Compare expansions per second of the original and the heap based A*
+def benchmark_a_star(observations, grid, graph, avg_speeds, dirways_graph=None, shallow_graph=None, engines=None):
+    if engines is None:
+        engines = {
+            'a_star': shortest_path.a_star,
+            'a_star_heap': shortest_path.a_star_heap,
+        }
+
+    results = []
+    for name, engine in engines.items():
+        result = [name]
+        result.extend(run_queries(engine, observations, grid, graph,
+                      avg_speeds, dirways_graph, shallow_graph))
+        results.append(result)
+
+    return pd.DataFrame(data=results, columns=['engine', 'queries', 'failed', 'expansions', 'seconds', 'expansions_per_second'])
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Run function repeat times with its prints silenced and add the fastest time to results
+def time_step(results, step, repeat, function, *args, size=None):
+    times = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            output = function(*args)
+        times.append(time.perf_counter() - started)
+    results.append({'step': step, 'seconds': min(times), 'times': times,
+                    'size': size(output) if size is not None else None})
+    return output
+
+
+# calculate_voyages saves checkpoint CSVs to the working directory
+def calculate_voyages_in_temp_dir(ais, ports):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        os.chdir(path)
+        try:
+            return portcalls.calculate_voyages(ais, ports)
+        finally:
+            os.chdir(cwd)
+
+
+# Time the model building and prediction steps on a seeded synthetic dataset
+# (see synthetic.py). Every step gets the output of the previous ones, so the
+# whole pipeline runs even when only one step is of interest.
+def run_suite(scale='small', seed=0, repeat=1, legacy_a_star=False):
+    config = synthetic.SCALES[scale]
+    rng = np.random.default_rng(seed)
+    side_length = config['side_length']
+    results = []
+
+    north_east, south_west = synthetic.get_area(config['width_km'], config['height_km'])
+    grid = time_step(results, 'area_to_grid', repeat, gridify.area_to_grid, north_east, south_west, side_length,
+                     size=lambda grid: grid.get_node_count())
+    node_count = grid.get_node_count()
+
+    land = synthetic.generate_land(rng, north_east, south_west, config['islands'], side_length)
+    ports = synthetic.generate_ports(rng, north_east, south_west, config['ports'], land, side_length)
+    ais, voyages = synthetic.generate_ais(rng, grid, ports, config['vessels'])
+    dirways = synthetic.generate_dirways(rng, north_east, south_west, config['dirways'])
+    shallow_graph = synthetic.get_shallow_nodes(grid, land, side_length)
+    observations = synthetic.get_observations(voyages, config['queries'])
+
+    sea_graph = time_step(results, 'create_sea_graph', repeat, gridify.create_sea_graph, grid, True, land, size=len)
+    sea_graph = pd.DataFrame(data=sea_graph, columns=['original', 'connected'])
+    traffic_graph = time_step(results, 'create_graph_from_ais_adjacent', repeat,
+                              gridify.create_graph_from_ais_adjacent, ais, size=len)
+    time_step(results, 'create_graph_from_ais_maneuvaribility', repeat,
+              gridify.create_graph_from_ais_maneuvaribility, grid, ais, size=len)
+    traffic_graph = pd.DataFrame(data=traffic_graph, columns=['original', 'connected'])
+    sea_graph = time_step(results, 'calculate_transition_cost', repeat,
+                          gridify.calculate_transition_cost, sea_graph.copy(), traffic_graph, size=len)
+    time_step(results, 'calculate_voyages', repeat, calculate_voyages_in_temp_dir,
+              ais, synthetic.get_port_nodes(grid, ports), size=len)
+    avg_speeds = time_step(results, 'get_avg_speeds', repeat, gridify.get_avg_speeds, ais, node_count)
+
+    graph = shortest_path.df_to_graph(sea_graph[['original', 'connected', 'cost']], node_count)
+    graph.use_shallow_penalty = True
+    stats = instrumentation.BatchStats()
+    routes = time_step(results, 'a_star_heap', repeat, shortest_path.predict_routes, observations, grid, graph,
+                       avg_speeds, dirways, shallow_graph, True, None, None, None, False, stats,
+                       size=lambda routes: len(routes[0]))
+    summary = stats.get_summary()
+    # Stats of every repeat are collected, report one run
+    results[-1].update({name: summary[name] / repeat for name in
+                        ['expanded', 'edges_relaxed', 'heap_pushes', 'decrease_keys', 'found']})
+
+    if legacy_a_star:
+        dict_graph = shortest_path.df_to_dict_graph(sea_graph[['original', 'connected', 'cost']])
+        dict_graph.use_shallow_penalty = True
+        time_step(results, 'a_star', repeat, run_queries, shortest_path.a_star, observations, grid, dict_graph,
+                  avg_speeds, shortest_path.create_dirways_graph(dirways.copy(), grid), shallow_graph,
+                  size=lambda result: result[2])
+
+    routes = pd.DataFrame(data=routes[0], columns=[
+                          'lat', 'lon', 'node', 'speed', 'mmsi', 'voyage', 'start_time', 'number'])
+    predicted = time_step(results, 'calculate_timestamps', repeat,
+                          shortest_path.calculate_timestamps, routes, size=len)
+    time_step(results, 'test_accuracy', repeat, shortest_path.test_accuracy,
+              grid, predicted.copy(), voyages, 60, size=len)
+    time_step(results, 'test_accuracy_to_end', repeat, shortest_path.test_accuracy_to_end,
+              grid, predicted.copy(), voyages, None, size=len)
+
+    return {
+        'scale': scale,
+        'seed': seed,
+        'repeat': repeat,
+        'config': config,
+        'commit': get_commit(),
+        'created': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'results': results,
+    }
+
+
+# Step times of two run_suite outputs, ratio > 1 means current is slower
+def compare_results(baseline, current):
+    baseline = {result['step']: result['seconds'] for result in baseline['results']}
+    rows = []
+    for result in current['results']:
+        before = baseline.get(result['step'])
+        ratio = result['seconds'] / before if before else None
+        rows.append([result['step'], before, result['seconds'], ratio])
+    return pd.DataFrame(data=rows, columns=['step', 'baseline_seconds', 'seconds', 'ratio'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time pygradu on a synthetic dataset')
+    parser.add_argument('--scale', default='small',
+                        choices=list(synthetic.SCALES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--legacy-a-star', action='store_true',
+                        help='also time the original dict based a_star')
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    args = parser.parse_args(argv)
+
+    suite = run_suite(args.scale, args.seed, args.repeat, args.legacy_a_star)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(suite, f, indent=2, default=str)
+    else:
+        print(json.dumps(suite, indent=2, default=str))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(compare_results(baseline, suite).to_string(index=False), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,413 @@
+import bisect
+import heapq
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from .shortest_path import SHALLOW_PENALTY, as_node_mask, get_node, get_path_speeds, retrace_path
+
+
+class ContractionHierarchy():
+    def __init__(self, rank, up_indptr, up_indices, up_costs, up_middles, down_indptr, down_indices, down_costs, down_middles,
+                 use_shallow_penalty, signature):
+        """
+        Contracted graph for static port-to-port queries.
+        up_* is a CSR graph of the edges from a node to higher ranked nodes and
+        down_* of the edges from higher ranked nodes into a node, stored reversed.
+        Neighbours are sorted by node id. *_middles holds the contracted middle
+        node of shortcut edges and -1 for the edges of the original graph.
+        signature is graph.get_signature() of the graph the hierarchy was built for.
+        """
+        self.rank = rank
+        self.up_indptr = up_indptr
+        self.up_indices = up_indices
+        self.up_costs = up_costs
+        self.up_middles = up_middles
+        self.down_indptr = down_indptr
+        self.down_indices = down_indices
+        self.down_costs = down_costs
+        self.down_middles = down_middles
+        self.use_shallow_penalty = use_shallow_penalty
+        self.signature = tuple(signature)
+        self.query_data = None
+
+    def has_node(self, node):
+        return 0 <= node < len(self.rank) and self.rank[node] >= 0
+
+    def get_shortcut_count(self):
+        return int(np.count_nonzero(self.up_middles >= 0) + np.count_nonzero(self.down_middles >= 0))
+
+    # Plain lists are faster than numpy for looking up single nodes and edges
+    # in the query and when shortcuts are unpacked. They are made on the first query.
+    def get_query_data(self):
+        if self.query_data is None:
+            self.query_data = tuple(array.tolist() for array in (
+                self.rank, self.up_indptr, self.up_indices, self.up_costs, self.up_middles,
+                self.down_indptr, self.down_indices, self.down_costs, self.down_middles))
+        return self.query_data
+
+    # Dirways and turn penalties depend on the query, so routes that need them go through a_star_heap
+    def check_graph(self, graph):
+        if graph.get_signature() != self.signature:
+            raise ValueError(
+                'Contraction hierarchy was built for another graph or before its costs changed, rebuild it')
+        if graph.use_dirways or graph.use_turn_penalty:
+            raise ValueError(
+                'Contraction hierarchies do not support dirways or turn penalties, set graph.use_dirways=False and graph.use_turn_penalty=False')
+        if graph.use_shallow_penalty != self.use_shallow_penalty:
+            raise ValueError(
+                'Contraction hierarchy was built with use_shallow_penalty=' + str(self.use_shallow_penalty))
+
+    # The forward search only goes up from start and the backward search only
+    # goes up from end, the cheapest node reached by both is on the shortest path.
+    # The searches take turns by the smaller key and stop when neither can
+    # reach a node cheaper than the best meeting found, so a query only
+    # touches the nodes near the top of the hierarchy and not the whole grid.
+    def query(self, start, end):
+        if not self.has_node(start) or not self.has_node(end):
+            return np.inf, None
+        if start == end:
+            return 0.0, [start]
+
+        _, up_indptr, up_indices, up_costs, _, down_indptr, down_indices, down_costs, _ = self.get_query_data()
+        forward, forward_parents, forward_heap = {start: 0.0}, {start: -1}, [(0.0, start)]
+        backward, backward_parents, backward_heap = {end: 0.0}, {end: -1}, [(0.0, end)]
+        best = np.inf
+        meeting = -1
+
+        while True:
+            forward_key = forward_heap[0][0] if forward_heap else np.inf
+            backward_key = backward_heap[0][0] if backward_heap else np.inf
+            if forward_key >= best and backward_key >= best:
+                break
+
+            # The forward search goes along up edges, the backward search along
+            # the reversed down edges. Edges of the other kind lead into the node
+            # from higher ranked nodes and are used to stall it.
+            if forward_key <= backward_key:
+                distance, node = heapq.heappop(forward_heap)
+                distances, parents, other, open_heap = forward, forward_parents, backward, forward_heap
+                indptr, indices, costs = up_indptr, up_indices, up_costs
+                in_indptr, in_indices, in_costs = down_indptr, down_indices, down_costs
+            else:
+                distance, node = heapq.heappop(backward_heap)
+                distances, parents, other, open_heap = backward, backward_parents, forward, backward_heap
+                indptr, indices, costs = down_indptr, down_indices, down_costs
+                in_indptr, in_indices, in_costs = up_indptr, up_indices, up_costs
+            if distance > distances[node]:
+                continue
+
+            other_distance = other.get(node)
+            if other_distance is not None and distance + other_distance < best:
+                best = distance + other_distance
+                meeting = node
+
+            # A node reached cheaper through a higher ranked node is not on a
+            # shortest up path, so its edges are not relaxed
+            stalled = False
+            for i in range(in_indptr[node], in_indptr[node + 1]):
+                in_distance = distances.get(in_indices[i])
+                if in_distance is not None and in_distance + in_costs[i] < distance:
+                    stalled = True
+                    break
+            if stalled:
+                continue
+
+            for i in range(indptr[node], indptr[node + 1]):
+                next_node = indices[i]
+                next_distance = distance + costs[i]
+                if next_distance < distances.get(next_node, np.inf):
+                    distances[next_node] = next_distance
+                    parents[next_node] = node
+                    heapq.heappush(open_heap, (next_distance, next_node))
+
+        if meeting == -1:
+            return np.inf, None
+
+        # Forward parents lead back to start, backward parents lead on to end
+        path_nodes = [meeting]
+        while forward_parents[path_nodes[-1]] >= 0:
+            path_nodes.append(forward_parents[path_nodes[-1]])
+        path_nodes = path_nodes[::-1]
+        while backward_parents[path_nodes[-1]] >= 0:
+            path_nodes.append(backward_parents[path_nodes[-1]])
+
+        path = [start]
+        for from_node, to_node in zip(path_nodes, path_nodes[1:]):
+            path.extend(self.unpack_edge(from_node, to_node))
+        return float(best), path
+
+    # Middle node of the edge from_node -> to_node, -1 for an edge of the original graph.
+    # The edge is stored with the lower ranked one of its nodes.
+    def get_middle(self, from_node, to_node):
+        rank, up_indptr, up_indices, _, up_middles, down_indptr, down_indices, _, down_middles = self.get_query_data()
+        if rank[from_node] < rank[to_node]:
+            i = bisect.bisect_left(up_indices, to_node, up_indptr[from_node], up_indptr[from_node + 1])
+            return up_middles[i]
+        i = bisect.bisect_left(down_indices, from_node, down_indptr[to_node], down_indptr[to_node + 1])
+        return down_middles[i]
+
+    # Replace a shortcut with the original grid nodes it skips over, end node included
+    def unpack_edge(self, from_node, to_node):
+        path = []
+        stack = [(from_node, to_node)]
+        while stack:
+            a, b = stack.pop()
+            middle = self.get_middle(a, b)
+            if middle == -1:
+                path.append(b)
+            else:
+                stack.append((middle, b))
+                stack.append((a, middle))
+        return path
+
+    # Same output as a_star_heap, see route_with_hierarchy
+    def route(self, start_latlon, end_latlon, avg_speeds, speed, vessel_type, grid, mmsi, voyage, start_time):
+        return route_with_hierarchy(self, start_latlon, end_latlon, avg_speeds, speed, vessel_type, grid, mmsi, voyage, start_time)
+
+    def save(self, path):
+        node_count, edge_count, digest = self.signature
+        np.savez(path, rank=self.rank, up_indptr=self.up_indptr, up_indices=self.up_indices, up_costs=self.up_costs,
+                 up_middles=self.up_middles, down_indptr=self.down_indptr, down_indices=self.down_indices,
+                 down_costs=self.down_costs, down_middles=self.down_middles, use_shallow_penalty=self.use_shallow_penalty,
+                 node_count=node_count, edge_count=edge_count, digest=digest)
+
+
+def load_hierarchy(path):
+    data = np.load(path)
+    signature = (int(data['node_count']), int(data['edge_count']), str(data['digest']))
+    return ContractionHierarchy(data['rank'], data['up_indptr'], data['up_indices'], data['up_costs'], data['up_middles'],
+                                data['down_indptr'], data['down_indices'], data['down_costs'], data['down_middles'],
+                                bool(data['use_shallow_penalty']), signature)
+
+
+def get_static_costs(graph, shallow_graph=None):
+    costs = graph.costs
+    if graph.use_shallow_penalty and shallow_graph is not None:
+        shallow_mask = as_node_mask(shallow_graph, graph.node_count)
+        costs = costs + SHALLOW_PENALTY * shallow_mask[graph.indices]
+    return costs
+
+
+class RemainingGraph():
+    def __init__(self, sources, targets, costs, middles, node_count):
+        """
+        Edges between the nodes that are not contracted yet, sorted by
+        (from, to) so that out edges are CSR slices and single edges are
+        found with a binary search. middles holds the contracted node of
+        shortcuts and -1 for original edges. Of duplicate edges the cheapest
+        one is kept.
+        """
+        keys = sources * node_count + targets
+        order = np.lexsort((costs, keys))
+        keys = keys[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        order = order[first]
+
+        self.node_count = node_count
+        self.keys = keys[first]
+        self.sources = sources[order]
+        self.targets = targets[order]
+        self.costs = costs[order]
+        self.middles = middles[order]
+        self.indptr = np.zeros(node_count + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum(np.bincount(self.sources, minlength=node_count))
+        self.in_degrees = np.bincount(self.targets, minlength=node_count)
+
+    def get_out_degrees(self):
+        return np.diff(self.indptr)
+
+    # Costs of the edges from_nodes -> to_nodes, inf where there is no edge
+    def get_costs(self, from_nodes, to_nodes):
+        if len(self.keys) == 0:
+            return np.full(len(from_nodes), np.inf)
+        keys = from_nodes * self.node_count + to_nodes
+        i = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[i] == keys, self.costs[i], np.inf)
+
+    # Edge positions of the out edges of nodes and the index in nodes they belong to
+    def expand(self, nodes):
+        starts = self.indptr[nodes]
+        counts = self.indptr[nodes + 1] - starts
+        owners = np.repeat(np.arange(len(nodes)), counts)
+        positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return owners, positions
+
+
+# Cheapest costs u -> w in the remaining graph without the excluded nodes.
+# scipy's Dijkstra runs from up to budget / node count sources at a time and
+# only searches up to limit, costs above it are inf.
+def get_path_costs(remaining, u, w, excluded, limit, budget):
+    present = np.zeros(remaining.node_count, dtype=bool)
+    present[remaining.sources] = True
+    present[remaining.targets] = True
+    present &= ~excluded
+    nodes = np.flatnonzero(present)
+    local = np.full(remaining.node_count, -1, dtype=np.int64)
+    local[nodes] = np.arange(len(nodes))
+    edges = present[remaining.sources] & present[remaining.targets]
+    matrix = csr_matrix((remaining.costs[edges], (local[remaining.sources[edges]], local[remaining.targets[edges]])),
+                        shape=(len(nodes), len(nodes)))
+
+    sources, inverse = np.unique(u, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(sources) + 1))
+    chunk = max(1, budget // max(1, len(nodes)))
+    costs = np.full(len(u), np.inf)
+    for start in range(0, len(sources), chunk):
+        end = min(start + chunk, len(sources))
+        rows = order[bounds[start]:bounds[end]]
+        distances = dijkstra(matrix, indices=local[sources[start:end]], limit=limit[rows].max())
+        costs[rows] = distances[inverse[rows] - start, local[w[rows]]]
+    return costs
+
+
+# Shortcuts (u, w, cost, v) that contracting the nodes v of middles needs.
+# The shortcut u -> v -> w is left out when there is another path u -> w that
+# costs at most as much and does not go through v or the excluded nodes. With
+# at most exact_nodes nodes left the witness search is a Dijkstra search,
+# before that it is limited to the edge u -> w and paths u -> x -> w, so some
+# unneeded shortcuts are kept. excluded=None only checks the edge u -> w,
+# which is enough for priority estimates. In edges are handled in blocks of
+# about block_size candidates.
+def find_shortcuts(remaining, middles, excluded, block_size, exact_nodes):
+    estimate = excluded is None
+    exact = not estimate and np.count_nonzero(np.diff(remaining.indptr) + remaining.in_degrees) <= exact_nodes
+
+    is_middle = np.zeros(remaining.node_count, dtype=bool)
+    is_middle[middles] = True
+    in_edges = np.flatnonzero(is_middle[remaining.targets])
+    out_degrees = remaining.get_out_degrees()
+    counts = np.cumsum(out_degrees[remaining.targets[in_edges]])
+    bounds = np.searchsorted(counts, np.arange(block_size, counts[-1] if len(counts) else 0, block_size))
+    shortcuts = [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64))]
+    for block in np.split(in_edges, bounds):
+        owners, positions = remaining.expand(remaining.targets[block])
+        u = remaining.sources[block][owners]
+        v = remaining.targets[block][owners]
+        w = remaining.targets[positions]
+        cost = remaining.costs[block][owners] + remaining.costs[positions]
+
+        needed = (u != w) & (remaining.get_costs(u, w) > cost)
+        u, v, w, cost = u[needed], v[needed], w[needed], cost[needed]
+
+        if not estimate and not exact:
+            owners, positions = remaining.expand(u)
+            x = remaining.targets[positions]
+            through = remaining.costs[positions] + remaining.get_costs(x, w[owners])
+            witness = (x != v[owners]) & ~excluded[x] & (through <= cost[owners])
+            needed = np.bincount(owners[witness], minlength=len(u)) == 0
+            u, v, w, cost = u[needed], v[needed], w[needed], cost[needed]
+        shortcuts.append((u, w, cost, v))
+
+    u, w, cost, v = (np.concatenate(arrays) for arrays in zip(*shortcuts))
+    if exact and len(u) > 0:
+        needed = get_path_costs(remaining, u, w, excluded, cost, block_size) > cost
+        u, w, cost, v = u[needed], w[needed], cost[needed], v[needed]
+    return u, w, cost, v
+
+
+def edges_to_csr(owners, neighbours, costs, middles, node_count):
+    order = np.lexsort((neighbours, owners))
+    indptr = np.zeros(node_count + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(owners, minlength=node_count))
+    return indptr, neighbours[order].astype(np.int32), costs[order], middles[order]
+
+
+# Offline contraction of the traffic cost graph. Dirways and turn penalties
+# depend on the query so they are not supported, the shallow water penalty
+# is included when graph.use_shallow_penalty is set.
+# Nodes are contracted in rounds: every round contracts the nodes with a lower
+# priority (edge difference plus contracted neighbours) than all of their
+# neighbours. They are independent, so their shortcuts are found together with
+# array operations. Priorities are only updated for the neighbours of
+# contracted nodes, see find_shortcuts for the witness searches.
+def build_hierarchy(graph, shallow_graph=None, block_size=2**20, exact_nodes=20000, seed=0):
+    node_count = graph.node_count
+    costs = get_static_costs(graph, shallow_graph).astype(np.float64)
+    sources = np.repeat(np.arange(node_count, dtype=np.int64), np.diff(graph.indptr))
+    targets = graph.indices.astype(np.int64)
+    edges = sources != targets
+    remaining = RemainingGraph(sources[edges], targets[edges], costs[edges],
+                               np.full(np.count_nonzero(edges), -1, dtype=np.int64), node_count)
+
+    alive = np.zeros(node_count, dtype=bool)
+    alive[remaining.sources] = True
+    alive[remaining.targets] = True
+    node_total = int(np.count_nonzero(alive))
+    # Ties between equal priorities are broken in a random but fixed order
+    tiebreak = np.random.default_rng(seed).permutation(node_count)
+    priorities = np.zeros(node_count, dtype=np.int64)
+    contracted_neighbours = np.zeros(node_count, dtype=np.int64)
+    dirty = alive.copy()
+
+    rank = np.full(node_count, -1, dtype=np.int64)
+    empty = np.zeros(0, dtype=np.int64)
+    up_edges = [(empty, empty, np.zeros(0), empty)]
+    down_edges = [(empty, empty, np.zeros(0), empty)]
+    order = 0
+    rounds = 0
+    while order < node_total:
+        nodes = np.flatnonzero(dirty)
+        if len(nodes) > 0:
+            middles = find_shortcuts(remaining, nodes, None, block_size, exact_nodes)[3]
+            priorities[nodes] = np.bincount(middles, minlength=node_count)[nodes] - remaining.in_degrees[nodes] - \
+                remaining.get_out_degrees()[nodes] + contracted_neighbours[nodes]
+            dirty[:] = False
+
+        alive_nodes = np.flatnonzero(alive)
+        keys = np.zeros(node_count, dtype=np.int64)
+        keys[alive_nodes[np.lexsort((tiebreak[alive_nodes], priorities[alive_nodes]))]] = np.arange(len(alive_nodes))
+        selected = alive.copy()
+        selected[remaining.sources[keys[remaining.sources] > keys[remaining.targets]]] = False
+        selected[remaining.targets[keys[remaining.targets] > keys[remaining.sources]]] = False
+        nodes = np.flatnonzero(selected)
+        nodes = nodes[np.argsort(keys[nodes])]
+
+        u, w, cost, v = find_shortcuts(remaining, nodes, selected, block_size, exact_nodes)
+
+        # Remaining neighbours are all ranked higher than the contracted nodes
+        up = selected[remaining.sources]
+        down = selected[remaining.targets]
+        up_edges.append((remaining.sources[up], remaining.targets[up], remaining.costs[up], remaining.middles[up]))
+        down_edges.append((remaining.targets[down], remaining.sources[down], remaining.costs[down], remaining.middles[down]))
+        neighbours = np.concatenate((remaining.targets[up], remaining.sources[down]))
+        contracted_neighbours += np.bincount(neighbours, minlength=node_count)
+        dirty[neighbours] = True
+
+        rank[nodes] = order + np.arange(len(nodes))
+        order += len(nodes)
+        alive[nodes] = False
+        rounds += 1
+
+        keep = ~(up | down)
+        remaining = RemainingGraph(np.concatenate((remaining.sources[keep], u)), np.concatenate((remaining.targets[keep], w)),
+                                   np.concatenate((remaining.costs[keep], cost)), np.concatenate((remaining.middles[keep], v)),
+                                   node_count)
+        if rounds % 10 == 0:
+            print('Contracted', order, '/', node_total, 'edges left', len(remaining.keys))
+
+    up_indptr, up_indices, up_costs, up_middles = edges_to_csr(
+        *(np.concatenate(arrays) for arrays in zip(*up_edges)), node_count)
+    down_indptr, down_indices, down_costs, down_middles = edges_to_csr(
+        *(np.concatenate(arrays) for arrays in zip(*down_edges)), node_count)
+    hierarchy = ContractionHierarchy(rank, up_indptr, up_indices, up_costs, up_middles, down_indptr, down_indices, down_costs,
+                                     down_middles, graph.use_shallow_penalty and shallow_graph is not None, graph.get_signature())
+    print('Contraction rounds', rounds)
+    print('Shortcuts added', hierarchy.get_shortcut_count())
+    return hierarchy
+
+
+# Same output as a_star_heap, the search area is not available for hierarchy queries
+def route_with_hierarchy(hierarchy, start_latlon, end_latlon, avg_speeds, speed, vessel_type, grid, mmsi, voyage, start_time):
+    start_pos = get_node(grid, start_latlon[0], start_latlon[1])
+    end_pos = get_node(grid, end_latlon[0], end_latlon[1])
+
+    cost, path = hierarchy.query(start_pos, end_pos)
+    if path is None:
+        print('Path does not exist!')
+        print('Voyage=', str(voyage))
+        return None
+
+    speeds = get_path_speeds(avg_speeds, vessel_type, speed, path)
+    return [retrace_path(grid, path, speeds, start_latlon, end_latlon, mmsi, voyage, start_time), []]
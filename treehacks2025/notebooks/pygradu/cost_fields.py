@@ -0,0 +1,121 @@
+from collections import OrderedDict
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from .layers import get_layer_key
+from .shortest_path import as_node_mask, get_node, get_path_speeds, retrace_path
+
+
+class CostField():
+    def __init__(self, destination, cost_to_go, next_hop):
+        """
+        Result of one reverse search from destination.
+        cost_to_go[n] is the cost of the cheapest route from n to destination
+        (inf when there is none) and next_hop[n] the node after n on that route.
+        """
+        self.destination = destination
+        self.cost_to_go = cost_to_go
+        self.next_hop = next_hop
+
+    def get_path(self, start):
+        if start < 0 or start >= len(self.cost_to_go) or not np.isfinite(self.cost_to_go[start]):
+            return None
+        path = [start]
+        while path[-1] != self.destination:
+            path.append(int(self.next_hop[path[-1]]))
+        return path
+
+
+class CostFields():
+    def __init__(self, graph, grid, shallow_graph=None, max_fields=32):
+        """
+        Cost fields by destination node, for routing many vessels to the same ports.
+        Fields are built on first use and kept until the graph costs or flags
+        change (graph.version). Fields are also keyed by the active dirways and
+        the least recently used field is dropped when there are more than max_fields.
+        Turn penalties depend on the course of the vessel so they are not supported.
+        """
+        if graph.use_turn_penalty:
+            raise ValueError(
+                'Cost fields do not support turn penalties, set graph.use_turn_penalty=False')
+        self.graph = graph
+        self.grid = grid
+        self.shallow_mask = None
+        if graph.use_shallow_penalty:
+            shallow_mask = as_node_mask(shallow_graph, graph.node_count)
+            if shallow_mask is not None:
+                self.shallow_mask = shallow_mask[:graph.node_count]
+        self.max_fields = max_fields
+        self.fields = OrderedDict()
+        self.graph_key = None
+        self.builds = 0
+
+    def get_graph_key(self):
+        return (self.graph.version, self.graph.use_dirways, self.graph.use_shallow_penalty)
+
+    # dirway_key identifies the dirway node set, e.g. DirwayCache.get_key(time)
+    def get_field(self, destination, dirways_graph=None, dirway_key=None):
+        if self.get_graph_key() != self.graph_key:
+            self.fields = OrderedDict()
+            self.graph_key = self.get_graph_key()
+
+        if not self.graph.use_dirways:
+            dirways_graph = None
+        if dirways_graph is not None and dirway_key is None:
+            dirway_key = get_layer_key(dirways_graph)
+        if dirways_graph is None:
+            dirway_key = None
+
+        key = (destination, dirway_key)
+        if key in self.fields:
+            self.fields.move_to_end(key)
+            return self.fields[key]
+
+        self.fields[key] = self.build_field(destination, dirways_graph)
+        if len(self.fields) > self.max_fields:
+            self.fields.popitem(last=False)
+        return self.fields[key]
+
+    def build_field(self, destination, dirways_graph):
+        graph = self.graph
+        dirway_mask = as_node_mask(dirways_graph, graph.node_count)
+        if dirway_mask is not None:
+            dirway_mask = dirway_mask[:graph.node_count]
+        costs = graph.get_all_costs(dirway_mask, self.shallow_mask)
+
+        if destination < 0 or destination >= graph.node_count:
+            cost_to_go = np.full(graph.node_count, np.inf)
+            return CostField(destination, cost_to_go, np.full(graph.node_count, -1, dtype=np.int32))
+
+        # Dijkstra from the destination over the reversed edges. The predecessor
+        # of a node in the reversed search is its next hop towards the destination.
+        matrix = csr_matrix((costs, graph.indices, graph.indptr),
+                            shape=(graph.node_count, graph.node_count))
+        cost_to_go, predecessors = dijkstra(
+            matrix.T.tocsr(), indices=destination, return_predecessors=True)
+        self.builds += 1
+        return CostField(destination, cost_to_go, predecessors.astype(np.int32))
+
+    def route(self, start_latlon, end_latlon, avg_speeds, speed, vessel_type, dirways_graph, mmsi, voyage, start_time, dirway_key=None):
+        return route_with_cost_field(self, start_latlon, end_latlon, avg_speeds, speed, vessel_type, self.grid,
+                                     dirways_graph, mmsi, voyage, start_time, dirway_key)
+
+    def clear(self):
+        self.fields = OrderedDict()
+
+
+# Same output as a_star_heap, ties between equally cheap routes may be broken
+# differently and the search area is not available.
+def route_with_cost_field(cost_fields, start_latlon, end_latlon, avg_speeds, speed, vessel_type, grid, dirways_graph, mmsi, voyage, start_time, dirway_key=None):
+    start_pos = get_node(grid, start_latlon[0], start_latlon[1])
+    end_pos = get_node(grid, end_latlon[0], end_latlon[1])
+
+    field = cost_fields.get_field(end_pos, dirways_graph, dirway_key)
+    path = field.get_path(start_pos)
+    if path is None:
+        print('Path does not exist!')
+        print('Voyage=', str(voyage))
+        return None
+
+    speeds = get_path_speeds(avg_speeds, vessel_type, speed, path)
+    return [retrace_path(grid, path, speeds, start_latlon, end_latlon, mmsi, voyage, start_time), []]
@@ -0,0 +1,110 @@
+import math
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+
+# Great circle functions on a spherical earth. Coordinates are degrees and
+# distances kilometres. The array versions take scalars, NumPy arrays or
+# pandas columns and broadcast them, the point_* versions take [lat, lon]
+# pairs and use math so they stay cheap inside search loops.
+
+def distance_km(lat1, lon1, lat2, lon2):
+    lat1 = np.radians(np.asarray(lat1, dtype=np.float64))
+    lat2 = np.radians(np.asarray(lat2, dtype=np.float64))
+    d_lat = lat2 - lat1
+    d_lon = np.radians(np.asarray(lon2, dtype=np.float64)) - \
+        np.radians(np.asarray(lon1, dtype=np.float64))
+
+    a = np.sin(d_lat / 2) * np.sin(d_lat / 2) + np.cos(lat1) * \
+        np.cos(lat2) * np.sin(d_lon / 2) * np.sin(d_lon / 2)
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return EARTH_RADIUS_KM * c
+
+
+# Initial bearing from point 1 to point 2, in [0, 360)
+def bearing_deg(lat1, lon1, lat2, lon2):
+    lat1 = np.radians(np.asarray(lat1, dtype=np.float64))
+    lat2 = np.radians(np.asarray(lat2, dtype=np.float64))
+    d_lon = np.radians(np.asarray(lon2, dtype=np.float64)) - \
+        np.radians(np.asarray(lon1, dtype=np.float64))
+
+    y = np.sin(d_lon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * \
+        np.cos(lat2) * np.cos(d_lon)
+
+    bearing = np.degrees(np.arctan2(y, x))
+    return np.where(bearing < 0, bearing + 360.0, bearing)[()]
+
+
+# Point reached when travelling distance_km from (lat, lon) along bearing
+def destination(lat, lon, bearing, distance_km):
+    lat1 = np.radians(np.asarray(lat, dtype=np.float64))
+    lon1 = np.radians(np.asarray(lon, dtype=np.float64))
+    bearing = np.radians(np.asarray(bearing, dtype=np.float64))
+    angle = np.asarray(distance_km, dtype=np.float64) / EARTH_RADIUS_KM
+
+    lat2 = np.arcsin(np.sin(lat1) * np.cos(angle) +
+                     np.cos(lat1) * np.sin(angle) * np.cos(bearing))
+    lon2 = lon1 + np.arctan2(np.sin(bearing) * np.sin(angle) * np.cos(lat1),
+                             np.cos(angle) - np.sin(lat1) * np.sin(lat2))
+    return np.degrees(lat2), np.degrees(lon2)
+
+
+# Move distance_km from point 1 towards point 2
+def interpolate(lat1, lon1, lat2, lon2, distance_km):
+    return destination(lat1, lon1, bearing_deg(lat1, lon1, lat2, lon2), distance_km)
+
+
+# Position after moving from point 1 towards point 2 for seconds at speed (m/s)
+def interpolate_to_time(lat1, lon1, lat2, lon2, speed, seconds):
+    distance = np.asarray(seconds, dtype=np.float64) * \
+        np.asarray(speed, dtype=np.float64) / 1000
+    return interpolate(lat1, lon1, lat2, lon2, distance)
+
+
+# Distances between consecutive points of a track, one shorter than the track
+def segment_distances_km(lat, lon):
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    return distance_km(lat[:-1], lon[:-1], lat[1:], lon[1:])
+
+
+def point_distance_km(coordinate1, coordinate2):
+    lat1 = math.radians(coordinate1[0])
+    lat2 = math.radians(coordinate2[0])
+    d_lat = lat2 - lat1
+    d_lon = math.radians(coordinate2[1]) - math.radians(coordinate1[1])
+
+    a = math.sin(d_lat / 2) * math.sin(d_lat / 2) + math.cos(lat1) * \
+        math.cos(lat2) * math.sin(d_lon / 2) * math.sin(d_lon / 2)
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return EARTH_RADIUS_KM * c
+
+
+def point_bearing_deg(coordinate1, coordinate2):
+    lat1 = math.radians(coordinate1[0])
+    lat2 = math.radians(coordinate2[0])
+    d_lon = math.radians(coordinate2[1]) - math.radians(coordinate1[1])
+
+    y = math.sin(d_lon) * math.cos(lat2)
+    x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * \
+        math.cos(lat2) * math.cos(d_lon)
+
+    bearing = math.degrees(math.atan2(y, x))
+    if bearing < 0:
+        bearing += 360.0
+    return bearing
+
+
+def point_destination(coordinate, bearing, distance_km):
+    lat1 = math.radians(coordinate[0])
+    lon1 = math.radians(coordinate[1])
+    bearing = math.radians(bearing)
+    angle = distance_km / EARTH_RADIUS_KM
+
+    lat2 = math.asin(math.sin(lat1) * math.cos(angle) +
+                     math.cos(lat1) * math.sin(angle) * math.cos(bearing))
+    lon2 = lon1 + math.atan2(math.sin(bearing) * math.sin(angle) * math.cos(lat1),
+                             math.cos(angle) - math.sin(lat1) * math.sin(lat2))
+    return [math.degrees(lat2), math.degrees(lon2)]
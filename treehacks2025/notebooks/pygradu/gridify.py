@@ -1,10 +1,17 @@
+import json
 import numpy as np
 import pandas as pd
+import shapely
 import shapely.geometry
+import shapely.prepared
 import pyproj
 from shapely.geometry import Point
+from shapely.ops import unary_union
 import datetime
 
+# Speed used when there are no observations for the node and vessel type
+DEFAULT_SPEED = 7
+
 
 class Grid:
 
@@ -14,6 +21,10 @@ class Grid:
         self.side_length = side_length
         self.p_from = p_from
         self.p_to = p_to
+        # Transformers and the cell centre table are created on first use
+        self.to_grid = None
+        self.to_lat_lon = None
+        self.centroids = None
         self.model_1km = [
             [-1, -0],
             [-10, -1],
@@ -77,6 +88,10 @@ class Grid:
     def get_node_index(self, row, col):
         return (row * len(self.rows)) + col
 
+    # Upper bound for node indices, used to size arrays indexed by node
+    def get_node_count(self):
+        return (len(self.rows) - 1) * len(self.rows) + len(self.cols)
+
     # Decode node index back to (row, col) pair
     def extract_coords(self, node):
         row = int((node / len(self.rows)))
@@ -84,17 +99,69 @@ class Grid:
 
         return [row, col]
 
+    # Transformers and the centroid table are left out of pickles and rebuilt on use
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['to_grid'] = None
+        state['to_lat_lon'] = None
+        state['centroids'] = None
+        return state
+
+    # Building a transformation is slow, so both directions are built once
+    def get_transformers(self):
+        if self.to_grid is None:
+            self.to_grid = pyproj.Transformer.from_proj(
+                self.p_from, self.p_to, always_xy=True)
+            self.to_lat_lon = pyproj.Transformer.from_proj(
+                self.p_to, self.p_from, always_xy=True)
+        return self.to_grid, self.to_lat_lon
+
+    # Same as pyproj.transform(p_to, p_from, x, y), for scalars or arrays
+    def get_lon_lat(self, x, y):
+        return self.get_transformers()[1].transform(x, y)
+
+    # Cell centre (lat, lon) arrays indexed by node id, NaN for ids outside the grid
+    def get_centroids(self):
+        if self.centroids is None:
+            nodes = np.arange(self.get_node_count())
+            rows = nodes // len(self.rows)
+            cols = nodes - (rows * len(self.rows))
+            inside = (rows < len(self.rows)) & (cols < len(self.cols))
+
+            lat = np.full(len(nodes), np.nan)
+            lon = np.full(len(nodes), np.nan)
+            lon[inside], lat[inside] = self.get_lon_lat(
+                self.cols[cols[inside]] + self.side_length/2, self.rows[rows[inside]] + self.side_length/2)
+            self.centroids = (lat, lon)
+        return self.centroids
+
     # Decode node index back to (lat, lon) pair
     def extract_coords_lat_lon(self, node):
+        lat, lon = self.get_centroids()
+        if 0 <= node < len(lat):
+            return [float(lat[int(node)]), float(lon[int(node)])]
+
         row = int((node / len(self.rows)))
         col = int(node - (row * len(self.rows)))
 
-        p = pyproj.transform(
-            self.p_to, self.p_from, self.cols[col] + self.side_length/2, self.rows[row] + self.side_length/2)
-        # p = pyproj.transform(self.p_to, self.p_from, self.cols[col-1] + self.side_length/2, self.rows[row-1] + self.side_length/2)
+        p = self.get_lon_lat(
+            self.cols[col] + self.side_length/2, self.rows[row] + self.side_length/2)
 
         return [p[1], p[0]]
 
+    # Cell centre (lat, lon) arrays for an array of nodes
+    def extract_coords_lat_lon_batch(self, nodes):
+        nodes = np.asarray(nodes, dtype=np.int64)
+        lat, lon = self.get_centroids()
+        if np.all((nodes >= 0) & (nodes < len(lat))):
+            return lat[nodes], lon[nodes]
+
+        rows = nodes // len(self.rows)
+        cols = nodes - (rows * len(self.rows))
+        lon, lat = self.get_lon_lat(
+            self.cols[cols] + self.side_length/2, self.rows[rows] + self.side_length/2)
+        return np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+
     def get_neighbours_adjacent(self, row, col):
         neighbours = []
         for i in range(-1, 2):
@@ -118,6 +185,17 @@ class Grid:
                         neighbours.append([row+x, col+y])
         return neighbours
 
+    # (row, col) offsets of the neighbours, in the order of get_neighbours_adjacent
+    # and get_neighbours_with_maneuvaribility
+    def get_neighbour_offsets(self, adjacent=False):
+        if adjacent:
+            offsets = [[i, j] for i in range(-1, 2)
+                       for j in range(-1, 2) if not (i == 0 and j == 0)]
+        else:
+            offsets = [[index[0] * i, index[1] * j] for i in [1, -1]
+                       for j in [1, -1] for index in self.neighbor_model]
+        return np.array(offsets, dtype=np.int64)
+
     def get_neighbours_nodes_with_maneuvaribility(self, row, col):
         neighbours = []
         # https://ieeexplore-ieee-org.libproxy.tuni.fi/mediastore_new/IEEE/content/media/6845395/6851348/6851512/6851512-fig-2-source-large.gif
@@ -131,15 +209,49 @@ class Grid:
                         neighbours.append(self.get_node_index(row+x, col+y))
         return neighbours
 
+    # Node index of row['grid_point'] (projected x, y), -1 outside the grid
     def get_grid_position(self, row):
-        return self.get_node_index(np.searchsorted(self.rows, row['grid_point'][1]) - 1, np.searchsorted(self.cols, row['grid_point'][0]) - 1)
-        # return {
-        #     'col': np.searchsorted(self.cols, row['grid_point'][0]),
-        #     'row': np.searchsorted(self.rows, row['grid_point'][1])
-        # }
+        return int(self.get_grid_positions_xy(row['grid_point'][0], row['grid_point'][1]))
 
     def get_grid_point(self, lat, lon):
-        return pyproj.transform(self.p_from, self.p_to, lon, lat)
+        return self.get_transformers()[0].transform(lon, lat)
+
+    # Projected (x, y) arrays for arrays of coordinates
+    def get_grid_points(self, lat, lon):
+        x, y = self.get_grid_point(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+        return np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+
+    # Cell (row, col) arrays of projected points. Cell i spans (rows[i], rows[i+1]],
+    # the same as np.searchsorted(rows, y) - 1 but without the binary search.
+    def get_cells(self, x, y):
+        return get_uniform_index(self.rows, y) - 1, get_uniform_index(self.cols, x) - 1
+
+    # Node indices for arrays of projected points, -1 outside the grid
+    def get_grid_positions_xy(self, x, y):
+        rows, cols = self.get_cells(x, y)
+        inside = (rows >= 0) & (rows < len(self.rows) - 1) & (cols >= 0) & (cols < len(self.cols) - 1)
+        return np.where(inside, self.get_node_index(rows, cols), -1)
+
+    # Node indices for arrays of coordinates, -1 outside the grid
+    def get_grid_positions(self, lat, lon):
+        x, y = self.get_grid_points(lat, lon)
+        return self.get_grid_positions_xy(x, y)
+
+
+# np.searchsorted(values, v) for evenly spaced values (np.linspace), the index
+# is calculated from the spacing and then fixed where rounding puts it off by one
+def get_uniform_index(values, v):
+    v = np.asarray(v, dtype=np.float64)
+    n = len(values)
+    if n < 2:
+        return np.searchsorted(values, v)
+    step = (values[-1] - values[0]) / (n - 1)
+    with np.errstate(invalid='ignore'):
+        index = np.ceil((v - values[0]) / step)
+    index = np.clip(np.nan_to_num(index, nan=n), 0, n).astype(np.int64)
+    index = np.where((index > 0) & (values[np.maximum(index - 1, 0)] >= v), index - 1, index)
+    index = np.where((index < n) & (values[np.minimum(index, n - 1)] < v), index + 1, index)
+    return index
 
 
 class Graph:
@@ -161,9 +273,10 @@ def area_to_grid(north_east=shapely.geometry.Point(31.5, 66.8), south_west=shape
 
     # Project corners to projection that is metric
     # Transform NW point to 3067
-    ne = pyproj.transform(p_from, p_to, north_east.x, north_east.y)
-    sw = pyproj.transform(p_from, p_to, south_west.x,
-                          south_west.y)  # .. same for SE
+    to_grid = pyproj.Transformer.from_proj(p_from, p_to, always_xy=True)
+    ne = to_grid.transform(north_east.x, north_east.y)
+    sw = to_grid.transform(south_west.x,
+                           south_west.y)  # .. same for SE
 
     print('Transformed NE:', ne)
     print('Transformed SW:', sw)
@@ -202,8 +315,72 @@ def get_avg_speeds_wo_graph(ais):
     return nodes
 
 
-def get_avg_speeds(ais):
+class SpeedTable:
+
+    def __init__(self, speeds, type_codes):
+        """
+        Average speeds as a dense (node, vessel type code) array.
+        The last column is for vessel types without observations and holds
+        DEFAULT_SPEED, like every node and type pair without observations.
+        """
+        self.speeds = speeds
+        self.type_codes = type_codes
+
+    def get_type_code(self, vessel_type):
+        return self.type_codes.get(vessel_type, len(self.type_codes))
+
+    def get_speed(self, node, vessel_type):
+        if node < 0 or node >= len(self.speeds):
+            return DEFAULT_SPEED
+        # Dict graphs built from DataFrames have float node ids
+        return float(self.speeds[int(node), self.get_type_code(vessel_type)])
+
+    # Speeds of many nodes for one vessel type
+    def get_speeds(self, nodes, vessel_type):
+        nodes = np.asarray(nodes, dtype=np.int64)
+        speeds = np.full(len(nodes), DEFAULT_SPEED, dtype=np.float64)
+        valid = (nodes >= 0) & (nodes < len(self.speeds))
+        speeds[valid] = self.speeds[nodes[valid],
+                                    self.get_type_code(vessel_type)]
+        return speeds
+
+
+def create_speed_table(nodes, vessel_types, speeds, node_count, dtype=np.float32):
+    nodes = np.asarray(nodes, dtype=np.int64)
+    speeds = np.asarray(speeds, dtype=np.float64)
+    types = sorted(set(vessel_types), key=str)
+    type_codes = {vessel_type: i for i, vessel_type in enumerate(types)}
+
+    table = np.full((node_count, len(types) + 1), DEFAULT_SPEED, dtype=dtype)
+    codes = np.array([type_codes[vessel_type] for vessel_type in vessel_types], dtype=np.int64)
+    valid = (nodes >= 0) & (nodes < node_count) & ~np.isnan(speeds)
+    table[nodes[valid], codes[valid]] = speeds[valid]
+    return SpeedTable(table, type_codes)
+
+
+# avg_speeds as returned by get_avg_speeds, {node: {vessel_type: speed}} or a DataFrame with nodes as columns
+def avg_speeds_to_table(avg_speeds, node_count, dtype=np.float32):
+    if isinstance(avg_speeds, pd.DataFrame):
+        avg_speeds = avg_speeds.to_dict()
+    nodes = []
+    vessel_types = []
+    speeds = []
+    for node, node_speeds in avg_speeds.items():
+        for vessel_type, speed in node_speeds.items():
+            nodes.append(node)
+            vessel_types.append(vessel_type)
+            speeds.append(speed)
+    return create_speed_table(nodes, vessel_types, speeds, node_count, dtype)
+
+
+# With node_count the speeds are returned as a SpeedTable with node_count rows
+def get_avg_speeds(ais, node_count=None):
     ais = ais[['vessel_type', 'node', 'speed']]
+    if node_count is not None:
+        means = ais.groupby(['node', 'vessel_type']).speed.mean()
+        return create_speed_table(means.index.get_level_values('node'), list(means.index.get_level_values('vessel_type')),
+                                  means.values, node_count)
+
     groups = ais.groupby('node')
 
     avg_speeds = {}
@@ -222,53 +399,155 @@ def get_avg_speeds(ais):
 
 # Connect all the neighbour nodes in grid
 def create_area_graph(grid, adjacent=False):
-    graph = []
-    for row in range(len(grid.rows) - 1):
-        for col in range(len(grid.cols) - 1):
-
-            node = grid.get_node_index(row, col)
-            if adjacent:
-                neighbours = grid.get_neighbours_adjacent(row, col)
-            else:
-                neighbours = grid.get_neighbours_with_maneuvaribility(row, col)
-            for n in neighbours:
-                connected = grid.get_node_index(n[0], n[1])
-                graph.append([node, connected])
-
-    return graph
-
-
-# Connect all the neighbour nodes in grid
-def create_sea_graph(grid, adjacent=False, exclude_geom=None):
-    graph = []
-    for row in range(len(grid.rows) - 1):
-        for col in range(len(grid.cols) - 1):
-            # Create point from col and row
-
-            sw = shapely.geometry.Point(pyproj.transform(
-                grid.p_to, grid.p_from, grid.cols[col], grid.rows[row]))
-            se = shapely.geometry.Point(pyproj.transform(
-                grid.p_to, grid.p_from, grid.cols[col] + grid.side_length, grid.rows[row]))
-            nw = shapely.geometry.Point(pyproj.transform(
-                grid.p_to, grid.p_from, grid.cols[col], grid.rows[row] + grid.side_length))
-            ne = shapely.geometry.Point(pyproj.transform(
-                grid.p_to, grid.p_from, grid.cols[col] + grid.side_length, grid.rows[row] + grid.side_length))
-            pointlist = list([sw, se, ne, nw])
-
-            cell = shapely.geometry.Polygon([[p.x, p.y] for p in pointlist])
-
-            if exclude_geom is not None and exclude_geom.contains(cell):
-                continue
-            node = grid.get_node_index(row, col)
-            if adjacent:
-                neighbours = grid.get_neighbours_adjacent(row, col)
-            else:
-                neighbours = grid.get_neighbours_with_maneuvaribility(row, col)
-            for n in neighbours:
-                connected = grid.get_node_index(n[0], n[1])
-                graph.append([node, connected])
-
-    return graph
+    return create_grid_edges(grid, adjacent)
+
+
+# Connect all the neighbour nodes in grid, except from cells inside exclude_geom.
+# The land test can be done once with get_sea_cells and passed as sea_mask.
+def create_sea_graph(grid, adjacent=False, exclude_geom=None, sea_mask=None):
+    if sea_mask is None and exclude_geom is not None:
+        sea_mask = get_sea_cells(grid, exclude_geom)
+    return create_grid_edges(grid, adjacent, sea_mask)
+
+
+# Union of the geometries in a GeoJSON file, e.g. land areas from data/shapes
+def load_geometry(path):
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('type') == 'FeatureCollection':
+        return unary_union([shapely.geometry.shape(feature['geometry']) for feature in data['features']])
+    if data.get('type') == 'Feature':
+        return shapely.geometry.shape(data['geometry'])
+    return shapely.geometry.shape(data)
+
+
+# Cells whose polygon (corners projected to lat/lon) is not inside exclude_geom,
+# as a (rows - 1, cols - 1) boolean array. Cells away from the boundary of
+# exclude_geom are wholly inside or outside it, so their centre decides. Only
+# the cells near the boundary are tested as polygons.
+def get_sea_cells(grid, exclude_geom):
+    side = grid.side_length
+    x, y = np.meshgrid(grid.cols[:-1] + side/2, grid.rows[:-1] + side/2)
+    lon, lat = grid.get_lon_lat(x, y)
+    prepared = shapely.prepared.prep(exclude_geom)
+    sea = ~contains_points(exclude_geom, prepared, lon, lat)
+
+    rows, cols = np.nonzero(get_boundary_cells(grid, exclude_geom))
+    sea[rows, cols] = ~cells_inside(grid, prepared, rows, cols)
+    return sea
+
+
+def contains_points(geom, prepared, lon, lat):
+    # shapely 2 tests all points at once
+    if hasattr(shapely, 'contains_xy'):
+        return np.asarray(shapely.contains_xy(geom, lon, lat), dtype=bool)
+    inside = [prepared.contains(Point(x, y))
+              for x, y in zip(np.ravel(lon), np.ravel(lat))]
+    return np.array(inside, dtype=bool).reshape(np.shape(lon))
+
+
+# Tests the polygons of the cells at rows and cols like create_sea_graph did
+def cells_inside(grid, prepared, rows, cols):
+    x = grid.cols[cols]
+    y = grid.rows[rows]
+    side = grid.side_length
+    # Corners in sw, se, ne, nw order
+    lon, lat = grid.get_lon_lat(np.stack([x, x + side, x + side, x], axis=-1),
+                                np.stack([y, y, y + side, y + side], axis=-1))
+    inside = [prepared.contains(shapely.geometry.Polygon(np.column_stack((lon[i], lat[i]))))
+              for i in range(len(rows))]
+    return np.array(inside, dtype=bool)
+
+
+def get_boundary_lines(geom):
+    if geom.is_empty:
+        return []
+    if hasattr(geom, 'geoms'):
+        return [line for part in geom.geoms for line in get_boundary_lines(part)]
+    if geom.geom_type == 'Polygon':
+        return [geom.exterior] + list(geom.interiors)
+    if geom.geom_type in ('LineString', 'LinearRing'):
+        return [geom]
+    return []
+
+
+# Cells that the boundary of geom passes through, and their neighbours, as a
+# (rows - 1, cols - 1) boolean array. The boundary is sampled at a quarter of
+# the cell side, the neighbours cover the cells between the samples.
+def get_boundary_cells(grid, geom):
+    row_count = len(grid.rows) - 1
+    col_count = len(grid.cols) - 1
+    step = grid.side_length / 111000 / 4
+
+    points = [np.zeros((0, 2))]
+    for line in get_boundary_lines(geom):
+        coords = np.asarray(line.coords, dtype=np.float64)[:, :2]
+        if len(coords) < 2:
+            continue
+        lengths = np.hypot(*(coords[1:] - coords[:-1]).T)
+        counts = np.maximum(1, np.ceil(lengths / step)).astype(np.int64)
+        segments = np.repeat(np.arange(len(lengths)), counts)
+        fractions = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) / \
+            np.repeat(counts, counts)
+        points.append(coords[segments] + (coords[segments + 1] - coords[segments]) * fractions[:, None])
+        points.append(coords[-1:])
+    points = np.concatenate(points)
+
+    # Padded by one cell so that samples just outside the grid mark the edge cells
+    x, y = grid.get_grid_points(points[:, 1], points[:, 0])
+    rows, cols = grid.get_cells(x, y)
+    inside = (rows >= -1) & (rows <= row_count) & (cols >= -1) & (cols <= col_count)
+    marked = np.zeros((row_count + 2, col_count + 2), dtype=bool)
+    marked[rows[inside] + 1, cols[inside] + 1] = True
+
+    near = np.zeros((row_count, col_count), dtype=bool)
+    for i in range(3):
+        for j in range(3):
+            near |= marked[i:i + row_count, j:j + col_count]
+    return near
+
+
+# Node indexed version of a cell mask from get_sea_cells, e.g.
+# NodeLayer(get_node_mask(grid, ~sea_mask)) is the land layer for the router
+def get_node_mask(grid, cell_mask):
+    mask = np.zeros(grid.get_node_count(), dtype=bool)
+    rows, cols = np.nonzero(cell_mask)
+    mask[grid.get_node_index(rows, cols)] = True
+    return mask
+
+
+# Edges from the cells (all cells or the True ones of a (rows - 1, cols - 1)
+# mask) to their neighbours as an (original, connected) array, in the same
+# order and with the same duplicates as looping over the cells row by row.
+# Rows are handled in blocks of about block_size (cell, neighbour) pairs.
+def create_grid_edges(grid, adjacent=False, cells=None, block_size=2**22):
+    offsets = grid.get_neighbour_offsets(adjacent)
+    row_count = len(grid.rows) - 1
+    col_count = len(grid.cols) - 1
+    dtype = np.int32 if grid.get_node_count() <= np.iinfo(np.int32).max else np.int64
+    block_rows = max(1, block_size // max(1, col_count * len(offsets)))
+
+    edges = [np.zeros((0, 2), dtype=dtype)]
+    for start in range(0, row_count, block_rows):
+        rows, cols = np.meshgrid(np.arange(start, min(start + block_rows, row_count)),
+                                 np.arange(col_count), indexing='ij')
+        rows = rows.ravel()
+        cols = cols.ravel()
+        if cells is not None:
+            keep = cells[start:start + block_rows].ravel()
+            rows = rows[keep]
+            cols = cols[keep]
+
+        next_rows = rows[:, None] + offsets[:, 0]
+        next_cols = cols[:, None] + offsets[:, 1]
+        inside = (next_cols >= 0) & (next_rows >= 0) & (
+            next_cols < col_count) & (next_rows < row_count)
+        original = np.broadcast_to(grid.get_node_index(
+            rows, cols)[:, None], inside.shape)[inside]
+        connected = grid.get_node_index(next_rows, next_cols)[inside]
+        edges.append(np.column_stack((original, connected)).astype(dtype))
+
+    return np.concatenate(edges)
 
 
 def get_port_lat(ports, row):
@@ -294,58 +573,115 @@ def get_port_area(port_areas, row):
     return None
 
 
-def create_graph_from_ais_adjacent(ais):
+# Node changes [previous node, node] of the vessels in one chunk of AIS data as an
+# int32 array (E, 2). last_nodes (mmsi -> node) carries the last node of every
+# vessel over to the next chunk and is updated in place.
+def get_ais_transitions(ais, last_nodes=None):
     ais = ais.reset_index(drop=True)
     ais = ais.sort_values(by=['mmsi', 'timestamp'])
 
-    observations_by_vessels = ais.groupby('mmsi')
-    graph = []
-
-    for mmsi, observations in observations_by_vessels:
-        prev_node = observations.head(1).iloc[0].node
-        for i, obs in observations.iterrows():
-            if prev_node == obs.node:
-                continue
+    mmsi = ais.mmsi.values
+    nodes = ais.node.values.astype(np.int64)
+    if len(nodes) == 0:
+        return np.empty((0, 2), dtype=np.int32)
 
-            node_row = [prev_node, obs.node]
-            graph.append(node_row)
+    first = np.ones(len(nodes), dtype=bool)
+    first[1:] = mmsi[1:] != mmsi[:-1]
+    prev_nodes = np.empty_like(nodes)
+    prev_nodes[1:] = nodes[:-1]
+    prev_nodes[first] = nodes[first]
 
-            prev_node = obs.node
+    if last_nodes is not None:
+        prev_nodes[first] = [last_nodes.get(vessel, node) for vessel, node in
+                             zip(mmsi[first].tolist(), nodes[first].tolist())]
+        last = np.append(first[1:], True)
+        last_nodes.update(zip(mmsi[last].tolist(), nodes[last].tolist()))
 
-    return graph
+    changed = prev_nodes != nodes
+    return np.column_stack([prev_nodes[changed], nodes[changed]]).astype(np.int32)
 
 
-def create_graph_from_ais_maneuvaribility(grid, ais, minutes_forward=45):
+# ais is a DataFrame or an iterable of DataFrame chunks in time order, e.g.
+# pd.read_csv(path, chunksize=10**6, parse_dates=['timestamp']), so the whole
+# archive does not have to be in memory. Vessels are followed from chunk to chunk.
+def create_graph_from_ais_adjacent(ais):
+    if isinstance(ais, pd.DataFrame):
+        return get_ais_transitions(ais)
+
+    last_nodes = dict()
+    graph = [get_ais_transitions(chunk, last_nodes) for chunk in ais]
+    if not graph:
+        return np.empty((0, 2), dtype=np.int32)
+    return np.concatenate(graph)
+
+
+# For every node change of a vessel, the neighbours (neighbor_model) of the node
+# that the vessel visits within minutes_forward are connected to the node.
+# Consecutive rows with the same node are handled as one run, so a time window
+# only covers the few runs of the next minutes_forward. Runs are handled in blocks
+# of about block_size (run, neighbour) pairs. Returns an int32 (E, 2) array.
+def create_graph_from_ais_maneuvaribility(grid, ais, minutes_forward=45, block_size=2**20):
     ais = ais.reset_index(drop=True)
     ais = ais.sort_values(by=['mmsi', 'timestamp'])
 
-    observations_by_vessels = ais.groupby('mmsi')
-
+    mmsi = ais.mmsi.values
+    nodes = ais.node.values.astype(np.int64)
+    times = ais.timestamp.values.astype('datetime64[ns]').astype(np.int64)
+    if len(nodes) == 0:
+        return np.empty((0, 2), dtype=np.int32)
+
+    new_vessel = np.ones(len(nodes), dtype=bool)
+    new_vessel[1:] = mmsi[1:] != mmsi[:-1]
+    run_starts = new_vessel.copy()
+    run_starts[1:] |= nodes[1:] != nodes[:-1]
+    run_ids = np.cumsum(run_starts) - 1
+    run_rows = np.flatnonzero(run_starts)
+    run_nodes = nodes[run_rows]
+
+    # First and last run in [time, time + minutes_forward] of every run, the
+    # window starts from the first row with the same time
+    window = pd.Timedelta(minutes=minutes_forward).value
+    first_runs = np.empty(len(run_rows), dtype=np.int64)
+    last_runs = np.empty(len(run_rows), dtype=np.int64)
+    vessel_starts = np.flatnonzero(new_vessel)
+    vessel_ends = np.append(vessel_starts[1:], len(nodes))
+    for start, end in zip(vessel_starts, vessel_ends):
+        runs = slice(run_ids[start], run_ids[end - 1] + 1)
+        vessel_times = times[start:end]
+        run_times = times[run_rows[runs]]
+        first_runs[runs] = run_ids[start +
+                                   np.searchsorted(vessel_times, run_times, side='left')]
+        last_runs[runs] = run_ids[start - 1 +
+                                  np.searchsorted(vessel_times, run_times + window, side='right')]
+
+    offsets = grid.get_neighbour_offsets()
+    # Keys combine a run and a node, -1 (outside the grid) included
+    key_size = max(int(run_nodes.max()), grid.get_node_count()) + 2
+    block_runs = max(1, block_size // len(offsets))
     graph = []
-
-    for mmsi, observations in observations_by_vessels:
-        observations = observations.set_index('timestamp')
-        node = None
-        for i, obs in observations.iterrows():
-            if node == obs.node:
-                continue
-
-            node = obs.node
-            coords = grid.extract_coords(node)
-
-            neighbors = grid.get_neighbours_nodes_with_maneuvaribility(
-                coords[0], coords[1])
-            obs_time = pd.to_datetime(obs.name)
-            time_window = observations.loc[obs.name: (pd.Timestamp(
-                obs_time + datetime.timedelta(minutes=minutes_forward)))]
-            future_nodes = time_window.node.unique()
-            future_nodes_set = set(future_nodes)
-
-            for neighbor in neighbors:
-                if neighbor in future_nodes_set:
-                    graph.append([node, neighbor])
-
-    return graph
+    for block_start in range(0, len(run_rows), block_runs):
+        block = slice(block_start, block_start + block_runs)
+        node = run_nodes[block]
+        row = np.trunc(node / len(grid.rows)).astype(np.int64)
+        col = node - row * len(grid.rows)
+        neighbour_rows = row[:, None] + offsets[:, 0]
+        neighbour_cols = col[:, None] + offsets[:, 1]
+        valid = (neighbour_cols >= 0) & (neighbour_rows >= 0) & \
+            (neighbour_cols < len(grid.cols) - 1) & (neighbour_rows < len(grid.rows) - 1)
+        neighbours = grid.get_node_index(neighbour_rows, neighbour_cols)
+
+        counts = last_runs[block] - first_runs[block] + 1
+        local = np.repeat(np.arange(len(node)), counts)
+        window_runs = np.repeat(first_runs[block], counts) + \
+            np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        window_keys = local * key_size + run_nodes[window_runs] + 1
+        keys = np.arange(len(node))[:, None] * key_size + neighbours + 1
+
+        found = valid & np.isin(keys, window_keys)
+        graph.append(np.column_stack(
+            [np.broadcast_to(node[:, None], found.shape)[found], neighbours[found]]))
+
+    return np.concatenate(graph).astype(np.int32)
 
 
 # Function for calculating weights for the graph. Could be improved a lot.
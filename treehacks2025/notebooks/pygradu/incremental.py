@@ -0,0 +1,156 @@
+import heapq
+import numpy as np
+from .shortest_path import as_node_mask, get_node, get_path_speeds, retrace_path
+
+
+class IncrementalPlanner():
+    def __init__(self, graph, grid, end_latlon, dirways_graph=None, shallow_graph=None):
+        """
+        D* Lite planner towards one destination for a vessel that moves along
+        its route. The search runs backwards from the destination, so g[n] is
+        the cost from n to the destination and a new start position only
+        continues the previous search instead of starting over. When edge costs
+        change (new graph version or other active dirways) only the nodes
+        whose costs changed are repaired.
+        The heuristic is zero, so the key modifier of D* Lite is not needed.
+        Turn penalties depend on the vessel course so they are not supported.
+        """
+        if graph.use_turn_penalty:
+            raise ValueError(
+                'IncrementalPlanner does not support turn penalties, set graph.use_turn_penalty=False')
+        self.graph = graph
+        self.grid = grid
+        self.end_latlon = end_latlon
+        self.goal = get_node(grid, end_latlon[0], end_latlon[1])
+        self.node_count = graph.node_count
+
+        self.shallow_mask = None
+        if graph.use_shallow_penalty:
+            shallow_mask = as_node_mask(shallow_graph, graph.node_count)
+            if shallow_mask is not None:
+                self.shallow_mask = shallow_mask[:graph.node_count]
+        self.dirway_mask = self.get_dirway_mask(dirways_graph)
+        self.costs = graph.get_all_costs(self.dirway_mask, self.shallow_mask)
+        self.graph_version = graph.version
+
+        # Sources of the incoming edges of every node, in CSR layout
+        sources = np.repeat(np.arange(graph.node_count, dtype=np.int32), np.diff(graph.indptr))
+        self.in_sources = sources[np.argsort(graph.indices, kind='stable')]
+        self.in_indptr = np.zeros(graph.node_count + 1, dtype=np.int64)
+        self.in_indptr[1:] = np.cumsum(np.bincount(
+            graph.indices, minlength=graph.node_count))
+
+        self.g = np.full(graph.node_count, np.inf)
+        self.rhs = np.full(graph.node_count, np.inf)
+        self.open_keys = np.full(graph.node_count, np.inf)
+        self.open_heap = []
+        self.counter = 0
+        self.expansions = 0
+
+        if 0 <= self.goal < graph.node_count:
+            self.rhs[self.goal] = 0.0
+            self.push(self.goal, 0.0)
+
+    def get_dirway_mask(self, dirways_graph):
+        if not self.graph.use_dirways:
+            return None
+        dirway_mask = as_node_mask(dirways_graph, self.graph.node_count)
+        if dirway_mask is not None:
+            dirway_mask = dirway_mask[:self.graph.node_count]
+        return dirway_mask
+
+    def push(self, node, key):
+        self.open_keys[node] = key
+        self.counter += 1
+        heapq.heappush(self.open_heap, (key, self.counter, node))
+
+    def get_rhs(self, node):
+        start, end = self.graph.indptr[node], self.graph.indptr[node + 1]
+        if start == end:
+            return np.inf
+        return float(np.min(self.costs[start:end] + self.g[self.graph.indices[start:end]]))
+
+    def update_vertex(self, node):
+        if node != self.goal:
+            self.rhs[node] = self.get_rhs(node)
+        if self.g[node] != self.rhs[node]:
+            self.push(node, min(self.g[node], self.rhs[node]))
+        else:
+            self.open_keys[node] = np.inf
+
+    def update_predecessors(self, node):
+        for i in range(self.in_indptr[node], self.in_indptr[node + 1]):
+            self.update_vertex(int(self.in_sources[i]))
+
+    def compute_shortest_path(self, start):
+        while self.open_heap:
+            key, _, node = self.open_heap[0]
+            if self.open_keys[node] != key:
+                heapq.heappop(self.open_heap)
+                continue
+            if key >= min(self.g[start], self.rhs[start]) and self.g[start] == self.rhs[start]:
+                break
+
+            heapq.heappop(self.open_heap)
+            self.open_keys[node] = np.inf
+            self.expansions += 1
+            if self.g[node] > self.rhs[node]:
+                self.g[node] = self.rhs[node]
+                self.update_predecessors(node)
+            else:
+                self.g[node] = np.inf
+                self.update_vertex(node)
+                self.update_predecessors(node)
+
+    # Repair the nodes whose outgoing edge costs changed
+    def set_costs(self, costs):
+        changed = np.flatnonzero(costs != self.costs)
+        self.costs = costs
+        sources = np.searchsorted(self.graph.indptr, changed, side='right') - 1
+        for node in np.unique(sources).tolist():
+            self.update_vertex(node)
+        return len(changed)
+
+    def update_dirways(self, dirways_graph):
+        self.dirway_mask = self.get_dirway_mask(dirways_graph)
+        return self.set_costs(self.graph.get_all_costs(self.dirway_mask, self.shallow_mask))
+
+    def get_path(self, start):
+        if not np.isfinite(self.g[start]):
+            return None
+        path = [start]
+        visited = {start}
+        node = start
+        while node != self.goal:
+            start_i, end_i = self.graph.indptr[node], self.graph.indptr[node + 1]
+            next_nodes = self.graph.indices[start_i:end_i]
+            totals = self.costs[start_i:end_i] + self.g[next_nodes]
+            # Zero cost edges can tie in both directions, never go back
+            totals[[n in visited for n in next_nodes.tolist()]] = np.inf
+            i = int(np.argmin(totals))
+            if not np.isfinite(totals[i]):
+                return None
+            node = int(next_nodes[i])
+            path.append(node)
+            visited.add(node)
+        return path
+
+    # Route from the current position of the vessel in the format of retrace_route
+    def plan(self, start_latlon, avg_speeds, speed, vessel_type, mmsi, voyage, start_time):
+        if self.graph.version != self.graph_version:
+            self.graph_version = self.graph.version
+            self.set_costs(self.graph.get_all_costs(
+                self.dirway_mask, self.shallow_mask))
+
+        start_pos = get_node(self.grid, start_latlon[0], start_latlon[1])
+        path = None
+        if 0 <= start_pos < self.node_count and 0 <= self.goal < self.node_count:
+            self.compute_shortest_path(start_pos)
+            path = self.get_path(start_pos)
+        if path is None:
+            print('Path does not exist!')
+            print('Voyage=', str(voyage))
+            return None
+
+        speeds = get_path_speeds(avg_speeds, vessel_type, speed, path)
+        return retrace_path(self.grid, path, speeds, start_latlon, self.end_latlon, mmsi, voyage, start_time)
@@ -0,0 +1,91 @@
+import json
+import time
+import pandas as pd
+
+COUNTERS = ['expanded', 'edges_relaxed', 'heap_pushes', 'decrease_keys']
+TIMERS = ['speed_seconds', 'cost_seconds', 'projection_seconds', 'total_seconds']
+
+
+class QueryStats():
+    def __init__(self, voyage=None, engine=None):
+        """
+        Counters and timers of one route query, filled in by a_star_heap when
+        it is given a QueryStats. edges_relaxed is the sum of the out-degrees
+        of the expanded nodes, edges to closed nodes and edges that do not
+        improve a g included. decrease_keys counts the pushes of nodes that were
+        already on the heap with a worse g, closed nodes are never reopened.
+        The timers measure speed propagation, edge cost evaluation (costs,
+        dirways, shallow water and turn penalties) and projections between
+        lat/lon and the grid.
+        """
+        self.voyage = voyage
+        self.engine = engine
+        self.found = False
+        self.expanded = 0
+        self.edges_relaxed = 0
+        self.heap_pushes = 0
+        self.decrease_keys = 0
+        self.speed_seconds = 0.0
+        self.cost_seconds = 0.0
+        self.projection_seconds = 0.0
+        self.total_seconds = 0.0
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def finish(self, found):
+        self.found = found
+        if self.started is not None:
+            self.total_seconds = time.perf_counter() - self.started
+
+    def to_record(self):
+        record = {'voyage': self.voyage, 'engine': self.engine, 'found': self.found}
+        for name in COUNTERS + TIMERS:
+            record[name] = getattr(self, name)
+        return record
+
+
+class BatchStats():
+    def __init__(self, engine='a_star_heap'):
+        """
+        QueryStats of every query in a batch, e.g. one predict_routes call.
+        Records are plain dicts (one per query) so they can be written as
+        JSON lines or turned into a DataFrame for dashboards.
+        """
+        self.engine = engine
+        self.queries = []
+
+    def new_query(self, voyage=None):
+        stats = QueryStats(voyage, self.engine)
+        self.queries.append(stats)
+        return stats
+
+    def extend(self, queries):
+        self.queries.extend(queries)
+
+    def get_records(self):
+        return [stats.to_record() for stats in self.queries]
+
+    def to_dataframe(self):
+        return pd.DataFrame(data=self.get_records(), columns=['voyage', 'engine', 'found'] + COUNTERS + TIMERS)
+
+    def get_summary(self):
+        summary = {'engine': self.engine, 'queries': len(self.queries),
+                   'found': sum(stats.found for stats in self.queries)}
+        for name in COUNTERS + TIMERS:
+            summary[name] = sum(getattr(stats, name) for stats in self.queries)
+        seconds = summary['total_seconds']
+        summary['expansions_per_second'] = summary['expanded'] / seconds if seconds > 0 else None
+        summary['mean_query_seconds'] = seconds / len(self.queries) if self.queries else None
+        return summary
+
+    def print_summary(self):
+        for name, value in self.get_summary().items():
+            print(name + '=', value)
+
+    # One JSON record per line, the batch summary is not written
+    def save(self, path):
+        with open(path, 'w') as f:
+            for record in self.get_records():
+                f.write(json.dumps(record, default=str) + '\n')
@@ -0,0 +1,119 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from .shortest_path import DIRWAY_COST
+
+
+class LandmarkTables():
+    def __init__(self, landmarks, from_landmarks, to_landmarks, use_dirways, signature):
+        """
+        Exact costs between landmark nodes and every node of the graph.
+        from_landmarks[n, i] is the cost from landmarks[i] to n and
+        to_landmarks[n, i] the cost from n to landmarks[i]. Costs are kept
+        as float64 so the bounds are not rounded up.
+        signature is graph.get_signature() of the graph the tables were built
+        for, tables of an older version of the costs are rejected.
+        """
+        self.landmarks = landmarks
+        self.from_landmarks = from_landmarks
+        self.to_landmarks = to_landmarks
+        self.use_dirways = use_dirways
+        self.signature = tuple(signature)
+
+    def check_graph(self, graph):
+        if graph.get_signature() != self.signature:
+            raise ValueError(
+                'Landmark tables were built for another graph or before its costs changed, rebuild them')
+        if graph.use_dirways and not self.use_dirways:
+            raise ValueError(
+                'Landmark tables were built without dirways, rebuild them with graph.use_dirways=True')
+
+    # Triangle inequality lower bounds for the costs from nodes to target,
+    # heuristic takes an array of nodes and returns an array of bounds
+    def get_heuristic(self, target):
+        node_count = len(self.from_landmarks)
+        if target < 0 or target >= node_count:
+            return lambda nodes: np.zeros(len(nodes))
+
+        from_target = self.from_landmarks[target]
+        to_target = self.to_landmarks[target]
+
+        # An infinite bound means the target can not be reached from a node,
+        # inf - inf is NaN and fmax leaves it out
+        def heuristic(nodes):
+            nodes = np.asarray(nodes, dtype=np.int64)
+            inside = nodes < node_count
+            rows = np.where(inside, nodes, 0)
+            with np.errstate(invalid='ignore'):
+                bounds = np.fmax(np.fmax.reduce(from_target - self.from_landmarks[rows], axis=1, initial=0.0),
+                                 np.fmax.reduce(self.to_landmarks[rows] - to_target, axis=1, initial=0.0))
+            return np.where(inside, bounds, 0.0)
+
+        return heuristic
+
+    def save(self, path):
+        node_count, edge_count, digest = self.signature
+        np.savez(path, landmarks=self.landmarks, from_landmarks=self.from_landmarks,
+                 to_landmarks=self.to_landmarks, use_dirways=self.use_dirways,
+                 node_count=node_count, edge_count=edge_count, digest=digest)
+
+
+def load_landmarks(path):
+    tables = np.load(path)
+    signature = (int(tables['node_count']), int(tables['edge_count']), str(tables['digest']))
+    return LandmarkTables(tables['landmarks'], tables['from_landmarks'], tables['to_landmarks'],
+                          bool(tables['use_dirways']), signature)
+
+
+# Dirway edges cost DIRWAY_COST whatever the traffic cost is, so with dirways
+# on the lower bound graph uses the smaller of the two. Penalties only add cost.
+def get_lower_bound_matrix(graph):
+    costs = graph.costs
+    if graph.use_dirways:
+        costs = np.minimum(costs, DIRWAY_COST)
+    return csr_matrix((costs, graph.indices, graph.indptr), shape=(graph.node_count, graph.node_count))
+
+
+def select_landmarks(graph, grid=None, ports=None, count=8):
+    matrix = get_lower_bound_matrix(graph)
+
+    # Ports are preferred landmarks, otherwise any node with edges
+    candidates = np.flatnonzero(np.diff(graph.indptr))
+    if len(candidates) == 0:
+        raise ValueError('Graph has no edges, landmarks can not be selected')
+    if ports is not None:
+        port_nodes = grid.get_grid_positions(ports.lat.values, ports.lon.values)
+        port_candidates = np.intersect1d(candidates, port_nodes)
+        if len(port_candidates) > 0:
+            candidates = port_candidates
+        else:
+            print('No port is on a node with edges, selecting landmarks from all nodes')
+
+    if len(candidates) <= count:
+        return candidates
+
+    # Farthest first: every new landmark is the candidate farthest
+    # from the landmarks picked so far
+    distances = dijkstra(matrix, indices=candidates[0])[candidates]
+    landmarks = []
+    while len(landmarks) < count:
+        reachable = np.where(np.isfinite(distances), distances, -1)
+        if landmarks and reachable.max() <= 0:
+            break
+        landmark = candidates[np.argmax(reachable)]
+        landmarks.append(landmark)
+        distances = np.minimum(distances, dijkstra(
+            matrix, indices=landmark)[candidates])
+
+    return np.array(landmarks, dtype=np.int64)
+
+
+def build_landmark_tables(graph, landmarks):
+    matrix = get_lower_bound_matrix(graph)
+    landmarks = np.asarray(landmarks, dtype=np.int64)
+
+    from_landmarks = dijkstra(matrix, indices=landmarks).T.astype(np.float64)
+    to_landmarks = dijkstra(matrix.T.tocsr(), indices=landmarks).T.astype(np.float64)
+
+    return LandmarkTables(landmarks, np.ascontiguousarray(from_landmarks), np.ascontiguousarray(to_landmarks),
+                          graph.use_dirways, graph.get_signature())
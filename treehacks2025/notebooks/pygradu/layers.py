@@ -0,0 +1,118 @@
+import hashlib
+import numpy as np
+
+
+class NodeLayer():
+    def __init__(self, mask):
+        """
+        Set of grid nodes (dirways, shallow water, closed areas...) stored as
+        a boolean array over node ids. Membership is an array lookup instead
+        of a hash lookup and layers combine with |, &, - and ~ like sets.
+        Layers are pickled and saved as packed bits, 1 bit per node.
+        """
+        self.mask = np.asarray(mask, dtype=bool)
+        self.key = None
+
+    def __contains__(self, node):
+        return 0 <= node < len(self.mask) and bool(self.mask[node])
+
+    def __len__(self):
+        return int(np.count_nonzero(self.mask))
+
+    def __iter__(self):
+        return iter(self.get_nodes().tolist())
+
+    def check_size(self, other):
+        if len(other.mask) != len(self.mask):
+            raise ValueError('Layers have different node counts: ' +
+                             str(len(self.mask)) + ' and ' + str(len(other.mask)))
+
+    def __or__(self, other):
+        self.check_size(other)
+        return NodeLayer(self.mask | other.mask)
+
+    def __and__(self, other):
+        self.check_size(other)
+        return NodeLayer(self.mask & other.mask)
+
+    def __sub__(self, other):
+        self.check_size(other)
+        return NodeLayer(self.mask & ~other.mask)
+
+    def __invert__(self):
+        return NodeLayer(~self.mask)
+
+    def get_node_count(self):
+        return len(self.mask)
+
+    def get_nodes(self):
+        return np.flatnonzero(self.mask)
+
+    # Identifies the node set, e.g. for cache keys. Layers are not modified in place.
+    def get_key(self):
+        if self.key is None:
+            self.key = (len(self.mask), hashlib.sha1(
+                self.to_bits().tobytes()).hexdigest())
+        return self.key
+
+    def to_bits(self):
+        return np.packbits(self.mask)
+
+    def __getstate__(self):
+        return {'bits': self.to_bits(), 'node_count': len(self.mask)}
+
+    def __setstate__(self, state):
+        self.mask = bits_to_mask(state['bits'], state['node_count'])
+        self.key = None
+
+
+def bits_to_mask(bits, node_count):
+    return np.unpackbits(bits, count=node_count).astype(bool)
+
+
+def nodes_to_mask(nodes, node_count):
+    mask = np.zeros(node_count, dtype=bool)
+    if nodes is None:
+        return mask
+    nodes = np.asarray(list(nodes), dtype=np.int64)
+    nodes = nodes[(nodes >= 0) & (nodes < node_count)]
+    mask[nodes] = True
+    return mask
+
+
+# Layer from a set or list of node ids, a boolean mask or a layer
+def as_layer(nodes, node_count):
+    if nodes is None:
+        return None
+    if isinstance(nodes, NodeLayer):
+        return nodes
+    if isinstance(nodes, np.ndarray) and nodes.dtype == bool:
+        return NodeLayer(nodes)
+    return NodeLayer(nodes_to_mask(nodes, node_count))
+
+
+# Cache key of a node set, layers are hashed instead of copied into a frozenset
+def get_layer_key(nodes):
+    if isinstance(nodes, NodeLayer):
+        return nodes.get_key()
+    return frozenset(nodes)
+
+
+def get_grid_key(grid):
+    return (grid.side_length, len(grid.rows), len(grid.cols))
+
+
+# Named layers are saved with the grid dimensions and only loaded for the same grid
+def save_layers(path, grid, layers):
+    arrays = {'layer_' + name: layer.to_bits() for name, layer in layers.items()}
+    np.savez(path, grid=np.array(get_grid_key(grid), dtype=np.float64),
+             node_count=grid.get_node_count(), **arrays)
+
+
+def load_layers(path, grid):
+    data = np.load(path)
+    if tuple(data['grid']) != get_grid_key(grid):
+        raise ValueError('Layers were saved for another grid')
+    node_count = int(data['node_count'])
+    return {name[len('layer_'):]: NodeLayer(bits_to_mask(data[name], node_count))
+            for name in data.files if name.startswith('layer_')}
@@ -0,0 +1,170 @@
+from multiprocessing import Pool, shared_memory
+import numpy as np
+from .gridify import Grid, SpeedTable, avg_speeds_to_table
+from .instrumentation import BatchStats
+from .landmarks import LandmarkTables
+from .shortest_path import CSRGraph, DirwayCache, DirwayMasks, as_node_mask, predict_route
+
+# Graph, grid, speeds, dirway masks and landmarks attached by the worker initializer
+worker_state = {}
+
+
+def share_array(array):
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+# avg_speeds can be a SpeedTable, a dict or a DataFrame from gridify.get_avg_speeds.
+# float64 keeps the speeds equal to the ones predict_routes uses.
+def get_speed_table(avg_speeds, node_count):
+    if isinstance(avg_speeds, SpeedTable):
+        return avg_speeds
+    return avg_speeds_to_table(avg_speeds, node_count, dtype=np.float64)
+
+
+def init_worker(specs, graph_flags, grid_params, type_codes, dirway_params, has_shallow, landmark_params):
+    handles = {}
+    arrays = {}
+    for key, spec in specs.items():
+        handles[key], arrays[key] = attach_array(spec)
+    worker_state['handles'] = handles
+
+    graph = CSRGraph(arrays['indptr'], arrays['indices'], arrays['costs'])
+    graph.use_dirways, graph.use_turn_penalty, graph.use_shallow_penalty = graph_flags
+    worker_state['graph'] = graph
+
+    side_length, p_from, p_to = grid_params
+    worker_state['grid'] = Grid(
+        arrays['cols'], arrays['rows'], side_length, p_from, p_to)
+    worker_state['grid'].centroids = (arrays['centroid_lat'], arrays['centroid_lon'])
+    worker_state['avg_speeds'] = SpeedTable(arrays['speeds'], type_codes)
+    worker_state['dirways'] = None
+    if dirway_params is not None:
+        times, interval_keys, rows = dirway_params
+        worker_state['dirways'] = DirwayMasks(times, interval_keys, rows, arrays['dirways'])
+    worker_state['shallow_graph'] = arrays['shallow'] if has_shallow else None
+
+    worker_state['landmarks'] = None
+    if landmark_params is not None:
+        use_dirways, signature = landmark_params
+        worker_state['landmarks'] = LandmarkTables(arrays['landmarks'], arrays['from_landmarks'], arrays['to_landmarks'],
+                                                   use_dirways, signature)
+
+
+def predict_chunk(task):
+    chunk_id, observations, search_area, collect_stats = task
+    routes = []
+    search_areas = []
+    errors = []
+    stats = BatchStats() if collect_stats else None
+    for i, observation in observations.iterrows():
+        query_stats = None
+        if stats is not None:
+            query_stats = stats.new_query(observation.voyage)
+            query_stats.start()
+        route = predict_route(observation, worker_state['grid'], worker_state['graph'], worker_state['avg_speeds'],
+                              worker_state['dirways'], worker_state['shallow_graph'], worker_state['landmarks'],
+                              search_area='rows' if search_area else None, stats=query_stats)
+        if query_stats is not None:
+            query_stats.finish(route is not None)
+        if route is None:
+            errors.append([[observation.lat, observation.lon], [
+                          observation.end_lat, observation.end_lon]])
+        else:
+            routes.extend(route[0])
+            search_areas.extend(route[1])
+    return chunk_id, routes, search_areas, errors, stats.queries if stats is not None else []
+
+
+# Same output as predict_routes. Observations are split into chunks that are
+# routed in a process pool; the graph, grid, speeds, landmarks and the dirway
+# node masks of the observation times are placed in shared memory once instead
+# of being pickled to every worker. Workers only get the interval keys of the
+# dirway sets, not the dirways DataFrame. Chunks are merged
+# back in observation order, like the query stats of the workers when stats
+# (a BatchStats) is given.
+def predict_routes_parallel(observations, grid, graph, avg_speeds, dirways, shallow_graph, processes=None, chunk_size=50, print_params=True, landmarks=None, search_area=True, stats=None):
+    if print_params:
+        graph.print_parameters()
+        grid.print_parameters()
+
+    node_count = grid.get_node_count()
+    speed_table = get_speed_table(avg_speeds, node_count)
+    type_codes = speed_table.type_codes
+    centroid_lat, centroid_lon = grid.get_centroids()
+    arrays = {
+        'indptr': graph.indptr,
+        'indices': graph.indices,
+        'costs': graph.costs,
+        'rows': grid.rows,
+        'cols': grid.cols,
+        'speeds': speed_table.speeds,
+        'centroid_lat': centroid_lat,
+        'centroid_lon': centroid_lon,
+    }
+
+    has_shallow = graph.use_shallow_penalty and shallow_graph is not None
+    if has_shallow:
+        arrays['shallow'] = as_node_mask(shallow_graph, node_count)
+
+    dirway_params = None
+    if graph.use_dirways:
+        if not isinstance(dirways, DirwayCache):
+            dirways = DirwayCache(dirways, grid)
+        dirway_masks = dirways.get_masks(observations.ata.values)
+        arrays['dirways'] = dirway_masks.masks
+        dirway_params = (dirway_masks.times, dirway_masks.interval_keys, dirway_masks.rows)
+
+    landmark_params = None
+    if landmarks is not None:
+        arrays['landmarks'] = landmarks.landmarks
+        arrays['from_landmarks'] = landmarks.from_landmarks
+        arrays['to_landmarks'] = landmarks.to_landmarks
+        landmark_params = (landmarks.use_dirways, landmarks.signature)
+
+    handles = []
+    specs = {}
+    try:
+        for key, array in arrays.items():
+            shm, specs[key] = share_array(array)
+            handles.append(shm)
+
+        graph_flags = (graph.use_dirways, graph.use_turn_penalty,
+                       graph.use_shallow_penalty)
+        grid_params = (grid.side_length, grid.p_from, grid.p_to)
+
+        tasks = [(i, observations.iloc[start:start + chunk_size], search_area, stats is not None)
+                 for i, start in enumerate(range(0, len(observations), chunk_size))]
+
+        routes = []
+        search_areas = []
+        errors = []
+        with Pool(processes, initializer=init_worker,
+                  initargs=(specs, graph_flags, grid_params, type_codes, dirway_params, has_shallow, landmark_params)) as pool:
+            # imap returns the chunks in task order
+            for chunk_id, chunk_routes, chunk_areas, chunk_errors, chunk_stats in pool.imap(predict_chunk, tasks):
+                routes.extend(chunk_routes)
+                search_areas.extend(chunk_areas)
+                errors.extend(chunk_errors)
+                if stats is not None:
+                    stats.extend(chunk_stats)
+    finally:
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+
+    if print_params:
+        print('Error count=', len(errors))
+        print(errors)
+        if stats is not None:
+            stats.print_summary()
+    return [routes, search_areas]
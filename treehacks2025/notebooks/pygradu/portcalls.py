@@ -2,8 +2,9 @@ import math
 import datetime
 import numpy as np
 import pandas as pd
+from . import geodesy
 
-EARTH_RADIUS_KM = 6371.0
+EARTH_RADIUS_KM = geodesy.EARTH_RADIUS_KM
 KNOTS_PER_MS = 1.943844
 KM_PER_NM = 1.852
 time_limit_hours = 2
@@ -19,39 +20,34 @@ def rad2deg(rad):
     return rad * (180 / math.pi)
 
 
+# Works on rows and on whole columns
 def distance_from_coords_in_km(coordinate1, coordinate2):
-    lat1 = deg2rad(coordinate1['lat'])
-    lat2 = deg2rad(coordinate2['lat'])
-    long1 = deg2rad(coordinate1['lon'])
-    long2 = deg2rad(coordinate2['lon'])
+    return geodesy.distance_km(coordinate1['lat'], coordinate1['lon'], coordinate2['lat'], coordinate2['lon'])
 
-    dLat = (lat2 - lat1)
-    dLon = (long2 - long1)
-    a = math.sin(dLat / 2) * math.sin(dLat / 2) + math.cos((lat1)) * \
-        math.cos((lat2)) * math.sin(dLon / 2) * math.sin(dLon / 2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return EARTH_RADIUS_KM * c
+
+# First port within min_distance_to_port in ports order, not necessarily the nearest one
+def get_port_within_range(lat, lon, ports):
+    distances = geodesy.distance_km(lat, lon, ports['lat'].values, ports['lon'].values)
+    matches = np.flatnonzero(distances < min_distance_to_port)
+    if len(matches) == 0:
+        return None
+    return ports.iloc[matches[0]]
 
 
 def get_port_id(row, ports):
     row['lat'] = row['start_lat']
     row['lon'] = row['start_lon']
-    for i, port in ports.iterrows():
-        if distance_from_coords_in_km(row, port) < min_distance_to_port:
-            return int(port['port_id'])
-
-    return None
+    port = get_port_within_range(row['lat'], row['lon'], ports)
+    if port is None:
+        return None
+    return int(port['port_id'])
 
 
 def get_port_id_new(row, ports, columns):
-    row_coord = dict()
-    row_coord['lat'] = row[columns.index('lat')]
-    row_coord['lon'] = row[columns.index('lon')]
-    for i, port in ports.iterrows():
-        if distance_from_coords_in_km(row_coord, port) < min_distance_to_port:
-            return port['port_id']
-
-    return None
+    port = get_port_within_range(row[columns.index('lat')], row[columns.index('lon')], ports)
+    if port is None:
+        return None
+    return port['port_id']
 
 
 def is_moving(row):
@@ -99,19 +95,7 @@ def voyage_to_df(voyage, columns):
 
 def calculate_voyage_distance(voyage):
     voyage = voyage.sort_values(by=['timestamp'])
-    voyage = voyage.reset_index(drop=True)
-
-    distance = 0
-
-    for i, row in voyage.iterrows():
-        cursor = i+1
-        if cursor == len(voyage.lat):
-            continue
-        next_row = voyage.loc[cursor]
-
-        distance += distance_from_coords_in_km(row, next_row)
-
-    return distance
+    return float(geodesy.segment_distances_km(voyage.lat.values, voyage.lon.values).sum())
 
 
 def reset_ais_for_portcalls(ais):
@@ -175,8 +159,8 @@ def calculate_voyages(ais, ports):
                 voyage['end_lon'] = obs.lon
 
                 df_voyage = voyage_to_df(voyage, ais.columns)
-                ais_portcalls = ais_portcalls.append(
-                    df_voyage, ignore_index=True)
+                ais_portcalls = pd.concat(
+                    [ais_portcalls, df_voyage], ignore_index=True)
                 voyage = reset_voyage(voyage['voyage_nro'] + 1)
                 prev = obs
                 continue
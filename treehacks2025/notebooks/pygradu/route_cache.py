@@ -0,0 +1,178 @@
+from collections import OrderedDict
+import pickle
+import numpy as np
+from .layers import get_layer_key
+from .shortest_path import a_star_heap, get_node, get_path_speeds, retrace_path
+
+# Rough size of an OrderedDict entry and its key tuple, path and search area arrays are counted exactly
+ENTRY_OVERHEAD_BYTES = 400
+# Node set keys kept by RouteCache.get_nodes_key
+MAX_NODE_KEYS = 16
+
+
+def get_graph_signature(graph):
+    return graph.get_signature()
+
+
+class RouteCache():
+    def __init__(self, max_entries=10000, max_bytes=None):
+        """
+        LRU cache of found paths (node ids) by start node, end node, vessel type,
+        graph flags and graph version. The active dirways, the shallow water
+        nodes and the start course are part of the key when the graph uses them. Route rows are rebuilt from
+        the cached path for every query. The SearchArea of the search is stored
+        with the path when the query asks for one, a query that asks for a search
+        area misses entries stored without it. The search area is the one of the
+        search that filled the entry, e.g. with or without landmarks.
+        Keys of the node sets passed in are kept by object, so a batch that
+        passes the same set objects for every query builds their frozensets once.
+        Sets must not be modified in place while they are used with the cache.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.node_keys = {}
+
+    # Cache key of a node set, see layers.get_layer_key. The set is kept with
+    # its key so that its id is not reused by another object.
+    def get_nodes_key(self, nodes):
+        if id(nodes) not in self.node_keys:
+            if len(self.node_keys) >= MAX_NODE_KEYS:
+                self.node_keys = {}
+            self.node_keys[id(nodes)] = (nodes, get_layer_key(nodes))
+        return self.node_keys[id(nodes)][1]
+
+    # shallow_key identifies the shallow water nodes, see layers.get_layer_key
+    def get_key(self, graph, start_pos, end_pos, vessel_type, dirway_key=None, course=None, shallow_key=None):
+        flags = (graph.use_dirways, graph.use_turn_penalty,
+                 graph.use_shallow_penalty)
+        if not graph.use_dirways:
+            dirway_key = None
+        if not graph.use_turn_penalty:
+            course = None
+        if not graph.use_shallow_penalty:
+            shallow_key = None
+        return (start_pos, end_pos, vessel_type, flags, graph.version, dirway_key, course, shallow_key)
+
+    # Path and SearchArea (None when not stored) of key, with_area misses
+    # entries without a search area
+    def get(self, key, with_area=False):
+        entry = self.entries.get(key)
+        if entry is None or (with_area and entry[1] is None):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        path, area = entry
+        return path.tolist(), area
+
+    def put(self, key, path, area=None):
+        if key in self.entries:
+            self.remove(key)
+        path = np.asarray(path, dtype=np.int32)
+        self.entries[key] = (path, area)
+        self.bytes += get_entry_bytes(path, area)
+
+        while len(self.entries) > self.max_entries or \
+                (self.max_bytes is not None and self.bytes > self.max_bytes and len(self.entries) > 1):
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.evictions += 1
+
+    def remove(self, key):
+        path, area = self.entries.pop(key)
+        self.bytes -= get_entry_bytes(path, area)
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.node_keys = {}
+
+    def route(self, graph, start_latlon, end_latlon, avg_speeds, speed, course, vessel_type, grid, dirways_graph, shallow_graph, mmsi, voyage, start_time, landmarks=None, dirway_key=None, search_area='rows', stats=None):
+        return cached_a_star(self, graph, start_latlon, end_latlon, avg_speeds, speed, course, vessel_type, grid,
+                             dirways_graph, shallow_graph, mmsi, voyage, start_time, landmarks, dirway_key, search_area, stats)
+
+    def get_stats(self):
+        queries = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / queries if queries > 0 else None,
+        }
+
+    def print_stats(self):
+        for name, value in self.get_stats().items():
+            print(name + '=', value)
+
+    # The graph signature is stored so that a cache is only loaded for the same graph
+    def save(self, path, graph):
+        entries = [(key, value) for key, value in self.entries.items()]
+        with open(path, 'wb') as f:
+            pickle.dump({'signature': get_graph_signature(graph), 'max_entries': self.max_entries,
+                         'max_bytes': self.max_bytes, 'entries': entries}, f)
+
+
+def load_route_cache(path, graph):
+    with open(path, 'rb') as f:
+        saved = pickle.load(f)
+    if saved['signature'] != get_graph_signature(graph):
+        raise ValueError('Route cache was saved for another graph')
+
+    cache = RouteCache(saved['max_entries'], saved['max_bytes'])
+    for key, (path, area) in saved['entries']:
+        # Graph versions are counted per process, the signature already matched
+        key = key[:4] + (graph.version,) + key[5:]
+        cache.put(key, path, area)
+    return cache
+
+
+def get_entry_bytes(path, area):
+    size = path.nbytes + ENTRY_OVERHEAD_BYTES
+    if area is not None:
+        size += area.nodes.nbytes + area.g.nbytes + area.h.nbytes + area.f.nbytes
+    return size
+
+
+# a_star_heap with a RouteCache in front of it. On a hit the route is rebuilt
+# from the cached path and the search area from the cached SearchArea.
+# stats (a QueryStats) is only filled in by the search on a miss.
+def cached_a_star(route_cache, graph, start_latlon, end_latlon, avg_speeds, speed, course, vessel_type, grid, dirways_graph, shallow_graph, mmsi, voyage, start_time, landmarks=None, dirway_key=None, search_area='rows', stats=None):
+    start_pos = get_node(grid, start_latlon[0], start_latlon[1])
+    end_pos = get_node(grid, end_latlon[0], end_latlon[1])
+    if graph.use_dirways and dirway_key is None and dirways_graph is not None:
+        dirway_key = route_cache.get_nodes_key(dirways_graph)
+    shallow_key = None
+    if graph.use_shallow_penalty and shallow_graph is not None:
+        shallow_key = route_cache.get_nodes_key(shallow_graph)
+    key = route_cache.get_key(graph, start_pos, end_pos,
+                              vessel_type, dirway_key, course, shallow_key)
+
+    cached = route_cache.get(key, search_area is not None)
+    if cached is not None:
+        path, area = cached
+        speeds = get_path_speeds(avg_speeds, vessel_type, speed, path)
+        route = retrace_path(grid, path, speeds, start_latlon, end_latlon, mmsi, voyage, start_time)
+        if search_area is None:
+            return [route, []]
+        if search_area == 'rows':
+            return [route, area.to_rows(grid, voyage)]
+        return [route, area]
+
+    # Search areas are stored as arrays, rows depend on the voyage
+    route = a_star_heap(graph, start_latlon, end_latlon, avg_speeds, speed, course, vessel_type, grid,
+                        dirways_graph, shallow_graph, mmsi, voyage, start_time, landmarks,
+                        None if search_area is None else 'arrays', stats)
+    if route is None:
+        return None
+    area = route[1] if search_area is not None else None
+    route_cache.put(key, [row[2] for row in route[0]], area)
+    if search_area == 'rows':
+        return [route[0], area.to_rows(grid, voyage)]
+    return route
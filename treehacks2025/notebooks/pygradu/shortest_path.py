@@ -1,13 +1,90 @@
 from collections import defaultdict
 from sklearn import preprocessing
+import numpy as np
 import pandas as pd
 from math import *
 import datetime
+import hashlib
+import heapq
+import pickle
+import time
 # from .pygradu import portcalls
 from .gridify import *
+from . import geodesy
+from .layers import NodeLayer, as_layer, nodes_to_mask
 import math
 
-EARTH_RADIUS_KM = 6371.0
+EARTH_RADIUS_KM = geodesy.EARTH_RADIUS_KM
+DIRWAY_COST = 0.05
+SHALLOW_PENALTY = 0.2
+TURN_PENALTY = 0.05
+
+
+def turn_penalty(current_course, next_course):
+    phi = abs(current_course - next_course) % 360
+    if phi > 180:
+        change = 360 - phi
+    else:
+        change = phi
+    return change/180 * TURN_PENALTY
+
+
+# turn_penalty for arrays of courses
+def turn_penalties(current_course, next_courses):
+    phi = np.abs(current_course - next_courses) % 360
+    change = np.where(phi > 180, 360 - phi, phi)
+    return change/180 * TURN_PENALTY
+
+
+class TurnTable():
+    def __init__(self, offsets, courses, penalties, edge_codes):
+        """
+        Turn penalties by grid offset. offsets are the distinct (row, col)
+        steps of the graph edges and courses their directions in grid
+        coordinates. penalties[a, b] is the penalty of turning from offset a
+        to offset b and edge_codes the offset of every edge, in CSR order.
+        Turn penalties only depend on course changes, so the difference
+        between grid north and true north cancels out.
+        """
+        self.offsets = offsets
+        self.courses = courses
+        self.penalties = penalties
+        self.edge_codes = edge_codes
+
+
+def build_turn_table(graph, grid):
+    row_count = len(grid.rows)
+    sources = np.repeat(np.arange(graph.node_count, dtype=np.int64), np.diff(graph.indptr))
+    targets = graph.indices.astype(np.int64)
+    source_rows = sources // row_count
+    target_rows = targets // row_count
+    steps = np.column_stack((target_rows - source_rows,
+                             (targets - target_rows * row_count) - (sources - source_rows * row_count)))
+
+    offsets, edge_codes = np.unique(steps, axis=0, return_inverse=True)
+    # Rows grow to the north and cols to the east
+    courses = np.degrees(np.arctan2(offsets[:, 1], offsets[:, 0])) % 360
+    penalties = turn_penalties(courses[:, None], courses[None, :])
+    code_type = np.int16 if len(offsets) <= np.iinfo(np.int16).max else np.int32
+    return TurnTable(offsets, courses, penalties, edge_codes.reshape(-1).astype(code_type))
+
+
+# Turn penalties of the edges of node and their offset codes. course_code is the
+# offset the node was reached with, or -1 at the start where the vessel course
+# (a true bearing) is compared to the true bearings of the edges.
+def get_turn_penalties(graph, grid, turns, node, course_code, course, next_nodes, dirway_mask):
+    start, end = graph.get_edge_range(node)
+    next_codes = turns.edge_codes[start:end]
+    if course_code >= 0:
+        penalties = turns.penalties[course_code, next_codes]
+    else:
+        lats, lons = grid.extract_coords_lat_lon_batch(np.append(next_nodes, node))
+        next_courses = geodesy.bearing_deg(lats[-1], lons[-1], lats[:-1], lons[:-1])
+        penalties = turn_penalties(course, next_courses)
+    # No turn penalty on dirways
+    if dirway_mask is not None:
+        penalties = np.where(dirway_mask[next_nodes], 0.0, penalties)
+    return penalties, next_codes
 
 
 class Graph():
@@ -34,26 +111,24 @@ class Graph():
 
         self.costs[(from_node, to_node)] = cost
 
+    def get_edge_cost(self, current_node, next_node):
+        return self.costs[(current_node, next_node)]
+
     def cost(self, current_node, next_node, current_course, next_course, dirways_graph, shallow_graph):
-        cost = self.costs[(current_node, next_node)]
+        cost = self.get_edge_cost(current_node, next_node)
 
         if self.use_dirways and next_node in dirways_graph:
-            return 0.05
+            return DIRWAY_COST
 
         shallow_penalty = 0
         if self.use_shallow_penalty and next_node in shallow_graph:
-            shallow_penalty = 0.2
+            shallow_penalty = SHALLOW_PENALTY
 
-        turn_penalty = 0
+        penalty = 0
         if self.use_turn_penalty:
-            phi = abs(current_course - next_course) % 360
-            if phi > 180:
-                change = 360 - phi
-            else:
-                change = phi
-            turn_penalty = change/180 * 0.05
+            penalty = turn_penalty(current_course, next_course)
 
-        return cost + turn_penalty + shallow_penalty
+        return cost + penalty + shallow_penalty
 
     def print_parameters(self):
         print('use_dirways=', self.use_dirways)
@@ -61,7 +136,138 @@ class Graph():
         print('use_shallow_penalty=', self.use_shallow_penalty)
 
 
-def df_to_graph(complete_graph):
+class CSRAdjacency():
+    """Read-only view with the same indexing as Graph.edges"""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, node):
+        start, end = self.graph.get_edge_range(node)
+        return self.graph.indices[start:end]
+
+
+class CSRGraph(Graph):
+    def __init__(self, indptr, indices, costs):
+        """
+        Compressed sparse row graph.
+        Neighbours of node n are indices[indptr[n]:indptr[n+1]],
+        sorted by node id, and costs holds the edge costs in the same order.
+        The edges are fixed once the graph is built, costs change through
+        update_costs, which increments version.
+        """
+        self.indptr = indptr
+        self.indices = indices
+        self.costs = costs
+        self.node_count = len(indptr) - 1
+        self.edges = CSRAdjacency(self)
+        # Incremented when costs change, caches built from the graph compare it
+        self.version = 0
+        self.signature = None
+        self.signature_version = None
+        self.turn_table = None
+        self.turn_table_rows = None
+        self.use_dirways = True
+        self.use_turn_penalty = False
+        self.use_shallow_penalty = False
+
+    # The edges are built once, graphs that grow edge by edge are dict graphs
+    def add_edge(self, from_node, to_node, cost):
+        raise TypeError(
+            'CSRGraph edges are fixed after build, change costs with update_costs or use df_to_dict_graph to add edges')
+
+    def get_edge_range(self, node):
+        if node < 0 or node >= self.node_count:
+            return 0, 0
+        return self.indptr[node], self.indptr[node + 1]
+
+    def get_edge_cost(self, current_node, next_node):
+        start, end = self.get_edge_range(current_node)
+        i = start + np.searchsorted(self.indices[start:end], next_node)
+        if i == end or self.indices[i] != next_node:
+            raise KeyError((current_node, next_node))
+        return self.costs[i]
+
+    # Neighbours of node and their costs with dirway and shallow water rules applied.
+    # Turn penalty depends on the search state and is added by the caller.
+    def get_neighbours(self, node, dirway_mask=None, shallow_mask=None):
+        start, end = self.get_edge_range(node)
+        neighbours = self.indices[start:end]
+        costs = self.costs[start:end]
+
+        if self.use_shallow_penalty and shallow_mask is not None:
+            costs = costs + SHALLOW_PENALTY * shallow_mask[neighbours]
+        if self.use_dirways and dirway_mask is not None:
+            costs = np.where(dirway_mask[neighbours], DIRWAY_COST, costs)
+
+        return neighbours, costs
+
+    # Costs of all edges, in the same order as indices, with get_neighbours rules
+    def get_all_costs(self, dirway_mask=None, shallow_mask=None):
+        costs = self.costs
+        if self.use_shallow_penalty and shallow_mask is not None:
+            costs = costs + SHALLOW_PENALTY * shallow_mask[self.indices]
+        if self.use_dirways and dirway_mask is not None:
+            costs = np.where(dirway_mask[self.indices], DIRWAY_COST, costs)
+        return costs
+
+    # Edge offsets only depend on the edges and the grid, so the table is built once
+    def get_turn_table(self, grid):
+        if self.turn_table is None or self.turn_table_rows != len(grid.rows):
+            self.turn_table = build_turn_table(self, grid)
+            self.turn_table_rows = len(grid.rows)
+        return self.turn_table
+
+    def update_costs(self, costs):
+        self.costs = costs
+        self.version += 1
+
+    # Hash of the edges and costs, for tables and caches that are saved with the
+    # graph they were built for. Computed once per version.
+    def get_signature(self):
+        if self.signature is None or self.signature_version != self.version:
+            digest = hashlib.sha1()
+            for array in (self.indptr, self.indices, self.costs):
+                digest.update(np.ascontiguousarray(array).tobytes())
+            self.signature = (self.node_count, self.get_edge_count(), digest.hexdigest())
+            self.signature_version = self.version
+        return self.signature
+
+    def get_edge_count(self):
+        return len(self.indices)
+
+
+def as_node_mask(nodes, node_count):
+    if nodes is None:
+        return None
+    if isinstance(nodes, NodeLayer):
+        return nodes.mask
+    if isinstance(nodes, np.ndarray) and nodes.dtype == bool:
+        return nodes
+    return nodes_to_mask(nodes, node_count)
+
+
+def df_to_graph(complete_graph, node_count=None):
+    # Columns are (original, connected, cost). Later rows win for duplicate
+    # edges, like in Graph.add_edge
+    complete_graph = complete_graph.drop_duplicates(
+        subset=list(complete_graph.columns[:2]), keep='last')
+    original = complete_graph.iloc[:, 0].to_numpy().astype(np.int64)
+    connected = complete_graph.iloc[:, 1].to_numpy().astype(np.int64)
+    costs = complete_graph.iloc[:, 2].to_numpy().astype(np.float64)
+
+    if node_count is None:
+        node_count = int(max(original.max(initial=-1),
+                         connected.max(initial=-1))) + 1
+
+    order = np.lexsort((connected, original))
+    indptr = np.zeros(node_count + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(original, minlength=node_count))
+
+    return CSRGraph(indptr, connected[order].astype(np.int32), costs[order])
+
+
+def df_to_dict_graph(complete_graph):
     edges = complete_graph.values
 
     graph = Graph()
@@ -113,32 +319,11 @@ def normalize(value, min, max):
 
 
 def angleFromCoordinatesInDeg(coordinate1, coordinate2):
-    lat1 = deg2rad(coordinate1[0])
-    lat2 = deg2rad(coordinate2[0])
-    long1 = deg2rad(coordinate1[1])
-    long2 = deg2rad(coordinate2[1])
-    dLon = (long2 - long1)
-
-    y = math.sin(dLon) * math.cos(lat2)
-    x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * \
-        math.cos(lat2) * math.cos(dLon)
-
-    bearing = math.atan2(y, x)
-    return normalize(rad2deg(bearing), 0.0, 360.0)
+    return geodesy.point_bearing_deg(coordinate1, coordinate2)
 
 
 def distance_from_coords_in_km(coordinate1, coordinate2):
-    lat1 = deg2rad(coordinate1[0])
-    lat2 = deg2rad(coordinate2[0])
-    long1 = deg2rad(coordinate1[1])
-    long2 = deg2rad(coordinate2[1])
-
-    dLat = (lat2 - lat1)
-    dLon = (long2 - long1)
-    a = math.sin(dLat / 2) * math.sin(dLat / 2) + math.cos((lat1)) * \
-        math.cos((lat2)) * math.sin(dLon / 2) * math.sin(dLon / 2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return EARTH_RADIUS_KM * c
+    return geodesy.point_distance_km(coordinate1, coordinate2)
 
 
 def calculate_time(coords1, coords2, speed, start_time):
@@ -147,35 +332,32 @@ def calculate_time(coords1, coords2, speed, start_time):
 
 
 def interpolate_to_time(latlon1, latlon2, speed, start_time, end_time):
-    bearing = deg2rad(angleFromCoordinatesInDeg(latlon1, latlon2))
-
-    lat1 = deg2rad(latlon1[0])
-    long1 = deg2rad(latlon1[1])
-
+    bearing = angleFromCoordinatesInDeg(latlon1, latlon2)
     distance = ((end_time-start_time).total_seconds() * speed) / 1000
+    return geodesy.point_destination(latlon1, bearing, distance)
 
-    lat2 = math.asin(math.sin(lat1) * math.cos(distance / EARTH_RADIUS_KM) +
-                     math.cos(lat1) * math.sin(distance / EARTH_RADIUS_KM) * math.cos(bearing))
 
-    long2 = long1 + math.atan2(math.sin(bearing) * math.sin(distance / EARTH_RADIUS_KM) * math.cos(
-        lat1), math.cos(distance / EARTH_RADIUS_KM) - math.sin(lat1) * math.sin(lat2))
+def get_speed(avg_speeds, vessel_type, prev_speed, node_pos, transitions):
+    # Speed as moving average
+    if isinstance(avg_speeds, SpeedTable):
+        pred_speed = avg_speeds.get_speed(node_pos, vessel_type)
+    else:
+        try:
+            speeds_by_type = avg_speeds[node_pos]
+            pred_speed = speeds_by_type[vessel_type]
+            if isnan(speeds_by_type[vessel_type]):
+                pred_speed = DEFAULT_SPEED
+        except KeyError:
+            pred_speed = DEFAULT_SPEED
 
-    return [rad2deg(lat2), rad2deg(long2)]
+    return propagate_speed(prev_speed, pred_speed, transitions)
 
 
-def get_speed(avg_speeds, vessel_type, prev_speed, node_pos, transitions):
+def propagate_speed(prev_speed, pred_speed, transitions):
     max_transitions = 3
     if transitions > max_transitions:
         transitions = max_transitions
     multiplier = max_transitions - transitions
-    # Speed as moving average
-    try:
-        speeds_by_type = avg_speeds[node_pos]
-        pred_speed = speeds_by_type[vessel_type]
-        if isnan(speeds_by_type[vessel_type]):
-            pred_speed = 7
-    except KeyError:
-        pred_speed = 7
 
     speed = ((prev_speed * multiplier) + (pred_speed *
              (max_transitions - multiplier))) / max_transitions
@@ -211,14 +393,32 @@ def retrace_route(grid, current_node, start_latlon, end_latlon, mmsi, voyage, st
     return path[::-1]  # Return reversed pat
 
 
-def retrace_search_area(grid, closed_list, voyage):
-    area = []
-    for node in closed_list:
-        row = grid.extract_coords_lat_lon(node.position)
-        row.extend([voyage, node.g, node.h, node.f])
-        area.append(row)
+class SearchArea():
+    def __init__(self, nodes, g, h, f):
+        """Closed nodes of a search in closing order and their scores, as arrays"""
+        self.nodes = nodes
+        self.g = g
+        self.h = h
+        self.f = f
 
-    return area
+    def __len__(self):
+        return len(self.nodes)
+
+    # Rows of [lat, lon, voyage, g, h, f] like retrace_search_area
+    def to_rows(self, grid, voyage):
+        if len(self.nodes) == 0:
+            return []
+        lats, lons = grid.extract_coords_lat_lon_batch(self.nodes)
+        return [[lat, lon, voyage, g, h, f] for lat, lon, g, h, f in
+                zip(lats.tolist(), lons.tolist(), self.g.tolist(), self.h.tolist(), self.f.tolist())]
+
+
+def retrace_search_area(grid, closed_list, voyage):
+    area = SearchArea(np.array([node.position for node in closed_list], dtype=np.int64),
+                      np.array([node.g for node in closed_list], dtype=np.float64),
+                      np.array([node.h for node in closed_list], dtype=np.float64),
+                      np.array([node.f for node in closed_list], dtype=np.float64))
+    return area.to_rows(grid, voyage)
 
 
 def distance_to_dest(next_node, end_node, speed):
@@ -340,6 +540,209 @@ def a_star(graph, start_latlon, end_latlon, avg_speeds, speed, course, vessel_ty
     return None
 
 
+def get_path_speeds(avg_speeds, vessel_type, speed, path):
+    # Same speed propagation as a_star does when a node is reached from its parent
+    if isinstance(avg_speeds, SpeedTable):
+        node_speeds = avg_speeds.get_speeds(path[:-1], vessel_type).tolist()
+        speeds = [speed]
+        for i in range(1, len(path)):
+            speeds.append(propagate_speed(speeds[i-1], node_speeds[i-1], i))
+        return speeds
+
+    speeds = [speed]
+    for i in range(1, len(path)):
+        speeds.append(get_speed(avg_speeds, vessel_type,
+                      speeds[i-1], path[i-1], i))
+    return speeds
+
+
+# Same rows as retrace_route, built from a list of node ids
+def retrace_path(grid, path, speeds, start_latlon, end_latlon, mmsi, voyage, start_time):
+    route = []
+    for i, node in enumerate(path):
+        if i == len(path) - 1:
+            row = list(end_latlon)
+        elif i == 0:
+            row = list(start_latlon)
+        else:
+            row = grid.extract_coords_lat_lon(node)
+
+        row.extend([node, speeds[i], mmsi, voyage, start_time, i])
+        route.append(row)
+    return route
+
+
+def diagonal_distance_nodes(grid, node, end_node):
+    d = 1
+    d2 = sqrt(2)
+    row_count = len(grid.rows)
+    row = int(node / row_count)
+    end_row = int(end_node / row_count)
+    dx = abs(row - end_row)
+    dy = abs((node - row * row_count) - (end_node - end_row * row_count))
+    return (d * (dx + dy) + (d2 - 2 * d) * min(dx, dy))
+
+
+# Search counters of a_star_heap for a QueryStats (see instrumentation.py).
+# They are derived from the search state so the search loop does not count.
+# Only the expanded nodes are read, so counting does not depend on the graph size.
+# edges_relaxed is the sum of the out-degrees of the closed nodes, edges to
+# closed nodes and edges that do not improve a g are counted too.
+def count_search(stats, graph, closed_list, pushes, decrease_keys, found):
+    closed = np.array(closed_list, dtype=np.int64)
+    stats.expanded = len(closed_list) + int(found)
+    stats.edges_relaxed = int((graph.indptr[closed + 1] - graph.indptr[closed]).sum())
+    stats.heap_pushes = pushes
+    stats.decrease_keys = decrease_keys
+
+
+def a_star_heap(graph, start_latlon, end_latlon, avg_speeds, speed, course, vessel_type, grid, dirways_graph, shallow_graph, mmsi, voyage, start_time, landmarks=None, search_area='rows', stats=None):
+    # Same search as a_star, but the open list is a binary heap with lazy deletion:
+    # improved nodes are pushed again and stale heap entries are skipped when popped.
+    # g-scores, parents and courses are kept in arrays indexed by node id and
+    # neighbours and costs are read as slices of the CSRGraph arrays. Courses are
+    # stored as edge offset codes and turn penalties read from a TurnTable.
+    # Without landmarks nodes are ordered by g like in a_star and h is only reported
+    # in the search area. With landmarks (see landmarks.py) f = g + h, where h is
+    # a lower bound of the remaining cost.
+    # search_area selects how closed nodes are returned: 'rows' like a_star,
+    # 'arrays' as a SearchArea or None for an empty list.
+    # With stats (a QueryStats) the search is counted and timed.
+    if stats is not None:
+        timer = time.perf_counter()
+    start_pos = get_node(grid, start_latlon[0], start_latlon[1])
+    end_pos = get_node(grid, end_latlon[0], end_latlon[1])
+    if stats is not None:
+        stats.projection_seconds += time.perf_counter() - timer
+    if start_pos < 0 or end_pos < 0:
+        print('Position outside the grid!')
+        print('Voyage=', str(voyage))
+        return None
+
+    node_count = grid.get_node_count()
+    g = np.full(node_count, np.inf)
+    h = np.zeros(node_count)
+    f = np.full(node_count, np.inf)
+    parents = np.full(node_count, -1, dtype=np.int64)
+    course_codes = np.full(node_count, -1, dtype=np.int32)
+    closed = np.zeros(node_count, dtype=bool)
+    closed_list = []
+
+    turns = None
+    if graph.use_turn_penalty:
+        turns = graph.get_turn_table(grid)
+
+    dirway_mask = None
+    if graph.use_dirways:
+        dirway_mask = as_node_mask(dirways_graph, node_count)
+    shallow_mask = None
+    if graph.use_shallow_penalty:
+        shallow_mask = as_node_mask(shallow_graph, node_count)
+
+    heuristic = None
+    if landmarks is not None:
+        landmarks.check_graph(graph)
+        heuristic = landmarks.get_heuristic(end_pos)
+
+    g[start_pos] = 0
+    if heuristic is not None:
+        h[start_pos] = heuristic([start_pos])[0]
+    f[start_pos] = h[start_pos]
+
+    # Counter breaks ties between equal scores in insertion order
+    counter = 0
+    open_heap = [(f[start_pos], counter, start_pos)]
+    # Pushes of nodes that were already on the heap with a worse g
+    decrease_keys = 0
+
+    while open_heap:
+        current_f, _, current = heapq.heappop(open_heap)
+
+        if closed[current] or current_f > f[current]:
+            continue
+        current_g = g[current]
+
+        # Found the goal
+        if current == end_pos:
+            path = []
+            node = current
+            while node != -1:
+                path.append(node)
+                node = parents[node]
+            path = path[::-1]
+
+            if stats is not None:
+                count_search(stats, graph, closed_list, counter + 1, decrease_keys, True)
+                timer = time.perf_counter()
+            speeds = get_path_speeds(avg_speeds, vessel_type, speed, path)
+            if stats is not None:
+                stats.speed_seconds += time.perf_counter() - timer
+                timer = time.perf_counter()
+            route = retrace_path(grid, path, speeds, start_latlon,
+                                 end_latlon, mmsi, voyage, start_time)
+
+            area = []
+            if search_area is not None:
+                nodes = np.array(closed_list, dtype=np.int64)
+                area = SearchArea(nodes, g[nodes], h[nodes], f[nodes])
+                if search_area == 'rows':
+                    area = area.to_rows(grid, voyage)
+            if stats is not None:
+                stats.projection_seconds += time.perf_counter() - timer
+            return [route, area]
+
+        closed[current] = True
+        closed_list.append(current)
+
+        if stats is not None:
+            timer = time.perf_counter()
+        next_nodes, next_costs = graph.get_neighbours(
+            current, dirway_mask, shallow_mask)
+
+        next_codes = None
+        if turns is not None:
+            penalties, next_codes = get_turn_penalties(graph, grid, turns, current, course_codes[current], course,
+                                                       next_nodes, dirway_mask)
+            next_costs = next_costs + penalties
+            next_codes = next_codes.tolist()
+        if stats is not None:
+            stats.cost_seconds += time.perf_counter() - timer
+
+        # Landmark bounds of all neighbours at once
+        if heuristic is not None:
+            next_h = heuristic(next_nodes).tolist()
+
+        for i, (next_node, next_g) in enumerate(zip(next_nodes.tolist(), next_costs.tolist())):
+            if closed[next_node]:
+                continue
+
+            # G is the sum of all costs from the beginning
+            next_g += current_g
+
+            if next_g < g[next_node]:
+                if stats is not None and g[next_node] < np.inf:
+                    decrease_keys += 1
+                g[next_node] = next_g
+                if heuristic is not None:
+                    h[next_node] = next_h[i]
+                    f[next_node] = next_g + h[next_node]
+                else:
+                    h[next_node] = diagonal_distance_nodes(
+                        grid, next_node, end_pos)
+                    f[next_node] = next_g
+                parents[next_node] = current
+                if next_codes is not None:
+                    course_codes[next_node] = next_codes[i]
+                counter += 1
+                heapq.heappush(open_heap, (f[next_node], counter, next_node))
+
+    if stats is not None:
+        count_search(stats, graph, closed_list, counter + 1, decrease_keys, False)
+    print('Path does not exist!')
+    print('Voyage=', str(voyage))
+    return None
+
+
 def measure_accuracy(grid, real_pos, pred_pos, pred_speed, actual_speed):
     nm_multiplier = 0.539956803
     distance_nm = distance_from_coords_in_km(
@@ -359,6 +762,31 @@ def measure_accuracy(grid, real_pos, pred_pos, pred_speed, actual_speed):
     return [distance_nm, error_rate_lat, error_rate_lon, error_rate_speed, int(real_node == pred_node)]
 
 
+# measure_accuracy for arrays of positions
+def get_accuracy_measures(grid, real_lat, real_lon, pred_lat, pred_lon, pred_speed, actual_speed):
+    nm_multiplier = 0.539956803
+    real_lat = np.asarray(real_lat, dtype=np.float64)
+    real_lon = np.asarray(real_lon, dtype=np.float64)
+    pred_lat = np.asarray(pred_lat, dtype=np.float64)
+    pred_lon = np.asarray(pred_lon, dtype=np.float64)
+    pred_speed = np.asarray(pred_speed, dtype=np.float64)
+    actual_speed = np.asarray(actual_speed, dtype=np.float64)
+
+    distance_nm = geodesy.distance_km(
+        real_lat, real_lon, pred_lat, pred_lon) * nm_multiplier
+    error_rate_lat = np.abs(real_lat - pred_lat) / real_lat * 100
+    error_rate_lon = np.abs(real_lon - pred_lon) / real_lon * 100
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        error_rate_speed = np.where(actual_speed > 0, np.abs(
+            actual_speed - pred_speed) / actual_speed * 100, np.nan)
+
+    real_nodes = get_nodes(grid, real_lat, real_lon)
+    pred_nodes = get_nodes(grid, pred_lat, pred_lon)
+
+    return [distance_nm, error_rate_lat, error_rate_lon, error_rate_speed, (real_nodes == pred_nodes).astype(int)]
+
+
 def extract_test_voyage_ids(voyages, port_id, n):
     voyage_sizes = voyages.loc[voyages['port_id'] == port_id].loc[voyages['speed'] > 2].groupby(
         ['voyage']).size().sort_values(ascending=False)
@@ -379,80 +807,161 @@ def get_test_voyage(voyages, voyage_id, minutes_forward):
     return test_voyage
 
 
+# Node of a position, -1 outside the grid
 def get_node(grid, lat, lon):
-    start = dict()
-    start['grid_point'] = grid.get_grid_point(lat, lon)
-    return grid.get_grid_position(start)
+    return int(grid.get_grid_positions(lat, lon))
 
 
-def interpolate_by_distance(row, next_row, distanceKm):
-    brng = deg2rad(angleFromCoordinatesInDeg(
-        [row.lat, row.lon], [next_row.lat, next_row.lon]))
-    lat1 = deg2rad(row.lat)
-    long1 = deg2rad(row.lon)
+def get_nodes(grid, lats, lons):
+    return grid.get_grid_positions(lats, lons)
 
-    lat2 = math.asin(math.sin(lat1) * math.cos(distanceKm / EARTH_RADIUS_KM) +
-                     math.cos(lat1) * math.sin(distanceKm / EARTH_RADIUS_KM) * math.cos(brng))
-    long2 = long1 + math.atan2(math.sin(brng) * math.sin(distanceKm / EARTH_RADIUS_KM) * math.cos(
-        lat1), math.cos(distanceKm / EARTH_RADIUS_KM) - math.sin(lat1) * math.sin(lat2))
 
-    row.lat = rad2deg(lat2)
-    row.lon = rad2deg(long2)
+def interpolate_by_distance(row, next_row, distanceKm):
+    bearing = angleFromCoordinatesInDeg(
+        [row.lat, row.lon], [next_row.lat, next_row.lon])
+    row.lat, row.lon = geodesy.point_destination(
+        [row.lat, row.lon], bearing, distanceKm)
 
     return row
 
 
+# Nodes on the dirway lines, interpolated every distance_km. The positions are
+# collected first and projected to nodes with one get_nodes call.
 def create_dirways_graph(dirways, grid):
     dirways.sort_values(by=['id', 'number'], inplace=True)
     dirways.reset_index(inplace=True)
 
-    dirways = dirways.groupby('id')
-
-    interpolated_dirways = []
     distance_km = 1
+    lats = []
+    lons = []
 
-    dirway_nodes = set()
-
-    for id, dw_points in dirways:
-        order_number = 0
-        interpolated = []
-        dw_points.reset_index(inplace=True)
-        for i, current in dw_points.iterrows():
-            interpolated.append(current)
-
-            if i+1 == len(dw_points.lat):
+    for id, dw_points in dirways.groupby('id'):
+        points = dw_points[['lat', 'lon']].values.tolist()
+        for i, (lat, lon) in enumerate(points):
+            if i+1 == len(points):
                 break
 
-            next = dw_points.loc[(i+1)]
-            current.number = order_number
-
-            coords = dict()
-            coords['grid_point'] = grid.get_grid_point(
-                current.lat, current.lon)
+            lats.append(lat)
+            lons.append(lon)
+            next = points[i+1]
+            while distance_km < distance_from_coords_in_km([lat, lon], next):
+                bearing = angleFromCoordinatesInDeg([lat, lon], next)
+                lat, lon = geodesy.point_destination(
+                    [lat, lon], bearing, distance_km)
+                lats.append(lat)
+                lons.append(lon)
 
-            node = grid.get_grid_position(coords)
+    nodes = get_nodes(grid, lats, lons)
+    return set(nodes[nodes >= 0].tolist())
 
-            if node not in dirway_nodes:
-                dirway_nodes.add(node)
 
-            while distance_km < distance_from_coords_in_km([current.lat, current.lon], [next.lat, next.lon]):
-                current = interpolate_by_distance(current, next, distance_km)
-                order_number += 1
-                current.number = order_number
-                interpolated.append(current)
-
-                coords = dict()
-                coords['grid_point'] = grid.get_grid_point(
-                    current.lat, current.lon)
-
-                node = grid.get_grid_position(coords)
+class DirwayCache():
+    def __init__(self, dirways, grid):
+        """
+        Dirway node sets by observation time.
+        The set of active dirways only changes at publish and delete times, so
+        self.times splits the timeline into intervals with a constant set.
+        Node sets are memoized as NodeLayers by the set of active dirways,
+        identified by (id, publishtime, deletetime).
+        """
+        self.dirways = dirways
+        self.grid = grid
+        self.publishtimes = dirways.publishtime.values
+        self.deletetimes = dirways.deletetime.values
+        self.versions = list(zip(dirways.id.values, dirways.publishtime.values,
+                                 dirways.deletetime.values))
+        self.times = pd.DatetimeIndex(np.unique(np.concatenate(
+            [self.publishtimes, self.deletetimes])))
+        self.interval_keys = {}
+        self.node_sets = {}
+
+    def get_grid_key(self):
+        return (self.grid.side_length, len(self.grid.rows), len(self.grid.cols))
+
+    # Dirways are active when publishtime < time <= deletetime
+    def get_active(self, time):
+        return (self.publishtimes < time) & (time <= self.deletetimes)
+
+    def get_key(self, time):
+        if pd.isnull(time):
+            return frozenset()
+        time = pd.Timestamp(time).to_datetime64()
+        # Interval i covers times[i-1] < time <= times[i]
+        interval = self.times.searchsorted(time, side='left')
+        if interval not in self.interval_keys:
+            active = np.flatnonzero(self.get_active(time))
+            self.interval_keys[interval] = frozenset(
+                self.versions[i] for i in active)
+        return self.interval_keys[interval]
+
+    def get_nodes(self, time):
+        key = self.get_key(time)
+        if key not in self.node_sets:
+            active_dirways = self.dirways.loc[self.get_active(
+                pd.Timestamp(time).to_datetime64())].copy()
+            self.node_sets[key] = as_layer(create_dirways_graph(
+                active_dirways, self.grid), self.grid.get_node_count())
+        return self.node_sets[key]
+
+    # Node masks of the dirway sets active at times, one row per set,
+    # for sharing with worker processes
+    def get_masks(self, times):
+        rows = {}
+        masks = []
+        for time in pd.unique(times):
+            key = self.get_key(time)
+            if key not in rows:
+                rows[key] = len(masks)
+                masks.append(self.get_nodes(time).mask)
+        if masks:
+            masks = np.stack(masks)
+        else:
+            masks = np.zeros((0, self.grid.get_node_count()), dtype=bool)
+        interval_keys = {interval: key for interval, key in self.interval_keys.items() if key in rows}
+        return DirwayMasks(self.times, interval_keys, rows, masks)
 
-                if node not in dirway_nodes:
-                    dirway_nodes.add(node)
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({'grid': self.get_grid_key(),
+                        'node_sets': self.node_sets}, f)
 
-        interpolated_dirways.append(interpolated)
 
-    return dirway_nodes
+class DirwayMasks():
+    def __init__(self, times, interval_keys, rows, masks):
+        """
+        Dirway node sets of a DirwayCache for the times of one batch, made by
+        DirwayCache.get_masks. masks[rows[key]] is the node mask of the dirway
+        set key and interval_keys maps the intervals of times to their keys, so
+        the masks can be placed in shared memory and workers do not need the
+        dirways DataFrame. Times outside the batch raise KeyError.
+        """
+        self.times = times
+        self.interval_keys = interval_keys
+        self.rows = rows
+        self.masks = masks
+        self.layers = {}
+
+    def get_key(self, time):
+        if pd.isnull(time):
+            return frozenset()
+        time = pd.Timestamp(time).to_datetime64()
+        return self.interval_keys[self.times.searchsorted(time, side='left')]
+
+    def get_nodes(self, time):
+        row = self.rows[self.get_key(time)]
+        if row not in self.layers:
+            self.layers[row] = NodeLayer(self.masks[row])
+        return self.layers[row]
+
+
+def load_dirway_cache(path, dirways, grid):
+    cache = DirwayCache(dirways, grid)
+    with open(path, 'rb') as f:
+        saved = pickle.load(f)
+    if saved['grid'] != cache.get_grid_key():
+        raise ValueError('Dirway cache was saved for another grid')
+    cache.node_sets = saved['node_sets']
+    return cache
 
 
 def get_observations_at_time(voyages, timestamp):
@@ -476,30 +985,78 @@ def get_observations_at_time(voyages, timestamp):
     return pd.DataFrame(data=test_voyages, columns=columns)
 
 
-def predict_routes(observations, grid, graph, avg_speeds, dirways, shallow_graph, print_params=True):
+# dirways can be a DataFrame, a DirwayCache or DirwayMasks. With cost_fields (see cost_fields.py)
+# the route is read from the cost field of the destination instead of searched.
+# With route_cache (see route_cache.py) found paths are reused for the same
+# start and end nodes. With hierarchy (see contraction.py) the route is read
+# from a contraction hierarchy built for graph, which needs use_dirways and
+# use_turn_penalty to be off.
+def predict_route(observation, grid, graph, avg_speeds, dirways, shallow_graph, landmarks=None, cost_fields=None, route_cache=None, search_area=None, stats=None, hierarchy=None):
+    dirway_graph = None
+    dirway_key = None
+    if graph.use_dirways:
+        if isinstance(dirways, (DirwayCache, DirwayMasks)):
+            dirway_graph = dirways.get_nodes(observation.ata)
+            dirway_key = dirways.get_key(observation.ata)
+        else:
+            active_dirways = dirways.loc[(dirways.publishtime < observation.ata) & (
+                observation.ata <= dirways.deletetime)]
+            dirway_graph = create_dirways_graph(active_dirways, grid)
+
+    start_coords = [observation.lat, observation.lon]
+    start_time = pd.to_datetime(observation.timestamp)
+
+    end_coords = [observation.end_lat, observation.end_lon]
+
+    if cost_fields is not None:
+        return cost_fields.route(start_coords, end_coords, avg_speeds, observation.speed, observation.vessel_type,
+                                 dirway_graph, observation.mmsi, observation.voyage, start_time, dirway_key)
+
+    if hierarchy is not None:
+        hierarchy.check_graph(graph)
+        return hierarchy.route(start_coords, end_coords, avg_speeds, observation.speed, observation.vessel_type, grid,
+                               observation.mmsi, observation.voyage, start_time)
+
+    if route_cache is not None:
+        return route_cache.route(graph, start_coords, end_coords, avg_speeds, observation.speed, observation.course, observation.vessel_type,
+                                 grid, dirway_graph, shallow_graph, observation.mmsi, observation.voyage, start_time, landmarks, dirway_key,
+                                 search_area, stats)
+
+    return a_star_heap(graph, start_coords, end_coords, avg_speeds, observation.speed, observation.course,
+                       observation.vessel_type, grid, dirway_graph, shallow_graph, observation.mmsi, observation.voyage, start_time, landmarks,
+                       search_area, stats)
+
+
+# Search areas are collected as rows of [lat, lon, voyage, g, h, f], search_area=False
+# skips them when only the routes are needed.
+# With stats (a BatchStats, see instrumentation.py) every query is counted and timed.
+# hierarchy is passed on to predict_route, hierarchy routes have no search area.
+def predict_routes(observations, grid, graph, avg_speeds, dirways, shallow_graph, print_params=True, landmarks=None, cost_fields=None, route_cache=None, search_area=True, stats=None, hierarchy=None):
     if print_params:
         graph.print_parameters()
         grid.print_parameters()
 
+    if graph.use_shallow_penalty:
+        shallow_graph = as_layer(shallow_graph, grid.get_node_count())
+    if graph.use_dirways and not isinstance(dirways, DirwayCache):
+        dirways = DirwayCache(dirways, grid)
+
     routes = []
     errors = []
     search_areas = []
     for i, observation in observations.iterrows():
-        dirway_graph = None
-        if graph.use_dirways:
-            active_dirways = dirways.loc[(dirways.publishtime < observation.ata) & (
-                observation.ata <= dirways.deletetime)]
-            dirway_graph = create_dirways_graph(active_dirways, grid)
-
-        start_coords = [observation.lat, observation.lon]
-        start_time = pd.to_datetime(observation.timestamp)
-
-        end_coords = [observation.end_lat, observation.end_lon]
-
-        route = a_star(graph, start_coords, end_coords, avg_speeds, observation.speed, observation.course,
-                       observation.vessel_type, grid, dirway_graph, shallow_graph, observation.mmsi, observation.voyage, start_time)
+        query_stats = None
+        if stats is not None:
+            query_stats = stats.new_query(observation.voyage)
+            query_stats.start()
+        route = predict_route(observation, grid, graph, avg_speeds,
+                              dirways, shallow_graph, landmarks, cost_fields, route_cache, 'rows' if search_area else None,
+                              query_stats, hierarchy)
+        if query_stats is not None:
+            query_stats.finish(route is not None)
         if route is None:
-            errors.append([start_coords,  end_coords])
+            errors.append([[observation.lat, observation.lon], [
+                          observation.end_lat, observation.end_lon]])
         else:
             routes.extend(route[0])
             search_areas.extend(route[1])
@@ -507,6 +1064,10 @@ def predict_routes(observations, grid, graph, avg_speeds, dirways, shallow_graph
     if print_params:
         print('Error count=', len(errors))
         print(errors)
+        if route_cache is not None:
+            route_cache.print_stats()
+        if stats is not None:
+            stats.print_summary()
     return [routes, search_areas]
 
 
@@ -514,137 +1075,195 @@ def predict_routes(observations, grid, graph, avg_speeds, dirways, shallow_graph
 
 def calculate_timestamps(routes):
     routes.sort_values(by=['voyage', 'number'], inplace=True)
-    routes['timestamp'] = -1
-    routes = routes.groupby('voyage')
+    routes = routes.reset_index(drop=True)
+    voyages = routes.groupby('voyage', sort=False)
 
-    test = []
-    for voyage, route in routes:
-        route = route.reset_index(drop=True)
-        for i, current in route.iterrows():
-            timestamp = None
+    # Speed of a point is the average of its own and the previous averaged speed
+    speeds = voyages.speed.transform(
+        lambda speed: speed.ewm(alpha=0.5, adjust=False).mean()).values
+    prev_lat = voyages.lat.shift(1).values
+    prev_lon = voyages.lon.shift(1).values
 
-            if i == 0:
-                timestamp = current.start_time
-            else:
-                current.speed = (prev.speed+current.speed) / 2
-                timestamp = calculate_time([prev.lat, prev.lon], [
-                                           current.lat, current.lon], current.speed, prev.timestamp)
+    # Segment durations rounded to microseconds like datetime.timedelta
+    distances = geodesy.distance_km(prev_lat, prev_lon, routes.lat.values, routes.lon.values) * 1000
+    microseconds = np.round(distances / speeds * 1e6)
+    microseconds = pd.Series(np.where(np.isnan(prev_lat), 0, microseconds).astype(np.int64))
+    elapsed = pd.to_timedelta(microseconds.groupby(routes.voyage.values, sort=False).cumsum().values, unit='us')
+    start_times = pd.to_datetime(voyages.start_time.transform('first'))
 
-            current.timestamp = timestamp
-            prev = current
-            test.append(current.values)
+    predicted = routes[['lat', 'lon', 'node', 'speed', 'mmsi', 'voyage', 'start_time', 'number']].copy()
+    predicted['speed'] = speeds
+    predicted['timestamp'] = start_times + elapsed
+    return predicted
 
-    return pd.DataFrame(data=test, columns=['lat', 'lon', 'node', 'speed', 'mmsi', 'voyage', 'start_time', 'number', 'timestamp'])
 
+ACCURACY_COLUMNS = ['voyage', 'vessel_type', 'end_port', 'end_port_sea_area', 'start_time', 'pred_time', 'mins_to_future', 'actual_lat', 'actual_lon', 'pred_lat',
+                    'pred_lon', 'actual_speed', 'pred_speed', 'acc_distance_nm', 'error_rate_lat', 'error_rate_lon', 'error_rate_speed', 'correct_node']
 
-def test_accuracy(grid, predicted, voyages, minutes_forward=None):
+
+# Predicted points in route order with the route start and end time on every row
+def get_route_points(predicted):
     predicted.sort_values(by=['voyage', 'number'], inplace=True)
-    predicted = predicted.groupby('voyage')
-    results = []
-    errors = []
-    for voyage, pred_route in predicted:
-        start_row = pred_route.head(1).iloc[0]
-        end_row = pred_route.tail(1).iloc[0]
-        actual_route = voyages.loc[(voyages['voyage'] == voyage) & (
-            voyages['timestamp'] >= start_row.start_time) & (voyages['timestamp'] <= end_row.timestamp)]
-        pred_route.sort_values(by=['timestamp'], inplace=True)
-        pred_route = pred_route.reset_index(drop=True)
-
-        for i, obs in actual_route.iterrows():
-            try:
-                if minutes_forward is not None and pd.to_datetime(obs.timestamp) > (pd.to_datetime(start_row.start_time) + datetime.timedelta(minutes=minutes_forward)):
-                    break
-                next = pred_route.loc[pred_route['timestamp']
-                                      > obs.timestamp].head(1).iloc[0]
-                next_index = next.name
-                pred_pos = None
-                pred_speed = None
-                if int(next_index) is 0:
-                    pred_pos = [pred_route.head(
-                        1).iloc[0].lat, pred_route.head(1).iloc[0].lon]
-                    pred_speed = pred_route.head(1).iloc[0].speed
-                else:
-                    prev = pred_route.loc[next_index-1]
-                    pred_speed = (prev.speed + next.speed) / 2
-                    pred_pos = interpolate_to_time([prev.lat, prev.lon], [
-                                                   next.lat, next.lon], pred_speed, prev.timestamp, obs.timestamp)
-
-                mins_to_future = (pd.to_datetime(
-                    obs.timestamp) - pd.to_datetime(start_row.start_time)).total_seconds() / 60.0
-
-                acc_measures = measure_accuracy(
-                    grid, [obs.lat, obs.lon], pred_pos, pred_speed, obs.speed)
-                result = [voyage, obs.vessel_type, obs.end_port, obs.end_port_sea_area, start_row.start_time,
-                          obs.timestamp, mins_to_future, obs.lat, obs.lon, pred_pos[0], pred_pos[1], obs.speed, pred_speed]
-                result.extend(acc_measures)
-                results.append(result)
-            except IndexError:
-                errors.append(obs)
-                continue
+    points = predicted.reset_index(drop=True)
+    points['timestamp'] = pd.to_datetime(
+        points.timestamp).astype('datetime64[ns]')
+    routes = points.groupby('voyage', sort=False)
+    points['route_start'] = pd.to_datetime(routes.start_time.transform(
+        'first')).astype('datetime64[ns]')
+    points['route_end'] = routes.timestamp.transform('last')
+    points['first'] = routes.cumcount() == 0
+    points['position'] = np.arange(len(points))
+    return points
+
+
+# Actual observations between the start and the end of the predicted route, in voyages order
+def get_route_observations(points, voyages):
+    routes = points.groupby('voyage', sort=False)[
+        ['route_start', 'route_end']].first()
+    actual = voyages.assign(order=np.arange(len(voyages))).join(
+        routes, on='voyage', how='inner')
+    actual['timestamp'] = pd.to_datetime(
+        actual.timestamp).astype('datetime64[ns]')
+    actual = actual.loc[(actual.timestamp >= actual.route_start)
+                        & (actual.timestamp <= actual.route_end)]
+    return actual.sort_values(by='order')
+
+
+# Drop observations from the first one after minutes_forward onwards within each group
+def drop_after_minutes(actual, minutes_forward, by):
+    if minutes_forward is None:
+        return actual
+    late = actual.timestamp > actual.route_start + \
+        datetime.timedelta(minutes=minutes_forward)
+    return actual.loc[~late.groupby(by).cummax()]
+
+
+def get_accuracy_results(grid, voyage, actual, start_time, pred_time, real_lat, real_lon, pred_lat, pred_lon, actual_speed, pred_speed):
+    mins_to_future = (pred_time - start_time).dt.total_seconds().values / 60.0
+    results = pd.DataFrame({
+        'voyage': voyage,
+        'vessel_type': actual.vessel_type.values,
+        'end_port': actual.end_port.values,
+        'end_port_sea_area': actual.end_port_sea_area.values,
+        'start_time': start_time.values,
+        'pred_time': pred_time.values,
+        'mins_to_future': mins_to_future,
+        'actual_lat': real_lat,
+        'actual_lon': real_lon,
+        'pred_lat': pred_lat,
+        'pred_lon': pred_lon,
+        'actual_speed': actual_speed,
+        'pred_speed': pred_speed,
+    })
+    acc_measures = get_accuracy_measures(
+        grid, real_lat, real_lon, pred_lat, pred_lon, pred_speed, actual_speed)
+    for column, values in zip(ACCURACY_COLUMNS[-5:], acc_measures):
+        results[column] = values
+    return results
 
-    print('error count=', len(errors))
-    columns = ['voyage', 'vessel_type', 'end_port', 'end_port_sea_area', 'start_time', 'pred_time', 'mins_to_future', 'actual_lat', 'actual_lon', 'pred_lat',
-               'pred_lon', 'actual_speed', 'pred_speed', 'acc_distance_nm', 'error_rate_lat', 'error_rate_lon', 'error_rate_speed', 'correct_node']
-    return pd.DataFrame(data=results, columns=columns)
 
+def test_accuracy(grid, predicted, voyages, minutes_forward=None):
+    points = get_route_points(predicted)
+    actual = get_route_observations(points, voyages)
+    actual = drop_after_minutes(actual, minutes_forward, actual.voyage)
+
+    # First predicted point after each observation
+    pairs = pd.merge_asof(actual.sort_values(by='timestamp', kind='mergesort'),
+                          points[['timestamp', 'voyage', 'position']].sort_values(
+                              by='timestamp', kind='mergesort'),
+                          on='timestamp', by='voyage', direction='forward', allow_exact_matches=False)
+    pairs = pairs.sort_values(by=['voyage', 'order'])
+    errors = pairs.loc[pairs.position.isna()]
+    pairs = pairs.loc[pairs.position.notna()]
+
+    next_i = pairs.position.values.astype(np.int64)
+    first = points['first'].values[next_i]
+    prev_i = np.where(first, next_i, next_i - 1)
+    lats = points.lat.values
+    lons = points.lon.values
+    speeds = points.speed.values
+
+    # Before the first predicted point the prediction is the first point itself
+    pred_speed = np.where(
+        first, speeds[next_i], (speeds[prev_i] + speeds[next_i]) / 2)
+    seconds = (pairs.timestamp.values -
+               points.timestamp.values[prev_i]) / np.timedelta64(1, 's')
+    pred_lat, pred_lon = geodesy.interpolate_to_time(
+        lats[prev_i], lons[prev_i], lats[next_i], lons[next_i], pred_speed, seconds)
+    pred_lat = np.where(first, lats[next_i], pred_lat)
+    pred_lon = np.where(first, lons[next_i], pred_lon)
+
+    results = get_accuracy_results(grid, pairs.voyage.values, pairs, pairs.route_start, pairs.timestamp,
+                                   pairs.lat.values, pairs.lon.values, pred_lat, pred_lon, pairs.speed.values, pred_speed)
 
-def test_accuracy_to_end(grid, predicted, voyages, minutes_forward=None):
-    predicted.sort_values(by=['voyage', 'number'], inplace=True)
-    predicted = predicted.groupby('voyage')
-    results = []
-    errors = []
-    for voyage, pred_route in predicted:
-        start_row = pred_route.head(1).iloc[0]
-        end_row = pred_route.tail(1).iloc[0]
-        actual_route = voyages.loc[(voyages['voyage'] == voyage) & (
-            voyages['timestamp'] >= start_row.start_time) & (voyages['timestamp'] <= end_row.timestamp)]
-        actual_end = actual_route.tail(1).iloc[0]
-        pred_route.sort_values(by=['timestamp'], inplace=True)
-        pred_route = pred_route.reset_index(drop=True)
-        prev = None
-        last = None
-        for i, next in pred_route.iterrows():
-            last = next
-            if prev is None:
-                prev = next
-                continue
+    print('error count=', len(errors))
+    return results[ACCURACY_COLUMNS].reset_index(drop=True)
 
-            observations_between_preds = actual_route.loc[(
-                actual_route['timestamp'] >= prev.timestamp) & (actual_route['timestamp'] < next.timestamp)]
-            pred_speed = (prev.speed + next.speed) / 2
-
-            if actual_end.ata < next.timestamp:
-                mins_to_future = (pd.to_datetime(
-                    next.timestamp) - pd.to_datetime(start_row.start_time)).total_seconds() / 60.0
-                acc_measures = measure_accuracy(grid, [actual_end.lat, actual_end.lon], [
-                                                next.lat, next.lon], pred_speed, actual_end.speed)
-                result = [voyage, actual_end.vessel_type, actual_end.end_port, actual_end.end_port_sea_area, start_row.start_time, next.timestamp, mins_to_future,
-                          actual_end.lat, actual_end.lon, next.lat, next.lon, actual_end.speed, pred_speed]
-                result.extend(acc_measures)
-                results.append(result)
-                prev = next
-                continue
 
-            for j, obs in observations_between_preds.iterrows():
-                if minutes_forward is not None and pd.to_datetime(obs.timestamp) > (pd.to_datetime(start_row.start_time) + datetime.timedelta(minutes=minutes_forward)):
-                    break
-                pred_pos = interpolate_to_time([prev.lat, prev.lon], [
-                                               next.lat, next.lon], pred_speed, prev.timestamp, obs.timestamp)
-                mins_to_future = (pd.to_datetime(
-                    obs.timestamp) - pd.to_datetime(start_row.start_time)).total_seconds() / 60.0
-                acc_measures = measure_accuracy(
-                    grid, [obs.lat, obs.lon], pred_pos, pred_speed, obs.speed)
-                result = [voyage, obs.vessel_type, obs.end_port, obs.end_port_sea_area, start_row.start_time,
-                          obs.timestamp, mins_to_future, obs.lat, obs.lon, pred_pos[0], pred_pos[1], obs.speed, pred_speed]
-                result.extend(acc_measures)
-                results.append(result)
-
-            prev = next
+def test_accuracy_to_end(grid, predicted, voyages, minutes_forward=None):
+    points = get_route_points(predicted)
+    actual = get_route_observations(points, voyages)
+    actual_end = actual.groupby('voyage', sort=False).tail(1)
+    actual_ata = pd.to_datetime(actual_end.set_index('voyage').ata).astype('datetime64[ns]')
+
+    lats = points.lat.values
+    lons = points.lon.values
+    speeds = points.speed.values
+    timestamps = points.timestamp.values
+
+    # Segments between consecutive predicted points, identified by the later point.
+    # Segments ending after the vessel arrived are compared to the last observation.
+    segments = points.loc[~points['first']].join(
+        actual_end.set_index('voyage'), on='voyage', how='inner', rsuffix='_actual')
+    after_arrival = pd.to_datetime(segments.ata).astype(
+        'datetime64[ns]') < segments.timestamp
+    ended = segments.loc[after_arrival]
+    next_i = ended.position.values
+    pred_speed = (speeds[next_i - 1] + speeds[next_i]) / 2
+    end_results = get_accuracy_results(grid, ended.voyage.values, ended, ended.route_start, ended.timestamp,
+                                       ended.lat_actual.values, ended.lon_actual.values, lats[next_i], lons[next_i],
+                                       ended.speed_actual.values, pred_speed)
+    end_results['segment'] = next_i
+    end_results['order'] = -1
+
+    # Other segments are compared to the observations within [prev.timestamp, next.timestamp)
+    pairs = pd.merge_asof(actual.sort_values(by='timestamp', kind='mergesort'),
+                          points[['timestamp', 'voyage', 'position']].sort_values(
+                              by='timestamp', kind='mergesort'),
+                          on='timestamp', by='voyage', direction='backward')
+    # Observations before the first predicted point of their voyage
+    errors = pairs.loc[pairs.position.isna()]
+    pairs = pairs.loc[pairs.position.notna()]
+    prev_i = pairs.position.values.astype(np.int64)
+    next_i = prev_i + 1
+    has_next = next_i < len(points)
+    has_next[has_next] = ~points['first'].values[next_i[has_next]]
+    pairs = pairs.loc[has_next]
+    prev_i = prev_i[has_next]
+    next_i = next_i[has_next]
+
+    in_segment = ~(actual_ata.reindex(pairs.voyage.values).values < timestamps[next_i])
+    pairs = pairs.loc[in_segment].assign(segment=next_i[in_segment])
+    pairs = drop_after_minutes(pairs.sort_values(
+        by='order'), minutes_forward, [pairs.voyage, pairs.segment])
+    prev_i = pairs.segment.values - 1
+    next_i = pairs.segment.values
+
+    pred_speed = (speeds[prev_i] + speeds[next_i]) / 2
+    seconds = (pairs.timestamp.values -
+               timestamps[prev_i]) / np.timedelta64(1, 's')
+    pred_lat, pred_lon = geodesy.interpolate_to_time(
+        lats[prev_i], lons[prev_i], lats[next_i], lons[next_i], pred_speed, seconds)
+    obs_results = get_accuracy_results(grid, pairs.voyage.values, pairs, pairs.route_start, pairs.timestamp,
+                                       pairs.lat.values, pairs.lon.values, pred_lat, pred_lon, pairs.speed.values, pred_speed)
+    obs_results['segment'] = next_i
+    obs_results['order'] = pairs.order.values
+
+    results = pd.concat([end_results, obs_results], ignore_index=True)
+    results = results.sort_values(by=['segment', 'order'])
 
     print('error count=', len(errors))
-    columns = ['voyage', 'vessel_type', 'end_port', 'end_port_sea_area', 'start_time', 'pred_time', 'mins_to_future', 'actual_lat', 'actual_lon', 'pred_lat',
-               'pred_lon', 'actual_speed', 'pred_speed', 'acc_distance_nm', 'error_rate_lat', 'error_rate_lon', 'error_rate_speed', 'correct_node']
-    return pd.DataFrame(data=results, columns=columns)
+    return results[ACCURACY_COLUMNS].reset_index(drop=True)
 
 
 def plot_intervals(results, col_x, col_y, interval):
@@ -0,0 +1,179 @@
+import numpy as np
+import pandas as pd
+import shapely.geometry
+import shapely.prepared
+from shapely.ops import unary_union
+from . import geodesy
+
+# Area and data sizes of the synthetic datasets. The area is width_km x height_km
+# from the south west corner, in the Archipelago Sea like the real data.
+# Node ids are row * len(rows) + col, so the areas must not be wider than they
+# are tall or cells in different rows get the same id.
+SCALES = {
+    'tiny': {'side_length': 10000, 'width_km': 80, 'height_km': 120, 'islands': 3, 'ports': 4,
+             'vessels': 8, 'dirways': 3, 'queries': 8},
+    'small': {'side_length': 5000, 'width_km': 150, 'height_km': 200, 'islands': 8, 'ports': 6,
+              'vessels': 30, 'dirways': 6, 'queries': 30},
+    'medium': {'side_length': 5000, 'width_km': 300, 'height_km': 400, 'islands': 20, 'ports': 10,
+               'vessels': 100, 'dirways': 12, 'queries': 100},
+    'large': {'side_length': 2500, 'width_km': 450, 'height_km': 600, 'islands': 40, 'ports': 16,
+              'vessels': 300, 'dirways': 20, 'queries': 300},
+}
+SOUTH_WEST = (19.5, 59.3)
+START_TIME = pd.Timestamp('2019-01-01')
+VESSEL_TYPES = [60, 70, 80, 90]
+AIS_INTERVAL_MINUTES = 5
+PORT_STOP_COUNT = 6
+
+
+# Corners of the area as shapely points (x=lon, y=lat) for area_to_grid
+def get_area(width_km, height_km, south_west=SOUTH_WEST):
+    north, _ = geodesy.destination(south_west[1], south_west[0], 0, height_km)
+    _, east = geodesy.destination(south_west[1], south_west[0], 90, width_km)
+    return shapely.geometry.Point(float(east), float(north)), shapely.geometry.Point(*south_west)
+
+
+# Node ids of all grid cells, fails when two cells share an id
+def get_cell_nodes(grid):
+    rows, cols = np.meshgrid(np.arange(len(grid.rows) - 1), np.arange(len(grid.cols) - 1), indexing='ij')
+    nodes = grid.get_node_index(rows.ravel(), cols.ravel())
+    assert len(np.unique(nodes)) == len(nodes), \
+        'Grid has ' + str(len(grid.cols)) + ' columns and ' + str(len(grid.rows)) + ' rows, node ids are not unique'
+    return nodes
+
+
+def random_positions(rng, north_east, south_west, count, margin=0.1):
+    lon_span = north_east.x - south_west.x
+    lat_span = north_east.y - south_west.y
+    lats = south_west.y + lat_span * rng.uniform(margin, 1 - margin, count)
+    lons = south_west.x + lon_span * rng.uniform(margin, 1 - margin, count)
+    return lats, lons
+
+
+# Islands as lat/lon polygons, a few grid cells across so create_sea_graph drops cells
+def generate_land(rng, north_east, south_west, count, side_length):
+    islands = []
+    lats, lons = random_positions(rng, north_east, south_west, count)
+    for lat, lon in zip(lats, lons):
+        radius_km = side_length / 1000 * rng.uniform(1.5, 3.5)
+        bearings = np.sort(rng.uniform(0, 360, 8))
+        distances = radius_km * rng.uniform(0.7, 1.0, 8)
+        corner_lats, corner_lons = geodesy.destination(lat, lon, bearings, distances)
+        islands.append(shapely.geometry.Polygon(zip(corner_lons, corner_lats)))
+    return unary_union(islands)
+
+
+# Ports on open water, at least two cells away from land and from each other
+def generate_ports(rng, north_east, south_west, count, land, side_length):
+    min_km = 2 * side_length / 1000
+    ports = []
+    while len(ports) < count:
+        lats, lons = random_positions(rng, north_east, south_west, 1)
+        lat, lon = float(lats[0]), float(lons[0])
+        point = shapely.geometry.Point(lon, lat)
+        if land is not None and land.distance(point) * 111 < min_km:
+            continue
+        if any(geodesy.distance_km(lat, lon, port[1], port[2]) < min_km for port in ports):
+            continue
+        ports.append([len(ports), lat, lon])
+    return pd.DataFrame(data=ports, columns=['port_id', 'lat', 'lon'])
+
+
+# Port id by grid node, like the ports argument of portcalls.calculate_voyages
+def get_port_nodes(grid, ports):
+    nodes = grid.get_grid_positions(ports.lat.values, ports.lon.values)
+    return {int(node): int(port_id) for node, port_id in zip(nodes, ports.port_id.values)}
+
+
+# AIS positions of vessels sailing between ports every AIS_INTERVAL_MINUTES.
+# Vessels stop in every port for PORT_STOP_COUNT positions. Returns the AIS
+# positions and the voyages (the positions between two ports) as DataFrames.
+def generate_ais(rng, grid, ports, vessel_count, start_time=START_TIME):
+    get_cell_nodes(grid)
+    ais = []
+    voyages = []
+    voyage = 0
+    interval = pd.Timedelta(minutes=AIS_INTERVAL_MINUTES)
+    port_lat = ports.lat.values
+    port_lon = ports.lon.values
+
+    for i in range(vessel_count):
+        mmsi = 230000000 + i
+        vessel_type = int(rng.choice(VESSEL_TYPES))
+        iceclass = int(rng.integers(0, 4))
+        time = start_time + pd.Timedelta(minutes=int(rng.integers(0, 12 * 60)))
+        port = int(rng.integers(0, len(ports)))
+
+        for leg in range(int(rng.integers(2, 5))):
+            next_port = int(rng.integers(0, len(ports) - 1))
+            if next_port >= port:
+                next_port += 1
+
+            for stop in range(PORT_STOP_COUNT):
+                ais.append([time, mmsi, port_lat[port], port_lon[port], 0.0, vessel_type, iceclass])
+                time += interval
+
+            speed = rng.uniform(4, 8)
+            distance = geodesy.distance_km(port_lat[port], port_lon[port], port_lat[next_port], port_lon[next_port])
+            steps = max(3, int(np.ceil(distance * 1000 / (speed * interval.total_seconds()))))
+            lats, lons = geodesy.interpolate(port_lat[port], port_lon[port], port_lat[next_port], port_lon[next_port],
+                                             distance * np.arange(1, steps) / steps)
+            lats = lats + rng.normal(0, 0.002, len(lats))
+            lons = lons + rng.normal(0, 0.004, len(lons))
+            speeds = np.clip(speed + rng.normal(0, 0.3, len(lats)), 1.5, None)
+            times = time + interval * np.arange(len(lats))
+            ata = times[-1] + interval
+
+            for lat, lon, obs_speed, obs_time in zip(lats, lons, speeds, times):
+                ais.append([obs_time, mmsi, lat, lon, obs_speed, vessel_type, iceclass])
+                voyages.append([voyage, mmsi, obs_time, lat, lon, obs_speed, vessel_type, iceclass, port, next_port,
+                                port_lat[next_port], port_lon[next_port], times[0] - interval, ata])
+            time = ata
+            port = next_port
+            voyage += 1
+
+        for stop in range(PORT_STOP_COUNT):
+            ais.append([time, mmsi, port_lat[port], port_lon[port], 0.0, vessel_type, iceclass])
+            time += interval
+
+    ais = pd.DataFrame(data=ais, columns=['timestamp', 'mmsi', 'lat', 'lon', 'speed', 'vessel_type', 'iceclass'])
+    ais['node'] = grid.get_grid_positions(ais.lat.values, ais.lon.values)
+    voyages = pd.DataFrame(data=voyages, columns=['voyage', 'mmsi', 'timestamp', 'lat', 'lon', 'speed', 'vessel_type', 'iceclass',
+                                                  'start_port', 'end_port', 'end_lat', 'end_lon', 'atd', 'ata'])
+    voyages['node'] = grid.get_grid_positions(voyages.lat.values, voyages.lon.values)
+    voyages['end_port_sea_area'] = 0
+    return ais, voyages
+
+
+# Dirways are lines between two random points, each active for a few days
+def generate_dirways(rng, north_east, south_west, count, start_time=START_TIME):
+    rows = []
+    for i in range(count):
+        lats, lons = random_positions(rng, north_east, south_west, 2)
+        publishtime = start_time + pd.Timedelta(days=int(rng.integers(-3, 1)))
+        deletetime = publishtime + pd.Timedelta(days=int(rng.integers(2, 6)))
+        for number in range(2):
+            rows.append([i, number, lats[number], lons[number], publishtime, deletetime, publishtime])
+    return pd.DataFrame(data=rows, columns=['id', 'number', 'lat', 'lon', 'publishtime', 'deletetime', 'createtime'])
+
+
+# Route queries like in the notebooks: the second position of every voyage with
+# the course from the first one
+def get_observations(voyages, count=None):
+    position = voyages.groupby('voyage', sort=False).cumcount()
+    observations = voyages.loc[position == 1].copy()
+    previous = voyages.loc[position == 0].set_index('voyage').reindex(observations.voyage.values)
+    observations['course'] = geodesy.bearing_deg(previous.lat.values, previous.lon.values,
+                                                 observations.lat.values, observations.lon.values)
+    if count is not None:
+        observations = observations.head(count)
+    return observations.reset_index(drop=True)
+
+
+# Nodes next to the islands, for the shallow water penalty
+def get_shallow_nodes(grid, land, side_length):
+    coast = shapely.prepared.prep(land.buffer(side_length / 1000 / 111).difference(land))
+    nodes = get_cell_nodes(grid)
+    lats, lons = grid.extract_coords_lat_lon_batch(nodes)
+    shallow = [coast.contains(shapely.geometry.Point(lon, lat)) for lat, lon in zip(lats, lons)]
+    return set(nodes[shallow].tolist())
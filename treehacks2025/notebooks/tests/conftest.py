@@ -0,0 +1,26 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# pygradu is imported from the notebooks directory, like in the notebooks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pygradu import gridify, synthetic  # noqa: E402
+
+
+# A 150 x 200 km area in 10 km cells, small enough for the loop versions
+@pytest.fixture(scope='session')
+def grid():
+    north_east, south_west = synthetic.get_area(150, 200)
+    return gridify.area_to_grid(north_east, south_west, 10000)
+
+
+# Manoeuvrability edges of grid with seeded random costs
+@pytest.fixture(scope='session')
+def edges(grid):
+    rng = np.random.default_rng(0)
+    edges = pd.DataFrame(data=gridify.create_area_graph(grid), columns=['original', 'connected'])
+    edges['cost'] = rng.uniform(0.1, 1.0, len(edges))
+    return edges
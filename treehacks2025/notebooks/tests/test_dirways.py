@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pygradu import shortest_path
+
+START_TIME = pd.Timestamp('2019-01-01')
+
+
+@pytest.fixture
+def dirways(grid):
+    rng = np.random.default_rng(0)
+    rows = []
+    for i in range(8):
+        published = START_TIME + pd.Timedelta(days=int(rng.integers(-5, 3)))
+        deleted = published + pd.Timedelta(days=int(rng.integers(1, 6)))
+        for number in range(2):
+            node = int(grid.get_node_index(rng.integers(0, len(grid.rows) - 1), rng.integers(0, len(grid.cols) - 1)))
+            lat, lon = grid.extract_coords_lat_lon(node)
+            rows.append(dict(id=i, number=number, lat=lat, lon=lon, publishtime=published, deletetime=deleted))
+    return pd.DataFrame(rows)
+
+
+# Masks of a batch give the same keys and node sets as the cache they were made from
+def test_masks_match_cache(grid, dirways):
+    cache = shortest_path.DirwayCache(dirways, grid)
+    times = pd.DatetimeIndex([START_TIME + pd.Timedelta(hours=h) for h in range(-7 * 24, 8 * 24, 5)] + [pd.NaT]).values
+    masks = cache.get_masks(times)
+    assert len(masks.masks) == len(set(cache.get_key(time) for time in times))
+    for time in times:
+        assert masks.get_key(time) == cache.get_key(time)
+        assert set(masks.get_nodes(time)) == set(cache.get_nodes(time))
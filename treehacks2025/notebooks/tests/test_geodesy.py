@@ -0,0 +1,151 @@
+import math
+import numpy as np
+import pandas as pd
+import pytest
+from pygradu import geodesy
+
+# Array results may differ from the math versions in the last bits
+DISTANCE_RTOL = 1e-12
+DEGREES_ATOL = 1e-9
+COUNT = 2000
+
+
+# The scalar math implementations that geodesy.py replaced
+def deg2rad(deg):
+    return deg * (math.pi / 180)
+
+
+def rad2deg(rad):
+    return rad * (180 / math.pi)
+
+
+def normalize(value, min, max):
+    if value < min:
+        return value + (max - min)
+    if value > max:
+        return value - (max - min)
+    return value
+
+
+def old_distance_km(coordinate1, coordinate2):
+    lat1 = deg2rad(coordinate1[0])
+    lat2 = deg2rad(coordinate2[0])
+    long1 = deg2rad(coordinate1[1])
+    long2 = deg2rad(coordinate2[1])
+
+    dLat = (lat2 - lat1)
+    dLon = (long2 - long1)
+    a = math.sin(dLat / 2) * math.sin(dLat / 2) + math.cos((lat1)) * \
+        math.cos((lat2)) * math.sin(dLon / 2) * math.sin(dLon / 2)
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return 6371.0 * c
+
+
+def old_bearing_deg(coordinate1, coordinate2):
+    lat1 = deg2rad(coordinate1[0])
+    lat2 = deg2rad(coordinate2[0])
+    long1 = deg2rad(coordinate1[1])
+    long2 = deg2rad(coordinate2[1])
+    dLon = (long2 - long1)
+
+    y = math.sin(dLon) * math.cos(lat2)
+    x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * \
+        math.cos(lat2) * math.cos(dLon)
+
+    bearing = math.atan2(y, x)
+    return normalize(rad2deg(bearing), 0.0, 360.0)
+
+
+def old_destination(latlon, bearing, distance):
+    bearing = deg2rad(bearing)
+    lat1 = deg2rad(latlon[0])
+    long1 = deg2rad(latlon[1])
+
+    lat2 = math.asin(math.sin(lat1) * math.cos(distance / 6371.0) +
+                     math.cos(lat1) * math.sin(distance / 6371.0) * math.cos(bearing))
+    long2 = long1 + math.atan2(math.sin(bearing) * math.sin(distance / 6371.0) * math.cos(
+        lat1), math.cos(distance / 6371.0) - math.sin(lat1) * math.sin(lat2))
+    return [rad2deg(lat2), rad2deg(long2)]
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    return {
+        'lat1': rng.uniform(-80, 80, COUNT),
+        'lon1': rng.uniform(-180, 180, COUNT),
+        'lat2': rng.uniform(-80, 80, COUNT),
+        'lon2': rng.uniform(-180, 180, COUNT),
+        'bearing': rng.uniform(0, 360, COUNT),
+        'distance': rng.uniform(0, 2000, COUNT),
+    }
+
+
+# Bearings near 0 and 360 are the same direction
+def assert_bearings_close(actual, expected):
+    difference = (np.asarray(actual) - np.asarray(expected) + 180) % 360 - 180
+    assert np.all(np.abs(difference) <= DEGREES_ATOL)
+
+
+def test_distance_km(points):
+    expected = [old_distance_km([a, b], [c, d]) for a, b, c, d in
+                zip(points['lat1'], points['lon1'], points['lat2'], points['lon2'])]
+    actual = geodesy.distance_km(points['lat1'], points['lon1'], points['lat2'], points['lon2'])
+    np.testing.assert_allclose(actual, expected, rtol=DISTANCE_RTOL)
+
+    scalar = [geodesy.point_distance_km([a, b], [c, d]) for a, b, c, d in
+              zip(points['lat1'], points['lon1'], points['lat2'], points['lon2'])]
+    np.testing.assert_allclose(scalar, expected, rtol=DISTANCE_RTOL)
+
+
+def test_bearing_deg(points):
+    expected = [old_bearing_deg([a, b], [c, d]) for a, b, c, d in
+                zip(points['lat1'], points['lon1'], points['lat2'], points['lon2'])]
+    actual = geodesy.bearing_deg(points['lat1'], points['lon1'], points['lat2'], points['lon2'])
+    assert np.all((actual >= 0) & (actual < 360))
+    assert_bearings_close(actual, expected)
+
+    scalar = [geodesy.point_bearing_deg([a, b], [c, d]) for a, b, c, d in
+              zip(points['lat1'], points['lon1'], points['lat2'], points['lon2'])]
+    assert_bearings_close(scalar, expected)
+
+
+def test_destination(points):
+    expected = np.array([old_destination([a, b], c, d) for a, b, c, d in
+                         zip(points['lat1'], points['lon1'], points['bearing'], points['distance'])])
+    lat, lon = geodesy.destination(points['lat1'], points['lon1'], points['bearing'], points['distance'])
+    np.testing.assert_allclose(lat, expected[:, 0], atol=DEGREES_ATOL)
+    np.testing.assert_allclose(lon, expected[:, 1], atol=DEGREES_ATOL)
+
+    scalar = np.array([geodesy.point_destination([a, b], c, d) for a, b, c, d in
+                       zip(points['lat1'], points['lon1'], points['bearing'], points['distance'])])
+    np.testing.assert_allclose(scalar, expected, atol=DEGREES_ATOL)
+
+
+def test_interpolate_to_time(points):
+    speed = 6.0
+    seconds = points['distance'] * 1000 / speed
+    expected = np.array([old_destination([a, b], old_bearing_deg([a, b], [c, d]), e) for a, b, c, d, e in
+                         zip(points['lat1'], points['lon1'], points['lat2'], points['lon2'], points['distance'])])
+    lat, lon = geodesy.interpolate_to_time(points['lat1'], points['lon1'], points['lat2'], points['lon2'],
+                                           speed, seconds)
+    np.testing.assert_allclose(lat, expected[:, 0], atol=DEGREES_ATOL)
+    np.testing.assert_allclose(lon, expected[:, 1], atol=DEGREES_ATOL)
+
+
+def test_pandas_columns_and_scalars(points):
+    frame = pd.DataFrame(points)
+    from_columns = geodesy.distance_km(frame.lat1, frame.lon1, frame.lat2, frame.lon2)
+    from_arrays = geodesy.distance_km(points['lat1'], points['lon1'], points['lat2'], points['lon2'])
+    np.testing.assert_array_equal(np.asarray(from_columns), from_arrays)
+
+    bearing = geodesy.bearing_deg(60.0, 20.0, 61.0, 21.0)
+    assert np.ndim(bearing) == 0
+    assert_bearings_close(bearing, old_bearing_deg([60.0, 20.0], [61.0, 21.0]))
+
+
+def test_segment_distances_km(points):
+    lat = points['lat1'][:50]
+    lon = points['lon1'][:50]
+    expected = [old_distance_km([lat[i], lon[i]], [lat[i + 1], lon[i + 1]]) for i in range(len(lat) - 1)]
+    np.testing.assert_allclose(geodesy.segment_distances_km(lat, lon), expected, rtol=DISTANCE_RTOL)
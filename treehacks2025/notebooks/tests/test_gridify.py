@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pygradu import gridify, synthetic
+
+
+@pytest.fixture(scope='module')
+def ais(grid):
+    rng = np.random.default_rng(0)
+    north_east, south_west = synthetic.get_area(150, 200)
+    ports = synthetic.generate_ports(rng, north_east, south_west, 5, None, grid.side_length)
+    return synthetic.generate_ais(rng, grid, ports, 12)[0]
+
+
+# The cell loop of create_area_graph / create_sea_graph before vectorizing
+def loop_grid_edges(grid, adjacent=False, cells=None):
+    graph = []
+    for row in range(len(grid.rows) - 1):
+        for col in range(len(grid.cols) - 1):
+            if cells is not None and not cells[row, col]:
+                continue
+            node = grid.get_node_index(row, col)
+            if adjacent:
+                neighbours = grid.get_neighbours_adjacent(row, col)
+            else:
+                neighbours = grid.get_neighbours_with_maneuvaribility(row, col)
+            for n in neighbours:
+                graph.append([node, grid.get_node_index(n[0], n[1])])
+    return np.array(graph, dtype=np.int64).reshape(-1, 2)
+
+
+@pytest.mark.parametrize('adjacent', [True, False])
+@pytest.mark.parametrize('block_size', [2**22, 100])
+def test_grid_edges_match_loop(grid, adjacent, block_size):
+    edges = gridify.create_grid_edges(grid, adjacent, block_size=block_size)
+    np.testing.assert_array_equal(edges, loop_grid_edges(grid, adjacent))
+
+
+@pytest.mark.parametrize('adjacent', [True, False])
+def test_grid_edges_with_cells_match_loop(grid, adjacent):
+    rng = np.random.default_rng(0)
+    cells = rng.random((len(grid.rows) - 1, len(grid.cols) - 1)) < 0.7
+    edges = gridify.create_grid_edges(grid, adjacent, cells=cells, block_size=100)
+    np.testing.assert_array_equal(edges, loop_grid_edges(grid, adjacent, cells))
+
+
+def test_uniform_index_matches_searchsorted(grid):
+    rng = np.random.default_rng(0)
+    for values in (grid.rows, grid.cols, np.linspace(-3.5, 7.25, 11)):
+        span = values[-1] - values[0]
+        v = np.concatenate([
+            rng.uniform(values[0] - span / 4, values[-1] + span / 4, 5000),
+            values, np.nextafter(values, np.inf), np.nextafter(values, -np.inf), [np.nan, np.inf, -np.inf]])
+        np.testing.assert_array_equal(gridify.get_uniform_index(values, v), np.searchsorted(values, v))
+
+
+def test_grid_positions_match_searchsorted(grid):
+    rng = np.random.default_rng(1)
+    x = rng.uniform(grid.cols[0] - 20000, grid.cols[-1] + 20000, 5000)
+    y = rng.uniform(grid.rows[0] - 20000, grid.rows[-1] + 20000, 5000)
+    rows = np.searchsorted(grid.rows, y) - 1
+    cols = np.searchsorted(grid.cols, x) - 1
+    inside = (rows >= 0) & (rows < len(grid.rows) - 1) & (cols >= 0) & (cols < len(grid.cols) - 1)
+    expected = np.where(inside, grid.get_node_index(rows, cols), -1)
+    np.testing.assert_array_equal(grid.get_grid_positions_xy(x, y), expected)
+
+
+# create_graph_from_ais_adjacent before vectorizing
+def loop_ais_transitions(ais):
+    ais = ais.reset_index(drop=True)
+    ais = ais.sort_values(by=['mmsi', 'timestamp'])
+    graph = []
+    for mmsi, observations in ais.groupby('mmsi'):
+        prev_node = observations.head(1).iloc[0].node
+        for i, obs in observations.iterrows():
+            if prev_node == obs.node:
+                continue
+            graph.append([prev_node, obs.node])
+            prev_node = obs.node
+    return np.array(graph, dtype=np.int64).reshape(-1, 2)
+
+
+def test_ais_transitions_match_loop(ais):
+    expected = loop_ais_transitions(ais)
+    assert len(expected) > 0
+    np.testing.assert_array_equal(gridify.create_graph_from_ais_adjacent(ais), expected)
+
+
+# Chunks give the same transitions, grouped by chunk instead of by vessel
+def test_ais_transitions_from_chunks(ais):
+    ais = ais.sort_values('timestamp')
+    chunks = [ais.iloc[start:start + 97] for start in range(0, len(ais), 97)]
+    transitions = gridify.create_graph_from_ais_adjacent(iter(chunks))
+    expected = loop_ais_transitions(ais)
+    np.testing.assert_array_equal(np.unique(transitions, axis=0, return_counts=True)[1],
+                                  np.unique(expected, axis=0, return_counts=True)[1])
+    np.testing.assert_array_equal(np.unique(transitions, axis=0), np.unique(expected, axis=0))
+
+
+# create_graph_from_ais_maneuvaribility before the sliding window
+def loop_ais_maneuvaribility(grid, ais, minutes_forward=45):
+    ais = ais.reset_index(drop=True)
+    ais = ais.sort_values(by=['mmsi', 'timestamp'])
+    graph = []
+    for mmsi, observations in ais.groupby('mmsi'):
+        observations = observations.set_index('timestamp')
+        node = None
+        for i, obs in observations.iterrows():
+            if node == obs.node:
+                continue
+            node = obs.node
+            coords = grid.extract_coords(node)
+            neighbours = grid.get_neighbours_nodes_with_maneuvaribility(coords[0], coords[1])
+            time_window = observations.loc[obs.name:obs.name + pd.Timedelta(minutes=minutes_forward)]
+            future_nodes = set(time_window.node.unique())
+            for neighbour in neighbours:
+                if neighbour in future_nodes:
+                    graph.append([node, neighbour])
+    return np.array(graph, dtype=np.int64).reshape(-1, 2)
+
+
+@pytest.mark.parametrize('block_size', [2**20, 500])
+@pytest.mark.parametrize('minutes_forward', [15, 45])
+def test_ais_maneuvaribility_matches_loop(grid, ais, block_size, minutes_forward):
+    expected = loop_ais_maneuvaribility(grid, ais, minutes_forward)
+    assert len(expected) > 0
+    edges = gridify.create_graph_from_ais_maneuvaribility(grid, ais, minutes_forward, block_size)
+    np.testing.assert_array_equal(edges, expected)
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from pygradu import landmarks, shortest_path
+
+
+@pytest.fixture(scope='module')
+def graph(grid, edges):
+    graph = shortest_path.df_to_graph(edges, grid.get_node_count())
+    graph.use_dirways = False
+    return graph
+
+
+# The bounds of all nodes at once never exceed the exact cost to the target
+def test_heuristic_is_a_lower_bound(graph):
+    tables = landmarks.build_landmark_tables(graph, landmarks.select_landmarks(graph, count=4))
+    matrix = csr_matrix((graph.costs, graph.indices, graph.indptr), shape=(graph.node_count, graph.node_count))
+    nodes = np.flatnonzero(np.diff(graph.indptr))
+    target = int(nodes[len(nodes) // 2])
+    costs = dijkstra(matrix.T.tocsr(), indices=target)[nodes]
+
+    bounds = tables.get_heuristic(target)(nodes)
+    assert bounds.shape == nodes.shape
+    assert np.all(bounds >= 0)
+    assert np.all(bounds <= costs + 1e-6)
+    assert bounds[nodes == target][0] == 0
+
+
+def test_heuristic_is_zero_outside_the_tables(graph):
+    tables = landmarks.build_landmark_tables(graph, landmarks.select_landmarks(graph, count=2))
+    assert np.all(tables.get_heuristic(-1)(np.array([0, 1])) == 0)
+    assert tables.get_heuristic(0)(np.array([graph.node_count]))[0] == 0
+
+
+# Ports on nodes without edges leave the farthest first selection to all nodes
+def test_select_landmarks_without_ports_on_edges(grid, graph):
+    ports = pd.DataFrame({'lat': [0.0], 'lon': [0.0]})
+    selected = landmarks.select_landmarks(graph, grid, ports, count=3)
+    assert len(selected) == 3
+    assert np.all(np.diff(graph.indptr)[selected] > 0)
+
+
+def test_select_landmarks_empty_graph(grid):
+    graph = shortest_path.df_to_graph(pd.DataFrame({'original': [], 'connected': [], 'cost': []}),
+                                      grid.get_node_count())
+    with pytest.raises(ValueError):
+        landmarks.select_landmarks(graph)
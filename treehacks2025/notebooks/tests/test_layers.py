@@ -0,0 +1,53 @@
+import pickle
+
+import numpy as np
+import pytest
+from pygradu import layers
+
+NODE_COUNT = 1000
+
+
+@pytest.fixture
+def node_sets():
+    rng = np.random.default_rng(0)
+    return (set(rng.integers(0, NODE_COUNT, 300).tolist()),
+            set(rng.integers(0, NODE_COUNT, 300).tolist()))
+
+
+def test_membership_matches_set(node_sets):
+    nodes, _ = node_sets
+    layer = layers.as_layer(nodes, NODE_COUNT)
+    for node in range(-5, NODE_COUNT + 5):
+        assert (node in layer) == (node in nodes)
+    assert len(layer) == len(nodes)
+    assert set(layer) == nodes
+
+
+def test_operators_match_set(node_sets):
+    a, b = node_sets
+    layer_a = layers.as_layer(a, NODE_COUNT)
+    layer_b = layers.as_layer(b, NODE_COUNT)
+    assert set(layer_a | layer_b) == a | b
+    assert set(layer_a & layer_b) == a & b
+    assert set(layer_a - layer_b) == a - b
+    assert set(~layer_a) == set(range(NODE_COUNT)) - a
+
+
+def test_out_of_range_nodes_are_dropped():
+    layer = layers.as_layer([-1, 3, NODE_COUNT], NODE_COUNT)
+    assert set(layer) == {3}
+
+
+def test_different_sizes_raise(node_sets):
+    a, _ = node_sets
+    with pytest.raises(ValueError):
+        layers.as_layer(a, NODE_COUNT) | layers.as_layer(a, NODE_COUNT + 1)
+
+
+def test_pickle_and_key(node_sets):
+    a, b = node_sets
+    layer = layers.as_layer(a, NODE_COUNT)
+    loaded = pickle.loads(pickle.dumps(layer))
+    assert set(loaded) == a
+    assert loaded.get_key() == layer.get_key()
+    assert layers.as_layer(b, NODE_COUNT).get_key() != layer.get_key()
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pygradu import route_cache, shortest_path
+
+START_TIME = pd.Timestamp('2019-01-01')
+
+
+@pytest.fixture
+def graph(grid, edges):
+    graph = shortest_path.df_to_graph(edges, grid.get_node_count())
+    graph.use_dirways = False
+    return graph
+
+
+def run_cached(cache, grid, graph, search_area, voyage=1):
+    start_latlon = grid.extract_coords_lat_lon(int(np.flatnonzero(np.diff(graph.indptr))[0]))
+    end_latlon = grid.extract_coords_lat_lon(int(np.flatnonzero(np.diff(graph.indptr))[-1]))
+    return route_cache.cached_a_star(cache, graph, start_latlon, end_latlon, {}, 8.0, 45.0, 70, grid, None, None,
+                                     1, voyage, START_TIME, search_area=search_area)
+
+
+# A hit returns the search area of the search that filled the entry, with the voyage of the query
+def test_hit_returns_search_area(grid, graph):
+    cache = route_cache.RouteCache()
+    route, area = run_cached(cache, grid, graph, 'rows')
+    hit_route, hit_area = run_cached(cache, grid, graph, 'rows', voyage=2)
+    assert cache.hits == 1
+    assert [row[2] for row in hit_route] == [row[2] for row in route]
+    assert len(hit_area) == len(area) > 0
+    assert [row[:2] + row[3:] for row in hit_area] == [row[:2] + row[3:] for row in area]
+    assert all(row[2] == 2 for row in hit_area)
+
+
+def test_entry_without_area_misses_area_query(grid, graph):
+    cache = route_cache.RouteCache()
+    run_cached(cache, grid, graph, None)
+    path_bytes = cache.bytes
+    route, area = run_cached(cache, grid, graph, 'arrays')
+    assert cache.hits == 0 and cache.misses == 2
+    assert cache.bytes == path_bytes + area.nodes.nbytes + area.g.nbytes + area.h.nbytes + area.f.nbytes
+    _, empty_area = run_cached(cache, grid, graph, None)
+    assert cache.hits == 1 and empty_area == []
+    cache.clear()
+    assert cache.bytes == 0
+
+
+def test_node_set_key_is_kept(grid):
+    cache = route_cache.RouteCache()
+    nodes = {1, 2, 3}
+    assert cache.get_nodes_key(nodes) == frozenset(nodes)
+    assert cache.get_nodes_key(nodes) is cache.get_nodes_key(nodes)
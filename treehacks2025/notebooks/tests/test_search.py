@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from pygradu import anytime, contraction, incremental, instrumentation, landmarks, shortest_path
+
+QUERY_COUNT = 12
+COST_RTOL = 1e-9
+START_TIME = pd.Timestamp('2019-01-01')
+
+
+@pytest.fixture(scope='module')
+def graph(grid, edges):
+    graph = shortest_path.df_to_graph(edges, grid.get_node_count())
+    graph.use_dirways = False
+    return graph
+
+
+# Start and end nodes with their cell centres and the Dijkstra cost between them
+@pytest.fixture(scope='module')
+def queries(grid, graph):
+    rng = np.random.default_rng(0)
+    nodes = rng.choice(np.flatnonzero(np.diff(graph.indptr)), (QUERY_COUNT, 2), replace=False)
+    matrix = csr_matrix((graph.costs, graph.indices, graph.indptr), shape=(graph.node_count, graph.node_count))
+    costs = dijkstra(matrix, indices=nodes[:, 0])[np.arange(QUERY_COUNT), nodes[:, 1]]
+    assert np.all(np.isfinite(costs))
+    return [(int(start), int(end), grid.extract_coords_lat_lon(start), grid.extract_coords_lat_lon(end), cost)
+            for (start, end), cost in zip(nodes, costs)]
+
+
+def get_path_cost(graph, route, start, end):
+    path = [row[2] for row in route]
+    assert path[0] == start and path[-1] == end
+    return sum(graph.get_edge_cost(a, b) for a, b in zip(path, path[1:]))
+
+
+def run_a_star(grid, graph, start_latlon, end_latlon, tables=None, stats=None):
+    return shortest_path.a_star_heap(graph, start_latlon, end_latlon, {}, 8.0, 45.0, 70, grid, None, None, 1, 1,
+                                     START_TIME, tables, 'arrays', stats)
+
+
+def test_a_star_heap_matches_dijkstra(grid, graph, queries):
+    for start, end, start_latlon, end_latlon, cost in queries:
+        route, _ = run_a_star(grid, graph, start_latlon, end_latlon)
+        assert get_path_cost(graph, route, start, end) == pytest.approx(cost, rel=COST_RTOL)
+
+
+def test_alt_matches_dijkstra(grid, graph, queries):
+    tables = landmarks.build_landmark_tables(graph, landmarks.select_landmarks(graph, count=4))
+    for start, end, start_latlon, end_latlon, cost in queries:
+        route, _ = run_a_star(grid, graph, start_latlon, end_latlon, tables)
+        assert get_path_cost(graph, route, start, end) == pytest.approx(cost, rel=COST_RTOL)
+
+
+def test_contraction_hierarchy_matches_dijkstra(graph, queries):
+    hierarchy = contraction.build_hierarchy(graph)
+    for start, end, start_latlon, end_latlon, cost in queries:
+        hierarchy_cost, path = hierarchy.query(start, end)
+        assert hierarchy_cost == pytest.approx(cost, rel=COST_RTOL)
+        assert path[0] == start and path[-1] == end
+        assert sum(graph.get_edge_cost(a, b) for a, b in zip(path, path[1:])) == pytest.approx(cost, rel=COST_RTOL)
+
+
+def test_d_star_lite_matches_dijkstra(grid, graph, queries):
+    for start, end, start_latlon, end_latlon, cost in queries:
+        planner = incremental.IncrementalPlanner(graph, grid, end_latlon)
+        route = planner.plan(start_latlon, {}, 8.0, 70, 1, 1, START_TIME)
+        assert get_path_cost(graph, route, start, end) == pytest.approx(cost, rel=COST_RTOL)
+
+
+def test_ara_star_matches_dijkstra(grid, graph, queries):
+    tables = landmarks.build_landmark_tables(graph, landmarks.select_landmarks(graph, count=4))
+    for start, end, start_latlon, end_latlon, cost in queries:
+        result = anytime.anytime_a_star(graph, start_latlon, end_latlon, {}, 8.0, 45.0, 70, grid, None, None, 1, 1,
+                                        START_TIME, tables, epsilon=2.0)
+        assert result.final
+        assert result.cost == pytest.approx(cost, rel=COST_RTOL)
+        assert get_path_cost(graph, result.route, start, end) == pytest.approx(cost, rel=COST_RTOL)
+
+
+# Counting does not change the route. The goal is expanded but not closed,
+# so it is counted once on top of the search area.
+def test_stats_do_not_change_routes(grid, graph, queries):
+    for start, end, start_latlon, end_latlon, cost in queries:
+        route, area = run_a_star(grid, graph, start_latlon, end_latlon)
+        stats = instrumentation.QueryStats()
+        counted_route, counted_area = run_a_star(grid, graph, start_latlon, end_latlon, stats=stats)
+        assert [row[2] for row in counted_route] == [row[2] for row in route]
+        assert stats.expanded == len(area) + 1 == len(counted_area) + 1
+        assert stats.edges_relaxed == np.diff(graph.indptr)[area.nodes].sum()
+        assert stats.heap_pushes >= stats.expanded
+        # Every push is the first push of a node or a decrease key
+        assert 0 <= stats.decrease_keys <= stats.heap_pushes - stats.expanded
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from pygradu import shortest_path
+
+# The turn table uses grid courses where the dict graph uses true bearings.
+# They differ by the meridian convergence along an edge, under a degree here.
+COURSE_ATOL_DEG = 1.0
+PENALTY_ATOL = COURSE_ATOL_DEG / 180 * shortest_path.TURN_PENALTY
+NODE_COUNT = 60
+
+
+@pytest.fixture(scope='module')
+def graphs(grid, edges):
+    graph = shortest_path.df_to_graph(edges, grid.get_node_count())
+    dict_graph = shortest_path.df_to_dict_graph(edges)
+    dict_graph.use_dirways = False
+    dict_graph.use_turn_penalty = True
+    return graph, dict_graph
+
+
+def get_course(grid, from_node, to_node):
+    return shortest_path.angleFromCoordinatesInDeg(grid.extract_coords_lat_lon(from_node),
+                                                   grid.extract_coords_lat_lon(to_node))
+
+
+def get_edge_index(graph, from_node, to_node):
+    start, end = graph.get_edge_range(from_node)
+    return start + int(np.searchsorted(graph.indices[start:end], to_node))
+
+
+def test_turn_table_matches_dict_graph(grid, graphs):
+    graph, dict_graph = graphs
+    turns = graph.get_turn_table(grid)
+    rng = np.random.default_rng(0)
+    nodes = rng.choice(np.flatnonzero(np.diff(graph.indptr)), NODE_COUNT, replace=False)
+    for node in nodes:
+        start, end = graph.get_edge_range(node)
+        next_nodes = graph.indices[start:end]
+        # Grid edges go both ways, so every neighbour is also a previous node
+        for previous in next_nodes:
+            course_code = turns.edge_codes[get_edge_index(graph, previous, node)]
+            penalties, next_codes = shortest_path.get_turn_penalties(
+                graph, grid, turns, node, course_code, None, next_nodes, None)
+            course = get_course(grid, previous, node)
+            expected = [dict_graph.cost(node, next_node, course, get_course(grid, node, next_node), set(), set()) -
+                        dict_graph.get_edge_cost(node, next_node) for next_node in next_nodes]
+            np.testing.assert_allclose(penalties, expected, rtol=0, atol=PENALTY_ATOL)
+            np.testing.assert_array_equal(next_codes, turns.edge_codes[start:end])
+
+
+# At the start the vessel course is compared to true bearings, like the dict graph does
+def test_start_penalties_match_dict_graph(grid, graphs):
+    graph, dict_graph = graphs
+    turns = graph.get_turn_table(grid)
+    rng = np.random.default_rng(1)
+    nodes = rng.choice(np.flatnonzero(np.diff(graph.indptr)), NODE_COUNT, replace=False)
+    for node, course in zip(nodes, rng.uniform(0, 360, NODE_COUNT)):
+        start, end = graph.get_edge_range(node)
+        next_nodes = graph.indices[start:end]
+        penalties, _ = shortest_path.get_turn_penalties(graph, grid, turns, node, -1, course, next_nodes, None)
+        expected = [dict_graph.cost(node, next_node, course, get_course(grid, node, next_node), set(), set()) -
+                    dict_graph.get_edge_cost(node, next_node) for next_node in next_nodes]
+        np.testing.assert_allclose(penalties, expected, rtol=0, atol=1e-9)
+
+
+def test_dirways_have_no_turn_penalty(grid, graphs):
+    graph, _ = graphs
+    turns = graph.get_turn_table(grid)
+    node = int(np.flatnonzero(np.diff(graph.indptr))[0])
+    start, end = graph.get_edge_range(node)
+    next_nodes = graph.indices[start:end]
+    dirway_mask = np.zeros(graph.node_count, dtype=bool)
+    dirway_mask[next_nodes[::2]] = True
+    penalties, _ = shortest_path.get_turn_penalties(graph, grid, turns, node, -1, 45.0, next_nodes, dirway_mask)
+    assert np.all(penalties[::2] == 0)